@@ -4,6 +4,7 @@ from sqlalchemy import engine_from_config
 from sqlalchemy import pool
 
 from alembic import context
+from alembic.util import CommandError
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -24,6 +25,9 @@ if config.config_file_name is not None:
 # import Base from models.py
 from models import Base
 
+# registers op.create_index_concurrently, op.drop_index_concurrently and op.backfill
+from migrations import lock_timeout_statement, online_revision_directives
+
 target_metadata = Base.metadata
 
 
@@ -53,6 +57,7 @@ def run_migrations_offline() -> None:
         target_metadata=target_metadata,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
+        process_revision_directives=online_revision_directives,
     )
 
     with context.begin_transaction():
@@ -72,8 +77,32 @@ def run_migrations_online() -> None:
         poolclass=pool.NullPool,
     )
 
+    # alembic -x dry_run=1 upgrade head: estimate the online operations, change nothing
+    dry_run = context.get_x_argument(as_dictionary=True).get("dry_run") not in (None, "", "0")
+
     with connectable.connect() as connection:
-        context.configure(connection=connection, target_metadata=target_metadata)
+        statement = lock_timeout_statement(connection.dialect.name)
+        if statement is not None:
+            connection.execute(statement)
+            connection.commit()
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            process_revision_directives=online_revision_directives,
+            # a failed revision does not roll back the ones before it, and the concurrent
+            # index builds and backfills commit between revisions
+            transaction_per_migration=not dry_run,
+            dry_run=dry_run,
+        )
+
+        if dry_run:
+            # alembic commits each revision when DDL is not transactional (SQLite)
+            if not context.get_context().impl.transactional_ddl:
+                raise CommandError("dry runs need a database with transactional DDL")
+            with connection.begin() as transaction:
+                context.run_migrations()
+                transaction.rollback()
+            return
 
         with context.begin_transaction():
             context.run_migrations()
@@ -18,6 +18,10 @@ branch_labels: Union[str, Sequence[str], None] = ${repr(branch_labels)}
 depends_on: Union[str, Sequence[str], None] = ${repr(depends_on)}
 
 
+# on tables that already hold data prefer op.create_index_concurrently,
+# op.drop_index_concurrently and op.backfill (see migrations.py)
+
+
 def upgrade() -> None:
     ${upgrades if upgrades else "pass"}
 
@@ -0,0 +1,33 @@
+"""revoked tokens unique jti
+
+Revision ID: a3f9d6c2e184
+Revises: f4c6a2d8b175
+Create Date: 2026-10-19 19:24:37.118402
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3f9d6c2e184'
+down_revision: Union[str, None] = 'f4c6a2d8b175'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # a jti revoked more than once (a logout after its rotation): keep the first row
+    op.execute(
+        "DELETE FROM revoked_tokens WHERE key LIKE 'jti:%' AND id NOT IN "
+        "(SELECT min(id) FROM revoked_tokens WHERE key LIKE 'jti:%' GROUP BY key)"
+    )
+    op.create_index_concurrently(
+        'uq_revoked_tokens_jti', 'revoked_tokens', ['key'], unique=True, where="key LIKE 'jti:%'"
+    )
+
+
+def downgrade() -> None:
+    op.drop_index_concurrently('uq_revoked_tokens_jti', 'revoked_tokens')
@@ -0,0 +1,31 @@
+"""row versions for optimistic concurrency
+
+Revision ID: a7d3c95e2f14
+Revises: f2c84d6e1a93
+Create Date: 2026-10-19 19:02:37.640219
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7d3c95e2f14'
+down_revision: Union[str, None] = 'f2c84d6e1a93'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # existing rows start at version 1
+    op.add_column('magazines', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('subscriptions', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('subscriptions_archive', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('subscriptions_archive', 'version')
+    op.drop_column('subscriptions', 'version')
+    op.drop_column('magazines', 'version')
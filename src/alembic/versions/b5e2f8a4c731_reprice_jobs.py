@@ -0,0 +1,62 @@
+"""reprice jobs
+
+Revision ID: b5e2f8a4c731
+Revises: a7d3c95e2f14
+Create Date: 2026-10-19 19:48:13.502871
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b5e2f8a4c731'
+down_revision: Union[str, None] = 'a7d3c95e2f14'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('reprice_jobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('magazine_id', sa.Integer(), nullable=True),
+    sa.Column('status', sa.String(), nullable=True),
+    sa.Column('total', sa.Integer(), nullable=True),
+    sa.Column('updated', sa.Integer(), nullable=True),
+    sa.Column('last_id', sa.Integer(), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=True),
+    sa.Column('next_attempt_at', sa.DateTime(), nullable=True),
+    sa.Column('last_error', sa.String(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_reprice_jobs_id'), 'reprice_jobs', ['id'], unique=False)
+    op.create_index(op.f('ix_reprice_jobs_magazine_id'), 'reprice_jobs', ['magazine_id'], unique=False)
+    op.create_index(
+        'ix_reprice_jobs_unfinished_next_attempt_at',
+        'reprice_jobs',
+        ['next_attempt_at'],
+        unique=False,
+        postgresql_where=sa.text("status != 'done'"),
+        sqlite_where=sa.text("status != 'done'"),
+    )
+    op.create_index(
+        'ix_subscriptions_active_magazine_id',
+        'subscriptions',
+        ['magazine_id', 'id'],
+        unique=False,
+        postgresql_where=sa.text('is_active'),
+        sqlite_where=sa.text('is_active'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_subscriptions_active_magazine_id', table_name='subscriptions')
+    op.drop_index('ix_reprice_jobs_unfinished_next_attempt_at', table_name='reprice_jobs')
+    op.drop_index(op.f('ix_reprice_jobs_magazine_id'), table_name='reprice_jobs')
+    op.drop_index(op.f('ix_reprice_jobs_id'), table_name='reprice_jobs')
+    op.drop_table('reprice_jobs')
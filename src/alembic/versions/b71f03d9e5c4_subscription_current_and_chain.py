@@ -0,0 +1,43 @@
+"""subscription current index and replacement chain
+
+Revision ID: b71f03d9e5c4
+Revises: 9e4b7d2c6a18
+Create Date: 2026-10-19 10:41:55.120937
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b71f03d9e5c4'
+down_revision: Union[str, None] = '9e4b7d2c6a18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('subscriptions', sa.Column('previous_subscription_id', sa.Integer(), nullable=True))
+    op.create_index(op.f('ix_subscriptions_previous_subscription_id'), 'subscriptions', ['previous_subscription_id'], unique=False)
+    # keep only the newest active subscription per user and magazine before enforcing the rule
+    op.execute(
+        "UPDATE subscriptions SET is_active = false "
+        "WHERE is_active AND id NOT IN ("
+        "SELECT max(id) FROM subscriptions WHERE is_active GROUP BY user_id, magazine_id)"
+    )
+    op.create_index(
+        'uq_subscriptions_active_user_magazine',
+        'subscriptions',
+        ['user_id', 'magazine_id'],
+        unique=True,
+        postgresql_where=sa.text('is_active'),
+        sqlite_where=sa.text('is_active'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('uq_subscriptions_active_user_magazine', table_name='subscriptions')
+    op.drop_index(op.f('ix_subscriptions_previous_subscription_id'), table_name='subscriptions')
+    op.drop_column('subscriptions', 'previous_subscription_id')
@@ -0,0 +1,59 @@
+"""subscriptions archive
+
+Revision ID: c4a2e81f9d07
+Revises: b71f03d9e5c4
+Create Date: 2026-10-19 11:26:08.357120
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4a2e81f9d07'
+down_revision: Union[str, None] = 'b71f03d9e5c4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('subscriptions', sa.Column('deactivated_at', sa.DateTime(), nullable=True))
+    # rows deactivated before the column existed: their renewal date, so archiving can filter
+    # on deactivated_at alone and use the partial index
+    op.execute(
+        "UPDATE subscriptions SET deactivated_at = next_renewal_date "
+        "WHERE NOT is_active AND deactivated_at IS NULL"
+    )
+    op.create_index(
+        'ix_subscriptions_inactive_deactivated_at',
+        'subscriptions',
+        ['deactivated_at'],
+        unique=False,
+        postgresql_where=sa.text('NOT is_active'),
+        sqlite_where=sa.text('NOT is_active'),
+    )
+    op.create_table('subscriptions_archive',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('magazine_id', sa.Integer(), nullable=True),
+    sa.Column('plan_id', sa.Integer(), nullable=True),
+    sa.Column('price', sa.Float(), nullable=True),
+    sa.Column('next_renewal_date', sa.DateTime(), nullable=True),
+    sa.Column('is_active', sa.Boolean(), nullable=True),
+    sa.Column('previous_subscription_id', sa.Integer(), nullable=True),
+    sa.Column('deactivated_at', sa.DateTime(), nullable=True),
+    sa.Column('archived_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_subscriptions_archive_previous_subscription_id'), 'subscriptions_archive', ['previous_subscription_id'], unique=False)
+    op.create_index(op.f('ix_subscriptions_archive_user_id'), 'subscriptions_archive', ['user_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_subscriptions_archive_user_id'), table_name='subscriptions_archive')
+    op.drop_index(op.f('ix_subscriptions_archive_previous_subscription_id'), table_name='subscriptions_archive')
+    op.drop_table('subscriptions_archive')
+    op.drop_index('ix_subscriptions_inactive_deactivated_at', table_name='subscriptions')
+    op.drop_column('subscriptions', 'deactivated_at')
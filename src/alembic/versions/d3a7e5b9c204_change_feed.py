@@ -0,0 +1,80 @@
+"""change feed
+
+Revision ID: d3a7e5b9c204
+Revises: c8f1d2a6b953
+Create Date: 2026-10-19 21:26:44.905127
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd3a7e5b9c204'
+down_revision: Union[str, None] = 'c8f1d2a6b953'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+TABLES = {'users': 'user', 'magazines': 'magazine', 'subscriptions': 'subscription'}
+OPERATIONS = (('insert', 'new'), ('update', 'new'), ('delete', 'old'))
+
+
+def upgrade() -> None:
+    op.create_table('changes',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('seq', sa.Integer(), nullable=True),
+    sa.Column('entity', sa.String(), nullable=False),
+    sa.Column('entity_id', sa.Integer(), nullable=False),
+    sa.Column('operation', sa.String(), nullable=False),
+    sa.Column('changed_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_changes_seq'), 'changes', ['seq'], unique=True)
+    op.create_index(
+        'ix_changes_unsequenced_id',
+        'changes',
+        ['id'],
+        unique=False,
+        postgresql_where=sa.text('seq IS NULL'),
+        sqlite_where=sa.text('seq IS NULL'),
+    )
+    dialect = op.get_context().dialect.name
+    if dialect == 'postgresql':
+        op.execute(
+            "CREATE FUNCTION record_change() RETURNS trigger AS $$ BEGIN "
+            "INSERT INTO changes (entity, entity_id, operation, changed_at) VALUES (TG_ARGV[0], "
+            "CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END, lower(TG_OP), "
+            "now() AT TIME ZONE 'utc'); "
+            "RETURN NULL; END $$ LANGUAGE plpgsql"
+        )
+        for table, entity in TABLES.items():
+            op.execute(
+                f"CREATE TRIGGER {table}_change AFTER INSERT OR UPDATE OR DELETE ON {table} "
+                f"FOR EACH ROW EXECUTE FUNCTION record_change('{entity}')"
+            )
+    elif dialect == 'sqlite':
+        for table, entity in TABLES.items():
+            for operation, row in OPERATIONS:
+                op.execute(
+                    f"CREATE TRIGGER {table}_change_{operation} AFTER {operation.upper()} "
+                    f"ON {table} BEGIN INSERT INTO changes "
+                    f"(entity, entity_id, operation, changed_at) VALUES ('{entity}', "
+                    f"{row}.id, '{operation}', strftime('%Y-%m-%d %H:%M:%f', 'now')); END"
+                )
+
+
+def downgrade() -> None:
+    dialect = op.get_context().dialect.name
+    if dialect == 'postgresql':
+        for table in TABLES:
+            op.execute(f"DROP TRIGGER {table}_change ON {table}")
+        op.execute("DROP FUNCTION record_change()")
+    elif dialect == 'sqlite':
+        for table in TABLES:
+            for operation, _ in OPERATIONS:
+                op.execute(f"DROP TRIGGER {table}_change_{operation}")
+    op.drop_index('ix_changes_unsequenced_id', table_name='changes')
+    op.drop_index(op.f('ix_changes_seq'), table_name='changes')
+    op.drop_table('changes')
@@ -0,0 +1,65 @@
+"""magazine search
+
+Revision ID: e5b1c7a3f260
+Revises: d93a5f1c2b80
+Create Date: 2026-10-19 13:02:17.540913
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5b1c7a3f260'
+down_revision: Union[str, None] = 'd93a5f1c2b80'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SEARCH_VECTOR = (
+    "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'B')"
+)
+
+
+def upgrade() -> None:
+    dialect = op.get_context().dialect.name
+    if dialect == 'postgresql':
+        op.execute(f"CREATE INDEX ix_magazines_search ON magazines USING gin (({SEARCH_VECTOR}))")
+    elif dialect == 'sqlite':
+        op.execute(
+            "CREATE VIRTUAL TABLE magazines_fts USING fts5("
+            "name, description, content='magazines', content_rowid='id', "
+            "tokenize='porter unicode61')"
+        )
+        op.execute(
+            "CREATE TRIGGER magazines_fts_insert AFTER INSERT ON magazines BEGIN "
+            "INSERT INTO magazines_fts(rowid, name, description) "
+            "VALUES (new.id, new.name, new.description); END"
+        )
+        op.execute(
+            "CREATE TRIGGER magazines_fts_delete AFTER DELETE ON magazines BEGIN "
+            "INSERT INTO magazines_fts(magazines_fts, rowid, name, description) "
+            "VALUES ('delete', old.id, old.name, old.description); END"
+        )
+        op.execute(
+            "CREATE TRIGGER magazines_fts_update AFTER UPDATE ON magazines BEGIN "
+            "INSERT INTO magazines_fts(magazines_fts, rowid, name, description) "
+            "VALUES ('delete', old.id, old.name, old.description); "
+            "INSERT INTO magazines_fts(rowid, name, description) "
+            "VALUES (new.id, new.name, new.description); END"
+        )
+        # index the existing magazines
+        op.execute("INSERT INTO magazines_fts(magazines_fts) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    dialect = op.get_context().dialect.name
+    if dialect == 'postgresql':
+        op.execute("DROP INDEX ix_magazines_search")
+    elif dialect == 'sqlite':
+        op.execute("DROP TRIGGER magazines_fts_update")
+        op.execute("DROP TRIGGER magazines_fts_delete")
+        op.execute("DROP TRIGGER magazines_fts_insert")
+        op.execute("DROP TABLE magazines_fts")
@@ -0,0 +1,43 @@
+"""subscription summaries
+
+Revision ID: e9b4c1f7a352
+Revises: d3a7e5b9c204
+Create Date: 2026-10-19 22:08:31.640219
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e9b4c1f7a352'
+down_revision: Union[str, None] = 'd3a7e5b9c204'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('subscription_summaries',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('active_count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('next_renewal_date', sa.DateTime(), nullable=True),
+    sa.Column('monthly_spend', sa.Float(), server_default='0', nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    # the summaries of the existing active subscriptions
+    op.execute(
+        "INSERT INTO subscription_summaries "
+        "(user_id, active_count, next_renewal_date, monthly_spend, updated_at) "
+        "SELECT s.user_id, count(*), min(s.next_renewal_date), "
+        "round(CAST(sum(s.price / coalesce(p.renewal_period, 1)) AS numeric), 2), "
+        "CURRENT_TIMESTAMP "
+        "FROM subscriptions s LEFT JOIN plans p ON p.id = s.plan_id "
+        "WHERE s.is_active GROUP BY s.user_id"
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('subscription_summaries')
@@ -0,0 +1,54 @@
+"""magazine plans
+
+Revision ID: f2c84d6e1a93
+Revises: e5b1c7a3f260
+Create Date: 2026-10-19 13:41:52.118204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f2c84d6e1a93'
+down_revision: Union[str, None] = 'e5b1c7a3f260'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('magazine_plans',
+    sa.Column('magazine_id', sa.Integer(), nullable=False),
+    sa.Column('plan_id', sa.Integer(), nullable=False),
+    sa.Column('discount', sa.Float(), nullable=True),
+    sa.Column('price', sa.Float(), nullable=True),
+    sa.PrimaryKeyConstraint('magazine_id', 'plan_id')
+    )
+    op.create_index(op.f('ix_magazine_plans_plan_id'), 'magazine_plans', ['plan_id'], unique=False)
+    # offerings implied by the discount columns: monthly plans are offered without a discount,
+    # the other periods when the magazine has a discount for them
+    op.execute(
+        """
+        INSERT INTO magazine_plans (magazine_id, plan_id, discount, price)
+        SELECT magazine_id, plan_id, discount,
+               round(CAST(base_price * renewal_period * (1 - discount) AS NUMERIC), 2)
+        FROM (
+            SELECT m.id AS magazine_id, p.id AS plan_id, m.base_price, p.renewal_period,
+                   CASE p.renewal_period
+                       WHEN 1 THEN 0.0
+                       WHEN 3 THEN m.discount_quarterly
+                       WHEN 6 THEN m.discount_half_yearly
+                       WHEN 12 THEN m.discount_annual
+                   END AS discount
+            FROM magazines m CROSS JOIN plans p
+        ) offerings
+        WHERE discount IS NOT NULL
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_magazine_plans_plan_id'), table_name='magazine_plans')
+    op.drop_table('magazine_plans')
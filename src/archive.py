@@ -0,0 +1,94 @@
+# hot/cold split for subscriptions: inactive rows older than the retention window are moved
+# into subscriptions_archive in small batches, so the subscriptions table (and its indexes)
+# only holds live and recently deactivated rows
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, insert, delete, literal, text
+from sqlalchemy.orm import Session
+
+from models import Subscription, SubscriptionArchive
+from fieldsets import columns
+
+# inactive subscriptions are kept in the hot table for this many days
+ARCHIVE_RETENTION_DAYS = 90
+# rows moved per transaction
+ARCHIVE_BATCH_SIZE = 500
+
+# the predicate of ix_subscriptions_inactive_deactivated_at, verbatim so SQLite uses the partial
+# index (the migration that added deactivated_at backfilled it for inactive rows)
+INACTIVE = text("NOT subscriptions.is_active")
+
+ARCHIVED_COLUMNS = [column.key for column in Subscription.__table__.columns]
+
+
+# move inactive subscriptions deactivated before the retention window, returns the number moved
+def archive_inactive_subscriptions(
+    db: Session,
+    retention_days: int = ARCHIVE_RETENTION_DAYS,
+    batch_size: int = ARCHIVE_BATCH_SIZE,
+    max_batches: int = None,
+):
+    now = datetime.utcnow()
+    cutoff = now - timedelta(days=retention_days)
+    archived = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        ids = (
+            db.execute(
+                select(Subscription.id)
+                .where(INACTIVE, Subscription.deactivated_at < cutoff)
+                .order_by(Subscription.deactivated_at)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            .scalars()
+            .all()
+        )
+        if not ids:
+            break
+        db.execute(
+            insert(SubscriptionArchive).from_select(
+                ARCHIVED_COLUMNS + ["archived_at"],
+                select(
+                    *(getattr(Subscription, key) for key in ARCHIVED_COLUMNS),
+                    literal(now),
+                ).where(Subscription.id.in_(ids)),
+            )
+        )
+        db.execute(
+            delete(Subscription).where(Subscription.id.in_(ids)),
+            execution_options={"synchronize_session": False},
+        )
+        db.commit()
+        archived += len(ids)
+        batches += 1
+        if len(ids) < batch_size:
+            break
+    return archived
+
+
+# subscriptions and archived subscriptions as one selectable, for history lookups
+def all_subscriptions():
+    return (
+        select(*(getattr(Subscription, key) for key in ARCHIVED_COLUMNS))
+        .union_all(
+            select(*(getattr(SubscriptionArchive, key) for key in ARCHIVED_COLUMNS))
+        )
+        .subquery("all_subscriptions")
+    )
+
+
+# an archived subscription as a row of the given columns (all of them by default)
+def get_archived_subscription(db: Session, subscription_id: int, fields: tuple = None):
+    return db.execute(
+        select(*columns(SubscriptionArchive, fields)).where(
+            SubscriptionArchive.id == subscription_id
+        )
+    ).first()
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    with SessionLocal() as db:
+        print(f"archived {archive_inactive_subscriptions(db)} subscriptions")
@@ -0,0 +1,101 @@
+# downstream sync: polling the full subscription list against polling the change feed
+#
+#   python -m benchmarks.changes --subscriptions 10000 100000 --changes 100
+#
+# For every table size the benchmark changes --changes subscriptions between two polls and
+# times one GET /subscriptions/ (what the CRM diffed so far) and one GET /changes from the
+# previous cursor, which returns just those changes. Sequencing them (the background
+# sequencer's work) is timed on its own.
+import asyncio
+import time
+from datetime import datetime
+
+from sqlalchemy import func, insert, select, update
+
+from benchmarks.common import parser, setup_database, client, Timer
+from changefeed import sequence_changes
+from database import SessionLocal
+from models import Change, Magazine, Plan, Subscription
+from utils import ADMIN_TOKEN
+
+HEADERS = {"X-Admin-Token": ADMIN_TOKEN}
+
+
+def seed(count: int, start_user: int):
+    with SessionLocal() as db:
+        magazine = db.execute(select(Magazine.id)).scalar()
+        plan = db.execute(select(Plan.id)).scalar()
+        if magazine is None:
+            magazine_row = Magazine(name="changes bench", description="", base_price=5.0)
+            plan_row = Plan(title="Monthly", description="", renewal_period=1)
+            db.add_all([magazine_row, plan_row])
+            db.flush()
+            magazine, plan = magazine_row.id, plan_row.id
+        renewal = datetime(2030, 1, 1)
+        for offset in range(0, count, 10000):
+            db.execute(
+                insert(Subscription),
+                [
+                    {
+                        "user_id": start_user + i,
+                        "magazine_id": magazine,
+                        "plan_id": plan,
+                        "price": 5.0,
+                        "next_renewal_date": renewal,
+                        "is_active": True,
+                    }
+                    for i in range(offset, min(offset + 10000, count))
+                ],
+            )
+        db.commit()
+        # a consumer that is up to date
+        while sequence_changes(db):
+            pass
+
+
+async def polls(changes: int):
+    async with client() as http:
+        with SessionLocal() as db:
+            ids = db.execute(select(Subscription.id).limit(changes)).scalars().all()
+            since = db.execute(select(func.max(Change.seq))).scalar()
+            db.execute(
+                update(Subscription)
+                .where(Subscription.id.in_(ids))
+                .values(price=Subscription.price + 0.5, version=Subscription.version + 1),
+                execution_options={"synchronize_session": False},
+            )
+            db.commit()
+            with Timer() as sequencing:
+                while sequence_changes(db):
+                    pass
+        with Timer() as full:
+            response = await http.get("/subscriptions/")
+            assert response.status_code == 200
+        with Timer() as feed:
+            response = await http.get(f"/changes?since={since}&limit=1000", headers=HEADERS)
+            assert len(response.json()["changes"]) == changes
+    return full.elapsed, feed.elapsed, sequencing.elapsed
+
+
+def main():
+    args = parser("Full list against change feed polling")
+    args.add_argument("--subscriptions", type=int, nargs="+", default=[10000, 100000])
+    args.add_argument("--changes", type=int, default=100)
+    options = args.parse_args()
+    setup_database(options.database_url)
+    total = 0
+    for size in options.subscriptions:
+        start = time.perf_counter()
+        seed(size - total, total)
+        seeded = time.perf_counter() - start
+        total = size
+        full, feed, sequencing = asyncio.run(polls(options.changes))
+        print(
+            f"{size} subscriptions (seeded in {seeded:.1f} s), {options.changes} changes: "
+            f"GET /subscriptions/ {full * 1000:.1f} ms, GET /changes {feed * 1000:.1f} ms "
+            f"(sequenced in {sequencing * 1000:.1f} ms)"
+        )
+
+
+if __name__ == "__main__":
+    main()
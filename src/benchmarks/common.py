@@ -0,0 +1,84 @@
+# shared setup for the benchmark scripts: point the app at a benchmark database
+# and drive it in-process through httpx.ASGITransport
+import argparse
+import os
+import statistics
+import time
+
+import httpx
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from main import app
+from models import Base
+from database import get_db, SessionLocal
+
+# a throwaway SQLite file by default, pass --database-url to benchmark PostgreSQL
+DEFAULT_DATABASE_URL = "sqlite:///./bench.db"
+
+
+def parser(description: str):
+    args = argparse.ArgumentParser(description=description)
+    args.add_argument("--database-url", default=DEFAULT_DATABASE_URL)
+    return args
+
+
+# create the schema and route every session of the app to the benchmark database
+def setup_database(url: str, pool_size: int = 20, max_overflow: int = 10):
+    if url.startswith("sqlite:///./") and os.path.exists(url[len("sqlite:///") :]):
+        os.remove(url[len("sqlite:///") :])
+    connect_args = {"check_same_thread": False} if url.startswith("sqlite") else {}
+    engine = create_engine(
+        url, connect_args=connect_args, pool_size=pool_size, max_overflow=max_overflow
+    )
+    Base.metadata.create_all(bind=engine)
+    BenchSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    def override_get_db():
+        db = BenchSessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = override_get_db
+    SessionLocal.configure(bind=engine)
+    return engine
+
+
+# in-process client by default, or a real HTTP client for a running server (e.g. uvicorn)
+def client(url: str = None, timeout: float = 30):
+    if url:
+        return httpx.AsyncClient(
+            base_url=url, timeout=timeout, limits=httpx.Limits(max_connections=None)
+        )
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=timeout
+    )
+
+
+def percentile(samples: list, pct: float):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def summary(latencies: list, elapsed: float, percentiles=(50, 99)):
+    result = {
+        "requests": len(latencies),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0,
+    }
+    for pct in percentiles:
+        result[f"p{pct}_ms"] = round(percentile(latencies, pct) * 1000, 2)
+    return result
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
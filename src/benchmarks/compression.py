@@ -0,0 +1,111 @@
+# CPU cost against bytes saved for the catalog compression
+#
+#   python -m benchmarks.compression --magazines 200 --plans 4
+#
+# For every encoding/level it reports the compressed size, the ratio and the CPU time per
+# compression, then compares GET /magazines/ latency when compressing on every request
+# with serving the precompressed cached body.
+import asyncio
+import time
+
+from benchmarks.common import parser, setup_database, client, summary, Timer
+from catalog import catalog_cache, derive_offerings
+from compression import compress, supported_encodings
+from models import Magazine, Plan
+from database import SessionLocal
+
+PERIODS = (1, 3, 6, 12)
+
+
+def seed(magazines: int, plans: int):
+    with SessionLocal() as db:
+        for i in range(plans):
+            db.add(
+                Plan(
+                    title=f"Plan {i}",
+                    description=f"Renews every {PERIODS[i % 4]} months",
+                    renewal_period=PERIODS[i % 4],
+                )
+            )
+        for i in range(magazines):
+            db.add(
+                Magazine(
+                    name=f"Magazine {i}",
+                    description=f"Issue after issue of magazine number {i}",
+                    base_price=5 + i % 10,
+                    discount_quarterly=0.05,
+                    discount_half_yearly=0.1,
+                    discount_annual=0.15,
+                )
+            )
+        db.flush()
+        derive_offerings(db)
+        db.commit()
+
+
+def cpu_cost(body: bytes, rounds: int):
+    results = []
+    for encoding in supported_encodings():
+        for best in (False, True):
+            start = time.process_time()
+            for _ in range(rounds):
+                compressed = compress(body, encoding, best=best)
+            cpu_ms = (time.process_time() - start) / rounds * 1000
+            results.append(
+                {
+                    "encoding": encoding,
+                    "level": "best" if best else "dynamic",
+                    "bytes": len(compressed),
+                    "saved_bytes": len(body) - len(compressed),
+                    "ratio": round(len(body) / len(compressed), 1),
+                    "cpu_ms": round(cpu_ms, 3),
+                    "saved_kb_per_cpu_ms": round(
+                        (len(body) - len(compressed)) / 1024 / max(cpu_ms, 1e-6), 1
+                    ),
+                }
+            )
+    return results
+
+
+async def latency(requests: int, cached: bool):
+    latencies = []
+    async with client() as http:
+        with Timer() as timer:
+            for _ in range(requests):
+                if not cached:
+                    # forget the cached body so every request builds and compresses it
+                    catalog_cache.clear()
+                start = time.perf_counter()
+                response = await http.get(
+                    "/magazines/", headers={"Accept-Encoding": "br, gzip"}
+                )
+                latencies.append(time.perf_counter() - start)
+    return {**summary(latencies, timer.elapsed), "decoded_bytes": len(response.content)}
+
+
+def main():
+    args = parser("Catalog compression cost")
+    args.add_argument("--magazines", type=int, default=200)
+    args.add_argument("--plans", type=int, default=4)
+    args.add_argument("--rounds", type=int, default=20)
+    args.add_argument("--requests", type=int, default=200)
+    options = args.parse_args()
+    setup_database(options.database_url)
+    seed(options.magazines, options.plans)
+
+    body = asyncio.run(_raw_body())
+    print(f"catalog: {options.magazines} magazines x {options.plans} plans, {len(body)} bytes")
+    for result in cpu_cost(body, options.rounds):
+        print(result)
+    print("uncached (build + compress per request):", asyncio.run(latency(options.requests, cached=False)))
+    print("cached (precompressed per version):", asyncio.run(latency(options.requests, cached=True)))
+
+
+async def _raw_body():
+    async with client() as http:
+        response = await http.get("/magazines/", headers={"Accept-Encoding": "identity"})
+        return response.content
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# bytes and latency saved by sparse fieldsets (?fields=) on the list endpoints
+#
+#   python -m benchmarks.fields --magazines 200 --plans 4 --subscriptions 5000
+#
+# Every endpoint is requested with all fields and with the fields a mobile client needs,
+# uncompressed so the byte counts compare serialised payloads. The catalog cache is cleared
+# before every magazine request so the query and serialisation are part of the latency.
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.common import parser, setup_database, client, summary, Timer
+from benchmarks.compression import seed as seed_catalog
+from catalog import catalog_cache
+from database import SessionLocal
+from models import Subscription
+
+CASES = [
+    ("/magazines/", "id,name,base_price"),
+    ("/plans/", "id,title,renewal_period"),
+    ("/subscriptions/", "id,magazine_id,next_renewal_date"),
+]
+
+
+def seed_subscriptions(count: int, magazines: int, plans: int):
+    renewal = datetime.utcnow() + timedelta(days=30)
+    with SessionLocal() as db:
+        db.add_all(
+            Subscription(
+                user_id=i,
+                magazine_id=random.randint(1, magazines),
+                plan_id=random.randint(1, plans),
+                price=10.0,
+                next_renewal_date=renewal,
+            )
+            for i in range(count)
+        )
+        db.commit()
+
+
+async def measure(path: str, fields: str, requests: int):
+    params = {"fields": fields} if fields else {}
+    latencies = []
+    async with client() as http:
+        with Timer() as timer:
+            for _ in range(requests):
+                catalog_cache.clear()
+                start = time.perf_counter()
+                response = await http.get(
+                    path, params=params, headers={"Accept-Encoding": "identity"}
+                )
+                latencies.append(time.perf_counter() - start)
+    return {**summary(latencies, timer.elapsed), "bytes": len(response.content)}
+
+
+def main():
+    args = parser("Sparse fieldset savings")
+    args.add_argument("--magazines", type=int, default=200)
+    args.add_argument("--plans", type=int, default=4)
+    args.add_argument("--subscriptions", type=int, default=5000)
+    args.add_argument("--requests", type=int, default=100)
+    options = args.parse_args()
+    setup_database(options.database_url)
+    seed_catalog(options.magazines, options.plans)
+    seed_subscriptions(options.subscriptions, options.magazines, options.plans)
+
+    for path, fields in CASES:
+        full = asyncio.run(measure(path, None, options.requests))
+        sparse = asyncio.run(measure(path, fields, options.requests))
+        print(f"{path} all fields: {full}")
+        print(f"{path} fields={fields}: {sparse}")
+        print(
+            f"{path} saved: {full['bytes'] - sparse['bytes']} bytes "
+            f"({1 - sparse['bytes'] / full['bytes']:.0%}), "
+            f"p50 {full['p50_ms'] - sparse['p50_ms']:.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# subscription write throughput with a commit per request against group commit
+#
+#   python -m benchmarks.groupcommit --requests 2000 --concurrency 8 32 64
+#   python -m benchmarks.groupcommit --database-url postgresql+psycopg2://... --max-wait-ms 2
+#
+# Every request creates a subscription for a distinct (user, magazine) pair, then modifies it.
+import asyncio
+import time
+import uuid
+
+from benchmarks.common import parser, setup_database, client, summary, Timer
+from database import SessionLocal
+from groupcommit import group_committer
+from utils import ADMIN_TOKEN
+
+
+async def seed(http, users: int, magazines: int):
+    run = uuid.uuid4().hex[:8]
+    plan = (
+        await http.post(
+            "/plans/",
+            json={"title": f"gc {run}", "description": "monthly", "renewal_period": 1},
+        )
+    ).json()
+    magazine_ids = []
+    for i in range(magazines):
+        response = await http.post(
+            "/magazines/",
+            json={"name": f"gc {run} {i}", "description": "bench", "base_price": 5.0},
+        )
+        magazine_ids.append(response.json()["id"])
+    user_ids = []
+    for start in range(0, users, 500):
+        batch = [
+            {
+                "username": f"gc{run}{i}",
+                "email": f"gc{run}{i}@example.com",
+                "password": "benchpassword",
+            }
+            for i in range(start, min(start + 500, users))
+        ]
+        response = await http.post(
+            "/users/register/batch", json={"users": batch}, headers={"X-Admin-Token": ADMIN_TOKEN}
+        )
+        user_ids += [row["id"] for row in response.json()["created"]]
+    return plan["id"], user_ids, magazine_ids
+
+
+async def run(requests: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = {"create": [], "modify": []}
+    statuses = {}
+
+    async with client() as http:
+        magazines = 20
+        plan_id, user_ids, magazine_ids = await seed(
+            http, requests // magazines + 1, magazines
+        )
+
+        async def send(kind, request):
+            start = time.perf_counter()
+            try:
+                response = await request
+                status = response.status_code
+            except Exception as error:
+                # e.g. "database is locked" surfacing through ASGITransport on SQLite
+                response, status = None, type(error).__name__
+            latencies[kind].append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+            return response
+
+        async def write(i):
+            body = {
+                "user_id": user_ids[i // magazines],
+                "magazine_id": magazine_ids[i % magazines],
+                "plan_id": plan_id,
+                "price": 5.0,
+                "next_renewal_date": "2030-01-01",
+            }
+            async with semaphore:
+                response = await send("create", http.post("/subscriptions/", json=body))
+                if response is None or response.status_code != 200:
+                    return
+                body["price"] = 6.0
+                path = f"/subscriptions/{response.json()['id']}"
+                await send("modify", http.put(path, json=body))
+
+        with Timer() as timer:
+            await asyncio.gather(*(write(i) for i in range(requests)))
+    return {
+        "writes_per_second": round(2 * requests / timer.elapsed, 1),
+        "create": summary(latencies["create"], timer.elapsed),
+        "modify": summary(latencies["modify"], timer.elapsed),
+        "statuses": statuses,
+    }
+
+
+def main():
+    args = parser("Subscription writes: commit per request vs group commit")
+    args.add_argument("--requests", type=int, default=2000)
+    args.add_argument("--concurrency", type=int, nargs="+", default=[8, 32, 64])
+    args.add_argument("--max-batch", type=int, default=200)
+    args.add_argument("--max-wait-ms", type=float, default=5)
+    options = args.parse_args()
+    setup_database(options.database_url)
+    group_committer.max_batch = options.max_batch
+    group_committer.max_wait = options.max_wait_ms / 1000
+    for concurrency in options.concurrency:
+        result = asyncio.run(run(options.requests, concurrency))
+        print(f"commit per request, concurrency={concurrency}: {result}")
+        group_committer.start(SessionLocal)
+        batches, writes = group_committer.batches, group_committer.writes
+        try:
+            result = asyncio.run(run(options.requests, concurrency))
+        finally:
+            group_committer.stop()
+        batches = group_committer.batches - batches
+        result["mean_batch"] = round((group_committer.writes - writes) / max(batches, 1), 1)
+        print(f"group commit, concurrency={concurrency}: {result}")
+
+
+if __name__ == "__main__":
+    main()
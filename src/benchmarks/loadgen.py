@@ -0,0 +1,366 @@
+# scenario based load generator: open-loop arrivals of weighted user journeys (login storm,
+# catalog browsing, subscription churn, sign-ups) against the app in-process or a running server
+#
+#   python -m benchmarks.loadgen --profile morning
+#   python -m benchmarks.loadgen --profile mixed --rate-scale 2 --pool-size 5 --max-overflow 0
+#   python -m benchmarks.loadgen --profile ./my_profile.json --url http://localhost:8000
+#
+# A profile is a list of phases, each with a duration (seconds), an arrival rate (scenario
+# runs per second, Poisson arrivals) and a scenario mix (relative weights), e.g.
+#
+#   [{"duration": 10, "rate": 80, "mix": {"login": 8, "browse": 2}},
+#    {"duration": 20, "rate": 40, "mix": {"browse": 5, "churn": 3, "signup": 1}}]
+#
+# Latency is measured from the scheduled arrival, so time spent queued behind a saturated
+# app is included. DB pool wait (time to check a connection out of the pool) is only
+# available in-process.
+import asyncio
+import contextvars
+import json
+import random
+import time
+import uuid
+from datetime import date, timedelta
+
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.common import parser, setup_database, client, summary, percentile, Timer
+from database import get_db
+from main import app
+from utils import ADMIN_TOKEN
+
+PASSWORD = "loadgenpassword"
+PLAN_PERIODS = (1, 3, 6, 12)
+PERCENTILES = (50, 90, 99)
+
+# built-in traffic profiles
+PROFILES = {
+    "mixed": [
+        {
+            "duration": 30,
+            "rate": 40,
+            "mix": {"login": 2, "browse": 5, "churn": 2, "signup": 1},
+        },
+    ],
+    # login storm at opening time, then browsing with subscription churn
+    "morning": [
+        {"duration": 10, "rate": 80, "mix": {"login": 8, "browse": 2}},
+        {"duration": 20, "rate": 40, "mix": {"browse": 5, "churn": 3, "login": 1}},
+    ],
+    "churn": [
+        {"duration": 20, "rate": 30, "mix": {"churn": 1}},
+    ],
+}
+
+# pool wait samples of the scenario run the current request belongs to
+current_pool_waits = contextvars.ContextVar("current_pool_waits", default=None)
+
+
+# route the app's sessions through a get_db that checks a connection out eagerly and
+# records how long that took for the scenario run making the request
+def measure_pool_wait(engine):
+    LoadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    def timed_get_db():
+        db = LoadSessionLocal()
+        try:
+            start = time.perf_counter()
+            db.connection()
+            waits = current_pool_waits.get()
+            if waits is not None:
+                waits.append(time.perf_counter() - start)
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = timed_get_db
+
+
+def load_profile(name: str, rate_scale: float, duration_scale: float):
+    if name in PROFILES:
+        phases = PROFILES[name]
+    else:
+        with open(name) as f:
+            phases = json.load(f)
+    return [
+        {
+            "duration": phase["duration"] * duration_scale,
+            "rate": phase["rate"] * rate_scale,
+            "mix": phase["mix"],
+        }
+        for phase in phases
+    ]
+
+
+class Population:
+    # users, magazines and plans created before the run, shared by all scenarios
+    def __init__(self):
+        self.run = uuid.uuid4().hex[:8]
+        self.users = []
+        self.magazines = []
+        self.plans = []
+        self.signups = 0
+
+    async def seed(self, http, users: int, magazines: int):
+        for period in PLAN_PERIODS:
+            response = await http.post(
+                "/plans/",
+                json={
+                    "title": f"loadgen {self.run} {period}",
+                    "description": f"{period} month plan",
+                    "renewal_period": period,
+                },
+            )
+            response.raise_for_status()
+            self.plans.append(response.json()["id"])
+        for i in range(magazines):
+            response = await http.post(
+                "/magazines/",
+                json={
+                    "name": f"loadgen {self.run} {i}",
+                    "description": "load generator magazine",
+                    "base_price": 5.0 + i % 10,
+                    "discount_quarterly": 0.1,
+                    "discount_half_yearly": 0.2,
+                    "discount_annual": 0.3,
+                },
+            )
+            response.raise_for_status()
+            self.magazines.append(response.json()["id"])
+        for start in range(0, users, 500):
+            batch = [
+                {
+                    "username": f"load{self.run}{i}",
+                    "email": f"load{self.run}{i}@example.com",
+                    "password": PASSWORD,
+                }
+                for i in range(start, min(start + 500, users))
+            ]
+            response = await http.post(
+                "/users/register/batch", json={"users": batch}, headers={"X-Admin-Token": ADMIN_TOKEN}
+            )
+            response.raise_for_status()
+            self.users.extend(
+                {"id": row["id"], "username": row["username"]}
+                for row in response.json()["created"]
+            )
+        # every user starts with one active subscription, churned by the churn scenario
+        semaphore = asyncio.Semaphore(20)
+
+        async def subscribe(user):
+            user["magazine_id"] = random.choice(self.magazines)
+            async with semaphore:
+                response = await http.post(
+                    "/subscriptions/",
+                    json={
+                        "user_id": user["id"],
+                        "magazine_id": user["magazine_id"],
+                        "plan_id": self.plans[0],
+                        "price": 5.0,
+                        "next_renewal_date": str(date.today() + timedelta(days=30)),
+                    },
+                )
+            response.raise_for_status()
+
+        await asyncio.gather(*(subscribe(user) for user in self.users))
+
+
+# scenarios: each runs one user journey and returns the status codes it saw
+async def login(http, population: Population):
+    user = random.choice(population.users)
+    response = await http.post(
+        "/users/login", json={"username": user["username"], "password": PASSWORD}
+    )
+    statuses = [response.status_code]
+    if response.status_code == 200:
+        token = response.json()["access_token"]
+        response = await http.get(
+            "/users/me", headers={"Authorization": f"Bearer {token}"}
+        )
+        statuses.append(response.status_code)
+    return statuses
+
+
+async def browse(http, population: Population):
+    statuses = []
+    response = await http.get("/magazines/", headers={"Accept-Encoding": "br, gzip"})
+    statuses.append(response.status_code)
+    for magazine_id in random.sample(population.magazines, min(3, len(population.magazines))):
+        response = await http.get(f"/magazines/{magazine_id}")
+        statuses.append(response.status_code)
+    response = await http.get("/plans/")
+    statuses.append(response.status_code)
+    return statuses
+
+
+async def churn(http, population: Population):
+    # switch a user's current subscription to another plan through modify_subscription
+    user = random.choice(population.users)
+    response = await http.get(
+        "/subscriptions/current",
+        params={"user_id": user["id"], "magazine_id": user["magazine_id"]},
+    )
+    statuses = [response.status_code]
+    if response.status_code != 200:
+        return statuses
+    current = response.json()
+    plan_id = random.choice([plan for plan in population.plans if plan != current["plan_id"]])
+    response = await http.put(
+        f"/subscriptions/{current['id']}",
+        json={
+            "user_id": user["id"],
+            "magazine_id": user["magazine_id"],
+            "plan_id": plan_id,
+            "price": current["price"],
+            "next_renewal_date": str(date.today() + timedelta(days=90)),
+        },
+    )
+    statuses.append(response.status_code)
+    return statuses
+
+
+async def signup(http, population: Population):
+    population.signups += 1
+    n = population.signups
+    response = await http.post(
+        "/users/register",
+        json={
+            "username": f"signup{population.run}{n}",
+            "email": f"signup{population.run}{n}@example.com",
+            "password": PASSWORD,
+        },
+    )
+    return [response.status_code]
+
+
+SCENARIOS = {"login": login, "browse": browse, "churn": churn, "signup": signup}
+
+
+class ScenarioStats:
+    def __init__(self):
+        self.latencies = []
+        self.requests = 0
+        self.statuses = {}
+        self.failed_runs = 0
+        self.exceptions = 0
+        self.pool_waits = []
+
+    def report(self, elapsed: float, pool_wait: bool):
+        result = summary(self.latencies, elapsed, PERCENTILES)
+        result["runs"] = result.pop("requests")
+        result["http_requests"] = self.requests
+        result["error_rate"] = (
+            round(self.failed_runs / len(self.latencies), 4) if self.latencies else 0.0
+        )
+        result["statuses"] = dict(sorted(self.statuses.items()))
+        result["exceptions"] = self.exceptions
+        if pool_wait:
+            waits = self.pool_waits
+            result["pool_wait_mean_ms"] = (
+                round(sum(waits) / len(waits) * 1000, 3) if waits else 0.0
+            )
+            result["pool_wait_p99_ms"] = round(percentile(waits, 99) * 1000, 3)
+        return result
+
+
+async def run_scenario(http, name, population, stats, scheduled, semaphore):
+    waits = []
+    current_pool_waits.set(waits)
+    failed = False
+    try:
+        async with semaphore:
+            statuses = await SCENARIOS[name](http, population)
+        for status in statuses:
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+        stats.requests += len(statuses)
+        failed = any(status >= 400 for status in statuses)
+    except Exception:
+        # timeouts, connection errors, app exceptions surfacing through ASGITransport
+        stats.exceptions += 1
+        failed = True
+    stats.latencies.append(time.perf_counter() - scheduled)
+    stats.failed_runs += failed
+    stats.pool_waits.extend(waits)
+
+
+async def run_phase(http, phase, population, stats, max_in_flight):
+    names = list(phase["mix"])
+    weights = [phase["mix"][name] for name in names]
+    semaphore = asyncio.Semaphore(max_in_flight)
+    tasks = []
+    start = time.perf_counter()
+    next_arrival = start
+    while next_arrival - start < phase["duration"]:
+        delay = next_arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        name = random.choices(names, weights)[0]
+        tasks.append(
+            asyncio.create_task(
+                run_scenario(http, name, population, stats[name], next_arrival, semaphore)
+            )
+        )
+        next_arrival += random.expovariate(phase["rate"])
+    await asyncio.gather(*tasks)
+
+
+async def run(options, pool_wait: bool):
+    random.seed(options.seed)
+    population = Population()
+    async with client(options.url, options.timeout) as http:
+        with Timer() as timer:
+            await population.seed(http, options.users, options.magazines)
+        print(
+            f"seeded {len(population.users)} users, {len(population.magazines)} magazines "
+            f"in {timer.elapsed:.1f}s"
+        )
+        phases = load_profile(options.profile, options.rate_scale, options.duration_scale)
+        for number, phase in enumerate(phases, 1):
+            stats = {name: ScenarioStats() for name in phase["mix"]}
+            with Timer() as timer:
+                await run_phase(http, phase, population, stats, options.max_in_flight)
+            print(
+                f"phase {number}: {phase['duration']:.0f}s at {phase['rate']:.0f}/s, "
+                f"mix {phase['mix']}"
+            )
+            for name, scenario_stats in stats.items():
+                print(f"  {name}: {scenario_stats.report(timer.elapsed, pool_wait)}")
+            total = ScenarioStats()
+            for scenario_stats in stats.values():
+                total.latencies += scenario_stats.latencies
+                total.requests += scenario_stats.requests
+                total.failed_runs += scenario_stats.failed_runs
+                total.exceptions += scenario_stats.exceptions
+                total.pool_waits += scenario_stats.pool_waits
+                for status, count in scenario_stats.statuses.items():
+                    total.statuses[status] = total.statuses.get(status, 0) + count
+            print(f"  total: {total.report(timer.elapsed, pool_wait)}")
+
+
+def main():
+    args = parser("Scenario based concurrent load generator")
+    args.add_argument("--url", help="base URL of a running server, in-process if omitted")
+    args.add_argument(
+        "--profile", default="mixed", help=f"{', '.join(PROFILES)} or a JSON file"
+    )
+    args.add_argument("--rate-scale", type=float, default=1.0)
+    args.add_argument("--duration-scale", type=float, default=1.0)
+    args.add_argument("--users", type=int, default=500)
+    args.add_argument("--magazines", type=int, default=50)
+    args.add_argument("--max-in-flight", type=int, default=256)
+    args.add_argument("--pool-size", type=int, default=20)
+    args.add_argument("--max-overflow", type=int, default=10)
+    args.add_argument("--timeout", type=float, default=30)
+    args.add_argument("--seed", type=int, default=None)
+    options = args.parse_args()
+    pool_wait = options.url is None
+    if pool_wait:
+        engine = setup_database(
+            options.database_url, options.pool_size, options.max_overflow
+        )
+        measure_pool_wait(engine)
+    asyncio.run(run(options, pool_wait))
+
+
+if __name__ == "__main__":
+    main()
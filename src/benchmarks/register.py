@@ -0,0 +1,81 @@
+# concurrent sign-up throughput of POST /users/register and POST /users/register/batch
+#
+#   python -m benchmarks.register --requests 2000 --concurrency 1 8 32
+import asyncio
+import time
+import uuid
+
+from benchmarks.common import parser, setup_database, client, summary, Timer
+from utils import ADMIN_TOKEN
+
+# the batch endpoint is admin only
+HEADERS = {"X-Admin-Token": ADMIN_TOKEN}
+
+
+async def register_many(requests: int, concurrency: int, duplicate_ratio: float):
+    run = uuid.uuid4().hex[:8]
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, statuses = [], {}
+    # every n-th request reuses an earlier username to exercise the conflict path (0: none)
+    every = max(1, round(1 / duplicate_ratio)) if duplicate_ratio > 0 else 0
+
+    async def register(http, i):
+        n = max(i - 1, 0) if every and i % every == 0 else i
+        body = {
+            "username": f"bench{run}{n}",
+            "email": f"bench{run}{n}@example.com",
+            "password": "benchpassword",
+        }
+        async with semaphore:
+            start = time.perf_counter()
+            response = await http.post("/users/register", json=body)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    async with client() as http:
+        with Timer() as timer:
+            await asyncio.gather(*(register(http, i) for i in range(requests)))
+    return {**summary(latencies, timer.elapsed), "statuses": statuses}
+
+
+async def register_batches(requests: int, batch_size: int):
+    run = uuid.uuid4().hex[:8]
+    latencies = []
+    async with client() as http:
+        with Timer() as timer:
+            for start in range(0, requests, batch_size):
+                users = [
+                    {
+                        "username": f"batch{run}{i}",
+                        "email": f"batch{run}{i}@example.com",
+                        "password": "benchpassword",
+                    }
+                    for i in range(start, min(start + batch_size, requests))
+                ]
+                began = time.perf_counter()
+                await http.post("/users/register/batch", json={"users": users}, headers=HEADERS)
+                latencies.append(time.perf_counter() - began)
+    result = summary(latencies, timer.elapsed)
+    result["users_per_second"] = round(requests / timer.elapsed, 1)
+    return result
+
+
+def main():
+    args = parser("Concurrent sign-up throughput")
+    args.add_argument("--requests", type=int, default=2000)
+    args.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    args.add_argument("--duplicate-ratio", type=float, default=0.05)
+    args.add_argument("--batch-size", type=int, default=500)
+    options = args.parse_args()
+    setup_database(options.database_url)
+    for concurrency in options.concurrency:
+        result = asyncio.run(
+            register_many(options.requests, concurrency, options.duplicate_ratio)
+        )
+        print(f"register concurrency={concurrency}: {result}")
+    result = asyncio.run(register_batches(options.requests, options.batch_size))
+    print(f"register/batch batch_size={options.batch_size}: {result}")
+
+
+if __name__ == "__main__":
+    main()
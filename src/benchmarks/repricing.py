@@ -0,0 +1,106 @@
+# chunked repricing of a magazine's active subscriptions, with reads running alongside
+#
+#   python -m benchmarks.repricing --subscriptions 100000 --chunk-size 200 500 2000
+#
+# Every round changes the magazine's base price, runs the reprice job in keyset chunks and
+# meanwhile reads subscriptions of that magazine from another thread, reporting the job's
+# throughput, its slowest chunk (the longest a transaction held its row locks) and the
+# latency of the concurrent reads.
+import random
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import insert, select
+
+import repricing
+from benchmarks.common import parser, setup_database, percentile
+from catalog import derive_offerings, replace_offerings
+from database import SessionLocal
+from models import Magazine, Plan, Subscription
+from repricing import enqueue_reprice, run_due_jobs
+
+
+def seed(count: int):
+    with SessionLocal() as db:
+        magazine = Magazine(name="reprice bench", description="", base_price=5.0)
+        plan = Plan(title="Monthly", description="", renewal_period=1)
+        db.add_all([magazine, plan])
+        db.flush()
+        derive_offerings(db)
+        renewal = datetime(2030, 1, 1)
+        for start in range(0, count, 10000):
+            db.execute(
+                insert(Subscription),
+                [
+                    {
+                        "user_id": i,
+                        "magazine_id": magazine.id,
+                        "plan_id": plan.id,
+                        "price": 5.0,
+                        "next_renewal_date": renewal,
+                        "is_active": True,
+                    }
+                    for i in range(start, min(start + 10000, count))
+                ],
+            )
+        db.commit()
+        return magazine.id
+
+
+def read_loop(ids: list, stop: threading.Event, latencies: list):
+    with SessionLocal() as db:
+        while not stop.is_set():
+            start = time.perf_counter()
+            db.execute(select(Subscription).where(Subscription.id == random.choice(ids))).all()
+            db.rollback()
+            latencies.append(time.perf_counter() - start)
+
+
+def main():
+    args = parser("Chunked subscription repricing")
+    args.add_argument("--subscriptions", type=int, default=100000)
+    args.add_argument("--chunk-size", type=int, nargs="+", default=[200, 500, 2000])
+    options = args.parse_args()
+    setup_database(options.database_url)
+    magazine_id = seed(options.subscriptions)
+    with SessionLocal() as db:
+        ids = db.execute(select(Subscription.id)).scalars().all()
+
+    chunks = []
+    record_progress = repricing._record_progress
+
+    def timed_progress(db, job_id, rows):
+        record_progress(db, job_id, rows)
+        chunks.append(time.perf_counter())
+
+    repricing._record_progress = timed_progress
+    for round, chunk_size in enumerate(options.chunk_size):
+        # what update_magazine does for a base price change
+        with SessionLocal() as db:
+            magazine = db.get(Magazine, magazine_id)
+            magazine.base_price = 6.0 + round
+            db.flush()
+            replace_offerings(db, magazine)
+            enqueue_reprice(db, magazine_id)
+            db.commit()
+        stop, latencies = threading.Event(), []
+        reader = threading.Thread(target=read_loop, args=(ids, stop, latencies))
+        reader.start()
+        chunks.clear()
+        start = time.perf_counter()
+        run_due_jobs(SessionLocal, chunk_size)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        reader.join()
+        gaps = [b - a for a, b in zip([start] + chunks, chunks)]
+        print(
+            f"chunk_size={chunk_size}: {options.subscriptions / elapsed:.0f} rows/s "
+            f"({elapsed:.2f} s, {len(chunks)} chunks, slowest chunk {max(gaps) * 1000:.1f} ms), "
+            f"concurrent reads: {len(latencies)}, p50 {percentile(latencies, 50) * 1000:.2f} ms, "
+            f"p99 {percentile(latencies, 99) * 1000:.2f} ms, max {max(latencies) * 1000:.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# time to warm a new worker's catalog: rebuilt from the database against loaded from a snapshot
+#
+#   python -m benchmarks.snapshot --magazines 2000 --plans 4
+#
+# The first /magazines/ and /plans/ requests (brotli) of a cold worker query, serialise and
+# compress the catalog; after load_snapshot() they are served from the primed cache.
+import asyncio
+import os
+import tempfile
+import time
+
+from benchmarks.common import parser, setup_database, client
+from benchmarks.compression import seed
+from catalog import catalog_cache
+from database import SessionLocal
+from snapshot import load_snapshot, write_snapshot
+
+PATHS = ("/magazines/", "/plans/")
+
+
+async def first_requests():
+    timings = {}
+    async with client() as http:
+        for path in PATHS:
+            start = time.perf_counter()
+            response = await http.get(path, headers={"Accept-Encoding": "br"})
+            timings[path] = round((time.perf_counter() - start) * 1000, 2)
+            assert response.status_code == 200
+    return timings
+
+
+def main():
+    args = parser("Catalog warm start from a snapshot")
+    args.add_argument("--magazines", type=int, default=2000)
+    args.add_argument("--plans", type=int, default=4)
+    args.add_argument("--rounds", type=int, default=5)
+    options = args.parse_args()
+    setup_database(options.database_url)
+    seed(options.magazines, options.plans)
+    path = os.path.join(tempfile.mkdtemp(), "catalog.snapshot")
+
+    for _ in range(options.rounds):
+        catalog_cache.clear()
+        cold = asyncio.run(first_requests())
+        with SessionLocal() as db:
+            start = time.perf_counter()
+            entries = write_snapshot(db, path)
+            written = (time.perf_counter() - start) * 1000
+            catalog_cache.clear()
+            start = time.perf_counter()
+            assert load_snapshot(db, path) == entries
+            loaded = (time.perf_counter() - start) * 1000
+        warm = asyncio.run(first_requests())
+        print(
+            f"cold first requests: {cold} ms, snapshot: {os.path.getsize(path)} bytes, "
+            f"write {written:.2f} ms, load {loaded:.2f} ms, "
+            f"first requests after load: {warm} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
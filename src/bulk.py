@@ -0,0 +1,122 @@
+# set-based bulk operations: single DELETE/UPDATE statements with RETURNING where the
+# database supports it, run in keyset chunks so every transaction (and its locks) stays short
+from sqlalchemy import select, delete, update
+from sqlalchemy.orm import Session
+
+# rows touched per statement / transaction
+BULK_CHUNK_SIZE = 1000
+
+
+def _supports_returning(db: Session, kind: str):
+    return getattr(db.get_bind().dialect, f"{kind}_returning", False)
+
+
+# whether the database has INSERT ... ON CONFLICT (see dialect_insert)
+def supports_on_conflict(db: Session):
+    return db.get_bind().dialect.name in ("postgresql", "sqlite")
+
+
+# dialect specific INSERT construct, needed for ON CONFLICT clauses
+def dialect_insert(db: Session, model):
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"ON CONFLICT is not supported on {dialect}")
+    return insert(model)
+
+
+def _run_chunked(
+    db, model, statement, kind, criteria, returning, chunk_size, on_chunk, after_id=None
+):
+    # returns the affected rows (the `returning` columns) of every chunk, starting after the
+    # id after_id (to resume an interrupted run)
+    affected = []
+    last_id = after_id
+    while True:
+        chunk = select(model.id).where(*criteria)
+        if last_id is not None:
+            chunk = chunk.where(model.id > last_id)
+        chunk = chunk.order_by(model.id).limit(chunk_size)
+        if _supports_returning(db, kind):
+            rows = db.execute(
+                statement.where(model.id.in_(chunk.scalar_subquery())).returning(
+                    model.id, *returning
+                ),
+                execution_options={"synchronize_session": False},
+            ).all()
+        else:
+            ids = db.execute(chunk).scalars().all()
+            rows = db.execute(
+                select(model.id, *returning).where(model.id.in_(ids))
+            ).all()
+            if ids:
+                db.execute(
+                    statement.where(model.id.in_(ids)),
+                    execution_options={"synchronize_session": False},
+                )
+        if rows and on_chunk is not None:
+            on_chunk(rows)
+        db.commit()
+        affected.extend(rows)
+        if len(rows) < chunk_size:
+            return affected
+        last_id = max(row[0] for row in rows)
+
+
+# delete every row matching criteria, returns the deleted rows
+def bulk_delete(
+    db: Session,
+    model,
+    *criteria,
+    returning=(),
+    chunk_size: int = BULK_CHUNK_SIZE,
+    on_chunk=None,
+):
+    return _run_chunked(
+        db, model, delete(model), "delete", criteria, returning, chunk_size, on_chunk
+    )
+
+
+# apply values to every row matching criteria, returns the updated rows
+def bulk_update(
+    db: Session,
+    model,
+    values: dict,
+    *criteria,
+    returning=(),
+    chunk_size: int = BULK_CHUNK_SIZE,
+    on_chunk=None,
+    after_id: int = None,
+):
+    return _run_chunked(
+        db,
+        model,
+        update(model).values(**values),
+        "update",
+        criteria,
+        returning,
+        chunk_size,
+        on_chunk,
+        after_id,
+    )
+
+
+# delete a single row with one statement, returns the deleted row or None
+# (the caller commits)
+def delete_one(db: Session, model, *criteria):
+    columns = list(model.__table__.c)
+    if _supports_returning(db, "delete"):
+        return db.execute(
+            delete(model).where(*criteria).returning(*columns),
+            execution_options={"synchronize_session": False},
+        ).first()
+    row = db.execute(select(*columns).where(*criteria)).first()
+    if row is not None:
+        db.execute(
+            delete(model).where(model.id == row.id),
+            execution_options={"synchronize_session": False},
+        )
+    return row
@@ -0,0 +1,404 @@
+# catalog version stamp, the per-process plan registry and a per-process cache of the
+# serialised catalog, compressed once per catalog version instead of on every request
+import hashlib
+import json
+import threading
+import time
+from dataclasses import dataclass
+
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import Numeric, case, cast, delete, exists, func, insert, literal, select, true, update
+from sqlalchemy.orm import Session
+
+from models import CatalogVersion, Magazine, MagazinePlan, Plan
+from compression import compress, choose_encoding, COMPRESSION_MINIMUM_SIZE
+from fieldsets import columns, pick, PLAN_FIELDS
+
+CATALOG_VERSION_ID = 1
+# how often (in seconds) a worker checks for plan changes made by other workers
+PLAN_REGISTRY_CHECK_SECONDS = 1.0
+
+
+# bump the catalog version inside the caller's transaction (the caller commits)
+def bump_catalog_version(db: Session):
+    result = db.execute(
+        update(CatalogVersion)
+        .where(CatalogVersion.id == CATALOG_VERSION_ID)
+        .values(version=CatalogVersion.version + 1)
+    )
+    if result.rowcount == 0:
+        db.add(CatalogVersion(id=CATALOG_VERSION_ID, version=1))
+
+
+def current_catalog_version(db: Session):
+    version = (
+        db.query(CatalogVersion.version)
+        .filter(CatalogVersion.id == CATALOG_VERSION_ID)
+        .scalar()
+    )
+    return version or 0
+
+
+# plans are a handful of nearly static rows: every worker keeps them in immutable records,
+# indexed by id and by renewal period, and replaces the whole set at once when the catalog
+# version moves (readers never see a partly rebuilt registry)
+@dataclass(frozen=True, slots=True)
+class PlanRecord:
+    id: int
+    title: str
+    description: str
+    renewal_period: int
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in PLAN_FIELDS}
+
+
+@dataclass(frozen=True, slots=True)
+class PlanSet:
+    version: int
+    by_id: dict
+    # renewal period -> plans with that period, by id
+    by_renewal_period: dict
+
+
+class PlanRegistry:
+    def __init__(self, check_seconds: float = PLAN_REGISTRY_CHECK_SECONDS):
+        self.check_seconds = check_seconds
+        self._plans = None
+        self._checked_at = 0.0
+
+    # load every plan and swap the new set in
+    def reload(self, db: Session, version: int = None):
+        if version is None:
+            version = current_catalog_version(db)
+        records = [
+            PlanRecord(*row)
+            for row in db.execute(select(*columns(Plan, PLAN_FIELDS)).order_by(Plan.id))
+        ]
+        by_renewal_period = {}
+        for record in records:
+            by_renewal_period.setdefault(record.renewal_period, []).append(record)
+        self._plans = PlanSet(
+            version,
+            {record.id: record for record in records},
+            {period: tuple(plans) for period, plans in by_renewal_period.items()},
+        )
+        self._checked_at = time.monotonic()
+        return self._plans
+
+    # the current plan set, reloaded when the catalog version moved (checked at most every
+    # check_seconds, or right away with force); with version, the set at that catalog version,
+    # for results stored under it (a set up to check_seconds old may predate it)
+    def plans(self, db: Session, force: bool = False, version: int = None):
+        plans = self._plans
+        if version is None:
+            if plans is not None and not force and (
+                time.monotonic() - self._checked_at < self.check_seconds
+            ):
+                return plans
+            version = current_catalog_version(db)
+        if plans is not None and version == plans.version:
+            self._checked_at = time.monotonic()
+            return plans
+        return self.reload(db, version)
+
+    # a plan by id, None when there is no such plan; an unknown id forces a version check
+    # first, the plan may have been created by another worker since the last one. Writes
+    # pass force: a plan deleted by another worker must not be accepted
+    def get(self, db: Session, plan_id: int, force: bool = False, version: int = None):
+        record = self.plans(db, force, version).by_id.get(plan_id)
+        if record is None and not force and version is None:
+            record = self.plans(db, force=True).by_id.get(plan_id)
+        return record
+
+    def get_many(self, db: Session, plan_ids, force: bool = False, version: int = None):
+        plans = self.plans(db, force, version)
+        if not force and version is None and any(plan_id not in plans.by_id for plan_id in plan_ids):
+            plans = self.plans(db, force=True)
+        return {plan_id: plans.by_id[plan_id] for plan_id in plan_ids if plan_id in plans.by_id}
+
+    def by_renewal_period(self, db: Session, renewal_period: int):
+        return self.plans(db).by_renewal_period.get(renewal_period, ())
+
+    def all(self, db: Session, version: int = None):
+        return list(self.plans(db, version=version).by_id.values())
+
+    # drop the loaded plans (tests, or to force a reload on the next lookup)
+    def clear(self):
+        self._plans = None
+
+
+plan_registry = PlanRegistry()
+
+
+# discount of a plan derived from the magazine's discount columns: monthly plans are always
+# offered without a discount, the other periods only when the magazine has a discount for them
+def derived_discount():
+    return case(
+        {
+            1: literal(0.0),
+            3: Magazine.discount_quarterly,
+            6: Magazine.discount_half_yearly,
+            12: Magazine.discount_annual,
+        },
+        value=Plan.renewal_period,
+    )
+
+
+def effective_price(base_price, renewal_period, discount):
+    return round(base_price * renewal_period * (1 - discount), 2)
+
+
+def effective_price_expression(discount):
+    return func.round(
+        cast(Magazine.base_price * Plan.renewal_period * (1 - discount), Numeric), 2
+    )
+
+
+# add the offerings implied by the discount columns for the magazine/plan pairs matching
+# criteria and not offered yet, with one INSERT ... SELECT (the caller commits)
+def derive_offerings(db: Session, *criteria):
+    discount = derived_discount()
+    offered = exists().where(
+        MagazinePlan.magazine_id == Magazine.id, MagazinePlan.plan_id == Plan.id
+    )
+    db.execute(
+        insert(MagazinePlan).from_select(
+            ["magazine_id", "plan_id", "discount", "price"],
+            # every magazine with every plan, narrowed down by criteria
+            select(Magazine.id, Plan.id, discount, effective_price_expression(discount))
+            .join_from(Magazine, Plan, true())
+            .where(discount.is_not(None), ~offered, *criteria),
+        )
+    )
+
+
+# delete the offerings matching criteria whose discount is the derived one for the plan's
+# current renewal period (explicit offerings with another discount are kept), before the
+# period changes (the caller commits)
+def delete_derived_offerings(db: Session, *criteria):
+    discount = (
+        select(derived_discount())
+        .where(Magazine.id == MagazinePlan.magazine_id, Plan.id == MagazinePlan.plan_id)
+        .scalar_subquery()
+    )
+    delete_offerings(db, MagazinePlan.discount == discount, *criteria)
+
+
+# replace the offerings of a magazine with the given ones (plan id -> discount), or with
+# the derived ones when offers is None; returns the ids of unknown plans (the caller commits)
+def replace_offerings(db: Session, magazine: Magazine, offers: dict = None):
+    db.execute(delete(MagazinePlan).where(MagazinePlan.magazine_id == magazine.id))
+    if offers is None:
+        derive_offerings(db, Magazine.id == magazine.id)
+        return []
+    plans = plan_registry.get_many(db, list(offers))
+    db.add_all(
+        MagazinePlan(
+            magazine_id=magazine.id,
+            plan_id=plan_id,
+            discount=discount,
+            price=effective_price(
+                magazine.base_price, plans[plan_id].renewal_period, discount
+            ),
+        )
+        for plan_id, discount in offers.items()
+        if plan_id in plans
+    )
+    return [plan_id for plan_id in offers if plan_id not in plans]
+
+
+# recompute the effective price of the offerings matching criteria (the caller commits)
+def reprice_offerings(db: Session, *criteria):
+    db.execute(
+        update(MagazinePlan)
+        .where(*criteria)
+        .values(
+            price=select(effective_price_expression(MagazinePlan.discount))
+            .where(
+                Magazine.id == MagazinePlan.magazine_id,
+                Plan.id == MagazinePlan.plan_id,
+            )
+            .scalar_subquery()
+        ),
+        execution_options={"synchronize_session": False},
+    )
+
+
+# the effective prices a magazine offers, plan id -> price
+def offering_prices(db: Session, magazine_id: int):
+    return dict(
+        db.execute(
+            select(MagazinePlan.plan_id, MagazinePlan.price).where(
+                MagazinePlan.magazine_id == magazine_id
+            )
+        ).all()
+    )
+
+
+def delete_offerings(db: Session, *criteria):
+    db.execute(
+        delete(MagazinePlan).where(*criteria),
+        execution_options={"synchronize_session": False},
+    )
+
+
+# magazines matching criteria with the plans they offer, from a single join with the
+# offerings (plain column rows, no ORM entities to build per magazine); the plans themselves
+# come from the plan registry (at `version` when given, see catalog_entry). fields limits the
+# magazine columns and whether plans are joined at all
+def magazines_with_offerings(db: Session, *criteria, fields: tuple = None, version: int = None):
+    if fields is None:
+        magazine_keys = [column.key for column in Magazine.__table__.c]
+        with_plans = True
+    else:
+        magazine_keys = [field for field in fields if field != "plans"]
+        with_plans = "plans" in fields
+    # the id comes first for grouping, requested or not
+    statement = select(Magazine.id, *(Magazine.__table__.c[key] for key in magazine_keys))
+    if not with_plans:
+        rows = db.execute(statement.where(*criteria).order_by(Magazine.id)).all()
+        return [dict(zip(magazine_keys, row[1:])) for row in rows]
+    rows = db.execute(
+        statement.add_columns(
+            MagazinePlan.plan_id, MagazinePlan.discount, MagazinePlan.price
+        )
+        .outerjoin(MagazinePlan, MagazinePlan.magazine_id == Magazine.id)
+        .where(*criteria)
+        .order_by(Magazine.id)
+    ).all()
+    plans = plan_registry.get_many(db, {row.plan_id for row in rows} - {None}, version=version)
+    magazines = {}
+    for row in rows:
+        magazine = magazines.get(row[0])
+        if magazine is None:
+            magazine = magazines[row[0]] = {
+                **dict(zip(magazine_keys, row[1 : len(magazine_keys) + 1])),
+                "plans": [],
+            }
+        record = plans.get(row.plan_id)
+        if record is not None:
+            plan = record.as_dict()
+            plan["discount"] = row.discount
+            plan["price"] = row.price
+            magazine["plans"].append(plan)
+    for magazine in magazines.values():
+        magazine["plans"].sort(key=lambda plan: (plan["renewal_period"], plan["id"]))
+    return list(magazines.values())
+
+
+# with each magazine, the plans offered by that magazine with their discount and effective
+# price (magazine_plans)
+def build_magazines(db: Session, fields: tuple = None, version: int = None):
+    return magazines_with_offerings(db, fields=fields, version=version)
+
+
+def build_plans(db: Session, fields: tuple = None, version: int = None):
+    return [pick(plan.as_dict(), fields) for plan in plan_registry.all(db, version)]
+
+
+# the catalog resources served from the cache, resource -> build(db, fields, version)
+CATALOG_BUILDERS = {"magazines": build_magazines, "plans": build_plans}
+
+
+def to_dict(row):
+    return {column.key: getattr(row, column.key) for column in row.__table__.columns}
+
+
+def serialise(content):
+    return json.dumps(
+        jsonable_encoder(content), separators=(",", ":"), ensure_ascii=False
+    ).encode()
+
+
+class CachedBody:
+    # encoded: variants compressed beforehand (e.g. loaded from a snapshot), encoding -> bytes
+    def __init__(self, version: int, body: bytes, encoded: dict = None):
+        self.version = version
+        self.body = body
+        # distinct per body: fieldsets of one catalog version can serialise to the same length
+        self.etag = f'"{version}-{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+        self._encoded = dict(encoded or {})
+        self._lock = threading.Lock()
+
+    # compressed at the highest level, once per version and encoding
+    def encoded(self, encoding: str):
+        if encoding not in self._encoded:
+            with self._lock:
+                if encoding not in self._encoded:
+                    self._encoded[encoding] = compress(self.body, encoding, best=True)
+        return self._encoded[encoding]
+
+
+class CatalogCache:
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    # cached body for `name` at `version`, built with build() on a miss
+    def get(self, name: str, version: int, build):
+        entry = self._entries.get(name)
+        if entry is not None and entry.version == version:
+            return entry
+        entry = CachedBody(version, serialise(build()))
+        with self._lock:
+            current = self._entries.get(name)
+            if current is None or current.version <= version:
+                self._entries[name] = entry
+        return entry
+
+    # add an entry built elsewhere, unless a newer one is cached already
+    def prime(self, name: str, entry: CachedBody):
+        with self._lock:
+            current = self._entries.get(name)
+            if current is None or current.version <= entry.version:
+                self._entries[name] = entry
+
+    # the cached entries at `version`, name -> entry
+    def entries(self, version: int):
+        with self._lock:
+            return {
+                name: entry
+                for name, entry in self._entries.items()
+                if entry.version == version
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+catalog_cache = CatalogCache()
+
+
+# cache name of a catalog resource with a fieldset
+def cache_name(resource: str, fields: tuple = None):
+    return resource if fields is None else f"{resource}:{','.join(fields)}"
+
+
+# the cached body of a catalog resource at the current catalog version, built on a miss from
+# the plans at that same version (the body is stored under it until the next bump)
+def catalog_entry(db: Session, resource: str, fields: tuple = None, version: int = None):
+    if version is None:
+        version = current_catalog_version(db)
+    return catalog_cache.get(
+        cache_name(resource, fields),
+        version,
+        lambda: CATALOG_BUILDERS[resource](db, fields, version),
+    )
+
+
+# response for a cached body: 304 on a matching If-None-Match, otherwise the precompressed
+# variant the client accepts (the compression middleware leaves encoded responses alone)
+def cached_response(entry: CachedBody, accept_encoding: str, if_none_match: str):
+    headers = {"ETag": entry.etag, "Vary": "Accept-Encoding"}
+    if if_none_match == entry.etag:
+        return Response(status_code=304, headers=headers)
+    encoding = choose_encoding(accept_encoding)
+    if encoding is None or len(entry.body) < COMPRESSION_MINIMUM_SIZE:
+        return Response(entry.body, media_type="application/json", headers=headers)
+    headers["Content-Encoding"] = encoding
+    return Response(
+        entry.encoded(encoding), media_type="application/json", headers=headers
+    )
@@ -0,0 +1,157 @@
+# change feed for downstream sync (CRM, billing): triggers on users, magazines and
+# subscriptions record every inserted, updated and deleted row in the changes table, in the
+# writing transaction (see models.py). Change ids follow insert order, which is not commit
+# order when transactions overlap: a reader that already read past an id would miss a change
+# committed after it. sequence_changes() therefore numbers the committed changes (seq) in the
+# order it sees them, one sequencer at a time, and readers page through seq with a cursor.
+# Sequencing runs in the background (ChangeSequencer), so a poll is a read-only query that
+# costs the number of changes since the previous one, not the size of the tables.
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+from sqlalchemy import func, select, text, update
+from sqlalchemy.orm import Session, aliased
+
+from bulk import bulk_delete
+from models import Change, Magazine, Subscription, User
+
+logger = logging.getLogger(__name__)
+
+# changes numbered per call to sequence_changes
+CHANGE_SEQUENCE_BATCH = 5000
+# sequenced changes older than this are purged, a cursor before them gets 410
+CHANGE_RETENTION_DAYS = int(os.getenv("CHANGE_RETENTION_DAYS", "7"))
+# advisory lock key of the sequencer on PostgreSQL
+CHANGE_SEQUENCER_LOCK = 4_802_001
+# run the sequencer in this process (one process is enough, several take turns) and how often
+# (in seconds) it looks for new changes: the delay before a change can be read
+CHANGE_SEQUENCER_ENABLED = os.getenv("CHANGE_SEQUENCER_ENABLED", "1") == "1"
+CHANGE_SEQUENCE_SECONDS = float(os.getenv("CHANGE_SEQUENCE_SECONDS", "0.5"))
+
+# entity -> model and the columns returned as its current state (never the password)
+CHANGE_ENTITIES = {
+    "user": (User, [column for column in User.__table__.c if column.key != "password"]),
+    "magazine": (Magazine, list(Magazine.__table__.c)),
+    "subscription": (Subscription, list(Subscription.__table__.c)),
+}
+
+
+# number the committed, unsequenced changes after the highest seq, returns how many
+def sequence_changes(db: Session, batch_size: int = CHANGE_SEQUENCE_BATCH):
+    # nothing new: no lock and no write (an index-only probe of ix_changes_unsequenced_id)
+    pending = db.execute(select(Change.id).where(Change.seq.is_(None)).limit(1)).first()
+    if pending is None:
+        db.commit()
+        return 0
+    # concurrent sequencers would hand out seqs that commit out of order
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": CHANGE_SEQUENCER_LOCK})
+    sequenced = aliased(Change)
+    highest = select(func.coalesce(func.max(sequenced.seq), 0)).scalar_subquery()
+    numbered = (
+        select(Change.id, (highest + func.row_number().over(order_by=Change.id)).label("seq"))
+        .where(Change.seq.is_(None))
+        .order_by(Change.id)
+        .limit(batch_size)
+        .subquery()
+    )
+    result = db.execute(
+        update(Change).where(Change.id == numbered.c.id).values(seq=numbered.c.seq),
+        execution_options={"synchronize_session": False},
+    )
+    db.commit()
+    return result.rowcount
+
+
+# current state of the changed rows, one IN query per entity (deleted rows are None)
+def _current_rows(db: Session, changes: list):
+    ids = {}
+    for change in changes:
+        ids.setdefault(change.entity, set()).add(change.entity_id)
+    rows = {}
+    for entity, entity_ids in ids.items():
+        model, columns = CHANGE_ENTITIES[entity]
+        for row in db.execute(select(*columns).where(model.id.in_(entity_ids))):
+            rows[entity, row.id] = row._asdict()
+    return rows
+
+
+# the changes after cursor `since`, oldest first, with the current state of their rows
+def read_changes(db: Session, since: int, limit: int):
+    oldest = db.execute(select(func.min(Change.seq))).scalar()
+    # the changes after the cursor were purged: the consumer has to resync from the tables
+    # (0 starts at the oldest change kept)
+    if oldest is not None and 0 < since < oldest - 1:
+        raise HTTPException(
+            status_code=410, detail=f"Changes before {oldest} are no longer available"
+        )
+    changes = db.execute(
+        select(Change).where(Change.seq > since).order_by(Change.seq).limit(limit + 1)
+    ).scalars().all()
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    rows = _current_rows(db, changes)
+    return {
+        "changes": [
+            {
+                "seq": change.seq,
+                "entity": change.entity,
+                "entity_id": change.entity_id,
+                "operation": change.operation,
+                "changed_at": change.changed_at,
+                "data": rows.get((change.entity, change.entity_id)),
+            }
+            for change in changes
+        ],
+        "next": changes[-1].seq if changes else since,
+        "has_more": has_more,
+    }
+
+
+# delete the changes up to the last one older than the retention window (so the retained
+# seqs stay contiguous), returns the number deleted
+def purge_changes(db: Session, retention_days: int = CHANGE_RETENTION_DAYS):
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    last = db.execute(select(func.max(Change.seq)).where(Change.changed_at < cutoff)).scalar()
+    if last is None:
+        return 0
+    return len(bulk_delete(db, Change, Change.seq <= last))
+
+
+class ChangeSequencer:
+    def __init__(self, session_factory, poll_seconds: float = CHANGE_SEQUENCE_SECONDS):
+        self.session_factory = session_factory
+        self.poll_seconds = poll_seconds
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="change-sequencer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.session_factory() as db:
+                    sequenced = sequence_changes(db)
+            except Exception:
+                logger.exception("change sequencer failed, retrying")
+                sequenced = 0
+            # keep going while batches are full, otherwise wait for new changes
+            if sequenced < CHANGE_SEQUENCE_BATCH:
+                self._stop.wait(self.poll_seconds)
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    with SessionLocal() as db:
+        print(f"purged {purge_changes(db)} changes")
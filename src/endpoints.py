@@ -1,16 +1,84 @@
 from fastapi import FastAPI
 
 # create router
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Header, Response
+from fastapi.concurrency import run_in_threadpool
 from utils import (
     hash_password,
     create_access_token,
     create_refresh_token,
     get_current_user,
+    get_refresh_token_user,
+    new_token_family,
+    revoke_token,
+    SECRET_KEY,
+    ALGORITHM,
+    REFRESH_TOKEN_EXPIRE_DAYS,
+    require_admin,
+)
+from bulk import bulk_delete, bulk_update, delete_one, dialect_insert, supports_on_conflict
+from revocation import revocation_store, family_key, subject_key
+from catalog import (
+    bump_catalog_version,
+    catalog_entry,
+    cached_response,
+    derive_offerings,
+    delete_derived_offerings,
+    replace_offerings,
+    reprice_offerings,
+    offering_prices,
+    delete_offerings,
+    magazines_with_offerings,
+    plan_registry,
+)
+from history import current_subscription, subscription_history
+from archive import archive_inactive_subscriptions, get_archived_subscription
+from forecast import forecast_cache
+from mailer import (
+    enqueue_mail,
+    enqueue_mail_to_user,
+    registration_mail,
+    password_reset_mail,
+    subscription_mail,
+)
+from profiling import ProfiledRoute, profiled_endpoint
+from slowlog import slow_query_log
+from search import search_magazines, autocomplete_index
+from groupcommit import group_committer
+from versioning import if_match, conflict, set_etag
+from repricing import enqueue_reprice, job_progress
+from eventlog import subscription_written, subscription_cancelled
+from changefeed import read_changes
+from summaries import refresh_summaries, rebuild_summaries, summary_response
+from loaders import (
+    get_loaders,
+    id_list,
+    expansions,
+    expand_references,
+    Loaders,
+    SUBSCRIPTION_EXPANSIONS,
+)
+from fieldsets import (
+    fieldset,
+    columns,
+    pick,
+    MAGAZINE_FIELDS,
+    PLAN_FIELDS,
+    SUBSCRIPTION_FIELDS,
+    USER_FIELDS,
+)
+from models import (
+    User,
+    Magazine,
+    Plan,
+    Subscription,
+    MagazinePlan,
+    RepriceJob,
+    SubscriptionSummary,
 )
-from models import User, Magazine, Plan, Subscription
 from schemas import (
     UserCreate,
+    UserBatchCreate,
     UserLogin,
     UserResetPassword,
     MagazineBase,
@@ -19,17 +87,26 @@ from schemas import (
     SubscriptionCreate,
     NewPassword,
     SubscriptionResponse,
+    TokenRevoke,
+    PlanFilter,
+    MagazineFilter,
+    UserDeactivateMany,
+    SubscriptionFilter,
 )
 from database import get_db
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from datetime import datetime
+from sqlalchemy.orm.exc import StaleDataError
+from jose import JWTError, jwt
+from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta
 
 # Add an empty line here
 
 
-# create a router object
-router = APIRouter()
+# create a router object, endpoints can be profiled on demand (see profiling.py)
+router = APIRouter(route_class=ProfiledRoute)
 
 
 # create an endpoint to say hello world
@@ -38,27 +115,82 @@ def read_root():
     return {"message": "Hello World"}
 
 
+# user columns returned by the registration endpoints
+USER_COLUMNS = (User.id, User.username, User.email, User.created_at, User.updated_at)
+
+
 # api to register a user using username, email and password
 @router.post("/users/register")
 def register_user(user: UserCreate, db: Session = Depends(get_db)):
-    # create a user in the database
-    # if user already exists with same email or username, return an error with 400 status code
-    if (
-        db.query(User)
-        .filter(User.email == user.email or User.username == user.username)
-        .first()
-    ):
+    # create the user with a single INSERT ... RETURNING
+    # if user already exists with same email or username, the unique indexes reject the insert
+    # and we return an error with 400 status code
+    try:
+        new_user = db.execute(
+            insert(User)
+            .values(
+                username=user.username,
+                email=user.email,
+                password=hash_password(user.password),
+            )
+            .returning(*USER_COLUMNS)
+        ).first()
+        # the confirmation mail is queued in the same transaction
+        enqueue_mail(db, "registration", user.email, *registration_mail(user.username))
+        db.commit()
+    except IntegrityError:
+        db.rollback()
         raise HTTPException(status_code=400, detail="User already exists")
-    # create a new user
-    new_user = User(
-        username=user.username, email=user.email, password=hash_password(user.password)
-    )
-    # add the user to the database
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
     # return the user details with 201 status code
-    return (new_user, 201)
+    return (new_user._asdict(), 201)
+
+
+# api to register many users at once (partner migrations, admin only), users whose username
+# or email already exists are skipped
+@router.post("/users/register/batch", dependencies=[Depends(require_admin)])
+def register_users_batch(batch: UserBatchCreate, db: Session = Depends(get_db)):
+    now = datetime.utcnow()
+    rows = [
+        {
+            "username": user.username,
+            "email": user.email,
+            "password": hash_password(user.password),
+            "created_at": now,
+            "updated_at": now,
+        }
+        for user in batch.users
+    ]
+    if supports_on_conflict(db):
+        # one multi-row INSERT ... ON CONFLICT DO NOTHING RETURNING for the whole batch
+        created = db.execute(
+            dialect_insert(db, User)
+            .values(rows)
+            .on_conflict_do_nothing()
+            .returning(*USER_COLUMNS)
+        ).all()
+    else:
+        # no ON CONFLICT on this database: one INSERT per user, each in a savepoint
+        created = []
+        for row in rows:
+            try:
+                with db.begin_nested():
+                    created.append(
+                        db.execute(insert(User).values(row).returning(*USER_COLUMNS)).first()
+                    )
+            except IntegrityError:
+                pass
+    for row in created:
+        enqueue_mail(db, "registration", row.email, *registration_mail(row.username))
+    db.commit()
+    created_usernames = {row.username for row in created}
+    return {
+        "created": [row._asdict() for row in created],
+        "skipped": [
+            user.username
+            for user in batch.users
+            if user.username not in created_usernames
+        ],
+    }
 
 
 # api to login a user using username and password
@@ -77,8 +209,10 @@ def login_user(user: UserLogin, db: Session = Depends(get_db)):
     if not user_db:
         raise HTTPException(status_code=400, detail="Invalid credentials")
     # return the user details with 200 status code along with access token and refresh token
-    access_token = create_access_token(data={"sub": user_db.username})
-    refresh_token = create_refresh_token(data={"sub": user_db.username})
+    # every login starts a new token family, shared by the tokens issued on refresh
+    family = new_token_family()
+    access_token = create_access_token(data={"sub": user_db.username, "fam": family})
+    refresh_token = create_refresh_token(data={"sub": user_db.username, "fam": family})
 
     # return the user details with 200 status code along with access token and refresh token
     return {
@@ -90,12 +224,15 @@ def login_user(user: UserLogin, db: Session = Depends(get_db)):
     # return user_db
 
 
+# api to exchange a refresh token for a new access token and refresh token
+# the presented refresh token is revoked (rotation), replaying it revokes the whole family
 @router.post("/users/token/refresh")
-def refresh_token(current_user: User = Depends(get_current_user)):
+def refresh_token(refresh=Depends(get_refresh_token_user)):
+    current_user, family = refresh
     # generate a new access token
-    access_token = create_access_token(data={"sub": current_user.username})
+    access_token = create_access_token(data={"sub": current_user.username, "fam": family})
     # generate a new refresh token
-    refresh_token = create_refresh_token(data={"sub": current_user.username})
+    refresh_token = create_refresh_token(data={"sub": current_user.username, "fam": family})
     # return the new access token and refresh token
     return {
         "access_token": access_token,
@@ -103,6 +240,31 @@ def refresh_token(current_user: User = Depends(get_current_user)):
     }
 
 
+# api to revoke an access or refresh token of the current user
+# revoking a refresh token also revokes every token of its family (logout)
+@router.post("/users/token/revoke")
+def revoke_user_token(
+    body: TokenRevoke,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    try:
+        payload = jwt.decode(body.token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise HTTPException(status_code=400, detail="Invalid token")
+    if payload.get("sub") != current_user.username:
+        raise HTTPException(status_code=403, detail="Token belongs to another user")
+    revoke_token(db, payload)
+    if payload.get("type") == "refresh" and payload.get("fam"):
+        revocation_store.revoke(
+            db,
+            family_key(payload["fam"]),
+            datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+        )
+    db.commit()
+    return {"msg": "Token revoked"}
+
+
 # api to reset password by taking email in params
 @router.post("/users/reset-password")
 def reset_password(email: str = Query(...), db: Session = Depends(get_db)):
@@ -111,11 +273,24 @@ def reset_password(email: str = Query(...), db: Session = Depends(get_db)):
     # if user not found, return an error with 400 status code
     if not user_db:
         raise HTTPException(status_code=400, detail="User not found")
-    # set mail to user email
+    # queue the reset mail to the user email, delivered by the outbox worker
+    enqueue_mail(db, "password_reset", user_db.email, *password_reset_mail(user_db.username))
+    db.commit()
     # return a success message with 200 status code
     return {"msg": "Password reset successful"}
 
 
+# offerings of a magazine from the request: the given plans, or the ones derived from the
+# discount columns
+def set_offerings(db: Session, magazine_db: Magazine, magazine: MagazineBase):
+    offers = None
+    if magazine.plans is not None:
+        offers = {offer.plan_id: offer.discount for offer in magazine.plans}
+    unknown = replace_offerings(db, magazine_db, offers)
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Plan not found: {unknown}")
+
+
 # api to create magazine
 @router.post("/magazines/")
 def create_magazine(magazine: MagazineBase, db: Session = Depends(get_db)):
@@ -130,76 +305,122 @@ def create_magazine(magazine: MagazineBase, db: Session = Depends(get_db)):
     )
     # add the magazine to the database
     db.add(new_magazine)
+    db.flush()
+    set_offerings(db, new_magazine, magazine)
+    bump_catalog_version(db)
     db.commit()
+    autocomplete_index.invalidate()
     db.refresh(new_magazine)
     # return the magazine details with 201 status code
     return new_magazine
 
 
 @router.get("/users/me")
-def read_users_me(current_user: User = Depends(get_current_user)):
-    return current_user
+def read_users_me(
+    current_user: User = Depends(get_current_user),
+    fields: tuple = Depends(fieldset(USER_FIELDS)),
+):
+    if fields is None:
+        return current_user
+    return {field: getattr(current_user, field) for field in fields}
+
+
+# api for the account page: active subscriptions, next renewal date and monthly spend of the
+# current user (one primary key read of the precomputed summary)
+@router.get("/users/me/summary")
+def read_users_me_summary(
+    current_user: User = Depends(get_current_user), db: Session = Depends(get_db)
+):
+    return summary_response(db.get(SubscriptionSummary, current_user.id))
 
 
 # api "/users/deactivate/{username}" to deactivate a user
 @router.delete("/users/deactivate/{username}")
 def deactivate_user(username: str, db: Session = Depends(get_db)):
-    # get the user from the database
-    user_db = db.query(User).filter(User.username == username).first()
+    # delete the user from the database in one statement
+    user_db = delete_one(db, User, User.username == username)
     # if user not found, return an error with 400 status code
     if not user_db:
         raise HTTPException(status_code=400, detail="User not found")
-    # delete the user from the database
-    db.delete(user_db)
+    # revoke every token issued to this username so far
+    revocation_store.revoke(
+        db,
+        subject_key(username),
+        datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+    )
     db.commit()
     # return the user details with 200 status code
-    return user_db
+    return user_db._asdict()
 
 
 # api to get a plan by id
 @router.get("/plans/{plan_id}")
-def get_plan(plan_id: int, db: Session = Depends(get_db)):
-    # get the plan from the database
-    plan = db.query(Plan).filter(Plan.id == plan_id).first()
+def get_plan(
+    plan_id: int,
+    fields: tuple = Depends(fieldset(PLAN_FIELDS)),
+    db: Session = Depends(get_db),
+):
+    # get the plan from the plan registry (see catalog.py)
+    plan = plan_registry.get(db, plan_id)
     # if plan not found, return an error with 404 status code
     if not plan:
         raise HTTPException(status_code=404, detail="Plan not found")
-    return plan
+    return pick(plan.as_dict(), fields)
 
 
 # api to get all plans if user is logged in
 @router.get("/plans/")
-def get_plans(db: Session = Depends(get_db)):
-    plans = db.query(Plan).all()
-    return plans
+# ?ids=1,2,3 returns just those plans (in that order) with one IN query
+def get_plans(
+    fields: tuple = Depends(fieldset(PLAN_FIELDS)),
+    ids: tuple = Depends(id_list),
+    db: Session = Depends(get_db),
+    loaders: Loaders = Depends(get_loaders),
+    accept_encoding: str = Header(None),
+    if_none_match: str = Header(None),
+):
+    if ids is not None:
+        return [pick(plan, fields) for plan in loaders.plans.get_many(ids)]
+    # part of the catalog: cached per catalog version like the magazines
+    entry = catalog_entry(db, "plans", fields)
+    return cached_response(entry, accept_encoding, if_none_match)
 
 
 # api to delete a plan
 @router.delete("/plans/{plan_id}")
 def delete_plan(plan_id: int, db: Session = Depends(get_db)):
-    # get the plan from the database
-    plan_db = db.query(Plan).filter(Plan.id == plan_id).first()
+    # delete the plan from the database in one statement
+    plan_db = delete_one(db, Plan, Plan.id == plan_id)
     # if plan not found, return an error with 400 status code
     if not plan_db:
         raise HTTPException(status_code=400, detail="Plan not found")
-    # delete the plan from the database
-    db.delete(plan_db)
+    delete_offerings(db, MagazinePlan.plan_id == plan_id)
+    bump_catalog_version(db)
     db.commit()
+    plan_registry.reload(db)
     # return the plan details with 200 status code
-    return plan_db
+    return plan_db._asdict()
+
+
+# per deleted chunk of plans, in the chunk's transaction
+def plans_deleted(db: Session, rows):
+    delete_offerings(db, MagazinePlan.plan_id.in_([row[0] for row in rows]))
+    bump_catalog_version(db)
 
 
 # api to delete all plans
 @router.delete("/plans/")
 def delete_all_plans(db: Session = Depends(get_db)):
-    # get all plans from the database
-    plans = db.query(Plan).all()
-    # delete all plans from the database
-    for plan in plans:
-        db.delete(plan)
-    db.commit()
-    # return the plan details with 200 status code
-    return plans
+    # delete all plans with chunked set-based DELETE statements
+    deleted = bulk_delete(
+        db,
+        Plan,
+        returning=[column for column in Plan.__table__.c if column.key != "id"],
+        on_chunk=lambda rows: plans_deleted(db, rows),
+    )
+    plan_registry.reload(db)
+    # return the deleted plans with 200 status code
+    return [row._asdict() for row in deleted]
 
 
 # api to create plan
@@ -213,7 +434,12 @@ def create_plan(plan: PlanBase, db: Session = Depends(get_db)):
     )
     # add the plan to the database
     db.add(new_plan)
+    db.flush()
+    # magazines offer it according to their discount columns
+    derive_offerings(db, Plan.id == new_plan.id)
+    bump_catalog_version(db)
     db.commit()
+    plan_registry.reload(db)
     db.refresh(new_plan)
     # if renewal period is 0 return an error with 422 status code
     if new_plan.renewal_period == 0:
@@ -230,11 +456,23 @@ def update_plan(plan_id: int, plan: PlanBase, db: Session = Depends(get_db)):
     # if plan not found, return an error with 400 status code
     if not plan_db:
         raise HTTPException(status_code=400, detail="Plan not found")
+    # derived offerings depend on the renewal period: drop the ones of the old period here
+    # and derive them for the new one below (a plan can move into or out of 1, 3, 6 and 12)
+    rederive = plan.renewal_period != plan_db.renewal_period
+    if rederive:
+        delete_derived_offerings(db, MagazinePlan.plan_id == plan_id)
     # update the plan details
     plan_db.title = plan.title
     plan_db.description = plan.description
     plan_db.renewal_period = plan.renewal_period
+    db.flush()
+    if rederive:
+        derive_offerings(db, Plan.id == plan_id)
+    # offering prices depend on the renewal period
+    reprice_offerings(db, MagazinePlan.plan_id == plan_id)
+    bump_catalog_version(db)
     db.commit()
+    plan_registry.reload(db)
     db.refresh(plan_db)
     # if renewal period is 0 return an error with 422 status code
     if plan_db.renewal_period == 0:
@@ -244,63 +482,74 @@ def update_plan(plan_id: int, plan: PlanBase, db: Session = Depends(get_db)):
 
 
 # api to Retrieve a list of magazines available for subscription. This list should include the plans available for that magazine and the discount offered for each plan.
+# the serialised catalog and its gzip/brotli variants are cached per catalog version
+# ?ids=1,2,3 returns just those magazines (in that order) with one IN query
 @router.get("/magazines/")
-def get_magazines(db: Session = Depends(get_db)):
-    magazines = db.query(Magazine).all()
-    # with each magazine, get the plans available for that magazine using Plan table
-    # and the discount offered for each plan using the discount columns in the Magazine table    , for monthly it is 0.0
-    for magazine in magazines:
-        magazine.plans = db.query(Plan).all()
-        # calculate the discount for each plan
-        for plan in magazine.plans:
-            if plan.renewal_period == 1:
-                plan.discount = 0.0
-            if plan.renewal_period == 3:
-                plan.discount = magazine.discount_quarterly or 0.0
-            elif plan.renewal_period == 6:
-                plan.discount = magazine.discount_half_yearly or 0.0
-            elif plan.renewal_period == 12:
-                plan.discount = magazine.discount_annual or 0.0
-
-    return magazines
+def get_magazines(
+    db: Session = Depends(get_db),
+    fields: tuple = Depends(fieldset(MAGAZINE_FIELDS)),
+    ids: tuple = Depends(id_list),
+    loaders: Loaders = Depends(get_loaders),
+    accept_encoding: str = Header(None),
+    if_none_match: str = Header(None),
+):
+    if ids is not None:
+        return [pick(magazine, fields) for magazine in loaders.magazines.get_many(ids)]
+    # one cached body per fieldset, with each magazine the plans it offers (see catalog.py)
+    entry = catalog_entry(db, "magazines", fields)
+    return cached_response(entry, accept_encoding, if_none_match)
+
+
+# api to search magazines by name and description, best matches first
+# declared before /magazines/{magazine_id} so "search" is not taken for an id
+@router.get("/magazines/search")
+def search_magazine(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(get_db),
+):
+    return search_magazines(db, q, limit, offset)
+
+
+# api to suggest magazine names for a prefix, served from memory
+@router.get("/magazines/autocomplete")
+def autocomplete_magazines(
+    prefix: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(10, ge=1, le=50),
+    db: Session = Depends(get_db),
+):
+    return autocomplete_index.complete(db, prefix, limit)
 
 
 # api to get a magazine by id
 @router.get("/magazines/{magazine_id}")
-def get_magazine(magazine_id: int, db: Session = Depends(get_db)):
-    # get the magazine from the database
-    magazine = db.query(Magazine).filter(Magazine.id == magazine_id).first()
+def get_magazine(
+    magazine_id: int,
+    response: Response,
+    fields: tuple = Depends(fieldset(MAGAZINE_FIELDS)),
+    db: Session = Depends(get_db),
+):
+    # get the magazine and the plans it offers from the database
+    magazines = magazines_with_offerings(db, Magazine.id == magazine_id, fields=fields)
     # if magazine not found, return an error with 404 status code
-    if not magazine:
+    if not magazines:
         raise HTTPException(status_code=404, detail="Magazine not found")
-    # get the plans available for that magazine using Plan table
-    magazine.plans = db.query(Plan).all()
-    # and the discount offered for each plan using the discount columns in the Magazine table
-    # calculate the discount for each plan
-    for plan in magazine.plans:
-        if plan.renewal_period == 1:
-            plan.discount = 0.0
-        if plan.renewal_period == 3:
-            plan.discount = magazine.discount_quarterly or 0.0
-        elif plan.renewal_period == 6:
-            plan.discount = magazine.discount_half_yearly or 0.0
-        elif plan.renewal_period == 12:
-            plan.discount = magazine.discount_annual or 0.0
-
-    return magazine
+    return set_etag(response, magazines[0])
 
 
 # api to delete a magazine
 @router.delete("/magazines/{magazine_id}")
 def delete_magazine(magazine_id: int, db: Session = Depends(get_db)):
-    # get the magazine from the database
-    magazine_db = db.query(Magazine).filter(Magazine.id == magazine_id).first()
+    # delete the magazine from the database in one statement
+    magazine_db = delete_one(db, Magazine, Magazine.id == magazine_id)
     # if magazine not found, return an error with 404 status code
     if not magazine_db:
         raise HTTPException(status_code=404, detail="Magazine not found")
-    # delete the magazine from the database
-    db.delete(magazine_db)
+    delete_offerings(db, MagazinePlan.magazine_id == magazine_id)
+    bump_catalog_version(db)
     db.commit()
+    autocomplete_index.invalidate()
     # return a success message with 200 status code
     return {"msg": "Magazine deleted successfully"}
 
@@ -308,13 +557,35 @@ def delete_magazine(magazine_id: int, db: Session = Depends(get_db)):
 # api to upadate a magazine
 @router.put("/magazines/{magazine_id}")
 def update_magazine(
-    magazine_id: int, magazine: MagazineBase, db: Session = Depends(get_db)
+    magazine_id: int,
+    magazine: MagazineBase,
+    response: Response,
+    expected: int = Depends(if_match),
+    db: Session = Depends(get_db),
 ):
     # get the magazine from the database
     magazine_db = db.query(Magazine).filter(Magazine.id == magazine_id).first()
     # if magazine not found, return an error with 400 status code
     if not magazine_db:
         raise HTTPException(status_code=400, detail="Magazine not found")
+    # the client edited an older version (If-Match)
+    if expected is not None and magazine_db.version != expected:
+        raise conflict("Magazine")
+    # active subscriptions are repriced when an offered price changes
+    prices_before = offering_prices(db, magazine_id)
+    # without plans in the body the offerings are kept (explicit ones included): re-derived
+    # when a discount column changes, repriced when only the base price does
+    discounts = (
+        magazine.discount_quarterly,
+        magazine.discount_half_yearly,
+        magazine.discount_annual,
+    )
+    rederive = magazine.plans is not None or discounts != (
+        magazine_db.discount_quarterly,
+        magazine_db.discount_half_yearly,
+        magazine_db.discount_annual,
+    )
+    reprice = magazine_db.base_price != magazine.base_price
     # update the magazine details
     magazine_db.name = magazine.name
     magazine_db.description = magazine.description
@@ -322,17 +593,45 @@ def update_magazine(
     magazine_db.discount_quarterly = magazine.discount_quarterly
     magazine_db.discount_half_yearly = magazine.discount_half_yearly
     magazine_db.discount_annual = magazine.discount_annual
+    # UPDATE ... WHERE version = <the version read above>, no rows when another write won
+    try:
+        db.flush()
+    except StaleDataError:
+        db.rollback()
+        raise conflict("Magazine")
+    if rederive:
+        set_offerings(db, magazine_db, magazine)
+    elif reprice:
+        reprice_offerings(db, MagazinePlan.magazine_id == magazine_id)
+    db.flush()
+    prices_changed = offering_prices(db, magazine_id) != prices_before
+    bump_catalog_version(db)
+    # queued with the change, run in chunks by the reprice worker (see repricing.py)
+    job = enqueue_reprice(db, magazine_id) if prices_changed else None
     db.commit()
+    autocomplete_index.invalidate()
     db.refresh(magazine_db)
+    if job is not None:
+        response.headers["X-Reprice-Job"] = str(job.id)
     # return the magazine details with 200 status code
-    return magazine_db
+    return set_etag(response, magazine_db)
 
 
 # api to create subscription
 @router.post("/subscriptions/", response_model=SubscriptionResponse)
-def create_subscription(
+async def create_subscription(
     subscription: SubscriptionCreate, db: Session = Depends(get_db)
 ):
+    # with group commit, concurrent writes share one transaction and are awaited without
+    # holding a worker thread (see groupcommit.py)
+    if group_committer.running:
+        return await group_committer.submit("create", subscription)
+    return await run_in_threadpool(insert_subscription, subscription, db)
+
+
+# the coroutine route is not profiled itself, its work in the threadpool is
+@profiled_endpoint
+def insert_subscription(subscription: SubscriptionCreate, db: Session):
     # Check if user exists
     user = db.query(User).filter(User.id == subscription.user_id).first()
     if not user:
@@ -346,7 +645,7 @@ def create_subscription(
         raise HTTPException(status_code=404, detail="Magazine not found")
 
     # Check if plan exists
-    plan = db.query(Plan).filter(Plan.id == subscription.plan_id).first()
+    plan = plan_registry.get(db, subscription.plan_id, force=True)
     if not plan:
         raise HTTPException(status_code=404, detail="Plan not found")
 
@@ -359,31 +658,93 @@ def create_subscription(
         next_renewal_date=subscription.next_renewal_date,
     )
     db.add(new_subscription)
-    db.commit()
+    enqueue_mail(db, "subscription", user.email, *subscription_mail("created", subscription))
+    # a user can only have one active subscription per magazine (partial unique index)
+    try:
+        refresh_summaries(db, [subscription.user_id])
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=400, detail="Active subscription already exists"
+        )
     db.refresh(new_subscription)
+    subscription_written(new_subscription)
 
     return new_subscription
 
 
 # api to get all subscriptions
 @router.get("/subscriptions/")
-def get_subscriptions(db: Session = Depends(get_db)):
-    # get all subscriptions from the database
-    subscriptions = db.query(Subscription).all()
-    return subscriptions
+# ?ids=1,2,3 returns just those subscriptions (in that order) with one IN query,
+# ?expand=magazine,plan replaces the references with the magazines and plans (one query each)
+def get_subscriptions(
+    fields: tuple = Depends(fieldset(SUBSCRIPTION_FIELDS)),
+    ids: tuple = Depends(id_list),
+    expand: tuple = Depends(expansions(SUBSCRIPTION_EXPANSIONS)),
+    db: Session = Depends(get_db),
+    loaders: Loaders = Depends(get_loaders),
+):
+    if ids is not None:
+        subscriptions = loaders.subscriptions.get_many(ids)
+    else:
+        # get all subscriptions (only the requested columns and the expanded references)
+        selected = fields
+        if fields is not None:
+            references = tuple(SUBSCRIPTION_EXPANSIONS[name][0] for name in expand)
+            selected = tuple(dict.fromkeys(fields + references))
+        subscriptions = [
+            row._asdict()
+            for row in db.execute(select(*columns(Subscription, selected))).all()
+        ]
+    expand_references(loaders, subscriptions, SUBSCRIPTION_EXPANSIONS, expand)
+    if fields is None:
+        return subscriptions
+    return [pick(subscription, fields + expand) for subscription in subscriptions]
+
+
+# api to get the current (active) subscription of a user for a magazine
+@router.get("/subscriptions/current", response_model=SubscriptionResponse)
+def get_current_subscription(
+    user_id: int, magazine_id: int, db: Session = Depends(get_db)
+):
+    subscription = current_subscription(db, user_id, magazine_id)
+    if not subscription:
+        raise HTTPException(status_code=404, detail="Subscription not found")
+    return subscription
 
 
 # api to get a subscription by id
 @router.get("/subscriptions/{subscription_id}")
-def get_subscription(subscription_id: int, db: Session = Depends(get_db)):
-    # get the subscription from the database
-    subscription = (
-        db.query(Subscription).filter(Subscription.id == subscription_id).first()
-    )
+def get_subscription(
+    subscription_id: int,
+    response: Response,
+    fields: tuple = Depends(fieldset(SUBSCRIPTION_FIELDS)),
+    db: Session = Depends(get_db),
+):
+    # get the subscription (only the requested columns) from the database
+    subscription = db.execute(
+        select(*columns(Subscription, fields)).where(Subscription.id == subscription_id)
+    ).first()
+    # archived subscriptions are only looked up when the live table has no such row
+    if not subscription:
+        subscription = get_archived_subscription(db, subscription_id, fields)
     # if subscription not found, return an error with 404 status code
     if not subscription:
         raise HTTPException(status_code=404, detail="Subscription not found")
-    return subscription
+    return set_etag(response, subscription._asdict())
+
+
+# api to get the replacement history of a subscription, oldest first
+@router.get(
+    "/subscriptions/{subscription_id}/history",
+    response_model=list[SubscriptionResponse],
+)
+def get_subscription_history(subscription_id: int, db: Session = Depends(get_db)):
+    history = subscription_history(db, subscription_id)
+    if not history:
+        raise HTTPException(status_code=404, detail="Subscription not found")
+    return history
 
 
 # api to get all subscriptions for a user
@@ -401,43 +762,105 @@ def get_subscriptions(user_id: int, db: Session = Depends(get_db)):
 
 # api to modify a subscription
 @router.put("/subscriptions/{subscription_id}")
-def modify_subscription(
+async def modify_subscription(
     subscription_id: int,
     subscription: SubscriptionCreate,
+    response: Response,
+    expected: int = Depends(if_match),
     db: Session = Depends(get_db),
 ):
-    # get the subscription from the database
     # If a user modifies their subscription for a magazine, the corresponsing subsciption is deactivated and a new subscription is created with a new renewal date depending on the plan that is chosen by the user.
-    subscription_db = (
-        db.query(Subscription).filter(Subscription.id == subscription_id).first()
+    if group_committer.running:
+        return set_etag(
+            response,
+            await group_committer.submit("modify", subscription, subscription_id, expected),
+        )
+    return await run_in_threadpool(
+        replace_subscription, subscription_id, subscription, response, expected, db
     )
+
+
+@profiled_endpoint
+def replace_subscription(
+    subscription_id: int,
+    subscription: SubscriptionCreate,
+    response: Response,
+    expected: int,
+    db: Session,
+):
+    current = db.execute(
+        select(
+            Subscription.version,
+            Subscription.is_active,
+            Subscription.user_id,
+            Subscription.plan_id,
+            Subscription.price,
+            Subscription.next_renewal_date,
+        ).where(Subscription.id == subscription_id)
+    ).first()
     # if subscription not found, return an error with 400 status code
-    if not subscription_db:
+    if not current:
         raise HTTPException(status_code=400, detail="Subscription not found")
-    # set the is_active attribute to False
-    subscription_db.is_active = False
-    db.commit()
-    db.refresh(subscription_db)
-    # create a new subscription with the new plan
+    # the client modified an older version (If-Match)
+    if expected is not None and current.version != expected:
+        raise conflict("Subscription")
+    if not current.is_active:
+        raise HTTPException(status_code=400, detail="Subscription is not active")
+    # both happen in one transaction, only the version read above can be replaced: a
+    # concurrent modification deactivates the row first and this one changes no rows
+    result = db.execute(
+        update(Subscription)
+        .where(
+            Subscription.id == subscription_id,
+            Subscription.version == current.version,
+            Subscription.is_active == True,
+        )
+        .values(
+            is_active=False,
+            deactivated_at=datetime.utcnow(),
+            version=Subscription.version + 1,
+        ),
+        execution_options={"synchronize_session": False},
+    )
+    if result.rowcount == 0:
+        db.rollback()
+        raise conflict("Subscription")
+    # create a new subscription with the new plan, linked to the one it replaces
     new_subscription = Subscription(
         user_id=subscription.user_id,
         magazine_id=subscription.magazine_id,
         plan_id=subscription.plan_id,
         price=subscription.price,
         next_renewal_date=subscription.next_renewal_date,
+        previous_subscription_id=subscription_id,
     )
     new_subscription.is_active = True
     # add the subscription to the database
     db.add(new_subscription)
-    db.commit()
+    enqueue_mail_to_user(
+        db, subscription.user_id, "subscription", *subscription_mail("modified", subscription)
+    )
+    try:
+        refresh_summaries(db, [current.user_id, subscription.user_id])
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=400, detail="Active subscription already exists"
+        )
     db.refresh(new_subscription)
+    subscription_written(new_subscription, replaced=current._asdict())
     # return the subscription details with 200 status code
-    return new_subscription
+    return set_etag(response, new_subscription)
 
 
 # api to cancel a subscription
 @router.delete("/subscriptions/{subscription_id}")
-def cancel_subscription(subscription_id: int, db: Session = Depends(get_db)):
+def cancel_subscription(
+    subscription_id: int,
+    expected: int = Depends(if_match),
+    db: Session = Depends(get_db),
+):
     # get the subscription from the database
     subscription_db = (
         db.query(Subscription).filter(Subscription.id == subscription_id).first()
@@ -445,9 +868,201 @@ def cancel_subscription(subscription_id: int, db: Session = Depends(get_db)):
     # if subscription not found, return an error with 400 status code
     if not subscription_db:
         raise HTTPException(status_code=400, detail="Subscription not found")
+    # the client cancelled an older version (If-Match)
+    if expected is not None and subscription_db.version != expected:
+        raise conflict("Subscription")
     # set the is_active attribute to False
-    subscription_db.is_active = False
-    db.commit()
+    cancelled = subscription_db.is_active
+    if cancelled:
+        subscription_db.is_active = False
+        subscription_db.deactivated_at = datetime.utcnow()
+        enqueue_mail_to_user(
+            db,
+            subscription_db.user_id,
+            "subscription",
+            *subscription_mail("cancelled", subscription_db),
+        )
+    # UPDATE ... WHERE version = <the version read above>
+    try:
+        if cancelled:
+            refresh_summaries(db, [subscription_db.user_id])
+        db.commit()
+    except StaleDataError:
+        db.rollback()
+        raise conflict("Subscription")
     db.refresh(subscription_db)
+    if cancelled:
+        subscription_cancelled(subscription_db)
     # return the subscription details with 200 status code
     return subscription_db
+
+
+# admin api to delete the plans matching a filter
+@router.post("/admin/plans/delete", dependencies=[Depends(require_admin)])
+def admin_delete_plans(filters: PlanFilter, db: Session = Depends(get_db)):
+    criteria = []
+    if filters.ids is not None:
+        criteria.append(Plan.id.in_(filters.ids))
+    if filters.title is not None:
+        criteria.append(Plan.title == filters.title)
+    if filters.renewal_period is not None:
+        criteria.append(Plan.renewal_period == filters.renewal_period)
+    # an empty filter would delete every plan, use DELETE /plans/ for that
+    if not criteria:
+        raise HTTPException(status_code=400, detail="At least one filter is required")
+    deleted = bulk_delete(
+        db, Plan, *criteria, on_chunk=lambda rows: plans_deleted(db, rows)
+    )
+    plan_registry.reload(db)
+    return {"deleted": len(deleted)}
+
+
+# per deleted chunk of magazines, in the chunk's transaction
+def magazines_deleted(db: Session, rows):
+    delete_offerings(db, MagazinePlan.magazine_id.in_([row[0] for row in rows]))
+    bump_catalog_version(db)
+
+
+# admin api to delete the magazines matching a filter
+@router.post("/admin/magazines/delete", dependencies=[Depends(require_admin)])
+def admin_delete_magazines(filters: MagazineFilter, db: Session = Depends(get_db)):
+    criteria = []
+    if filters.ids is not None:
+        criteria.append(Magazine.id.in_(filters.ids))
+    if filters.name_prefix is not None:
+        criteria.append(Magazine.name.startswith(filters.name_prefix, autoescape=True))
+    if not criteria:
+        raise HTTPException(status_code=400, detail="At least one filter is required")
+    deleted = bulk_delete(
+        db, Magazine, *criteria, on_chunk=lambda rows: magazines_deleted(db, rows)
+    )
+    autocomplete_index.invalidate()
+    return {"deleted": len(deleted)}
+
+
+# admin api to deactivate many users at once, their tokens are revoked in the same transaction
+@router.post("/admin/users/deactivate", dependencies=[Depends(require_admin)])
+def admin_deactivate_users(body: UserDeactivateMany, db: Session = Depends(get_db)):
+    revoke_until = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+
+    def revoke_chunk(rows):
+        for row in rows:
+            revocation_store.revoke(db, subject_key(row.username), revoke_until)
+
+    deactivated = bulk_delete(
+        db,
+        User,
+        User.username.in_(body.usernames),
+        returning=(User.username,),
+        on_chunk=revoke_chunk,
+    )
+    return {"deactivated": len(deactivated)}
+
+
+# admin api to deactivate the active subscriptions matching a filter
+@router.post("/admin/subscriptions/deactivate", dependencies=[Depends(require_admin)])
+def admin_deactivate_subscriptions(
+    filters: SubscriptionFilter, db: Session = Depends(get_db)
+):
+    criteria = []
+    if filters.ids is not None:
+        criteria.append(Subscription.id.in_(filters.ids))
+    if filters.user_id is not None:
+        criteria.append(Subscription.user_id == filters.user_id)
+    if filters.magazine_id is not None:
+        criteria.append(Subscription.magazine_id == filters.magazine_id)
+    if not criteria:
+        raise HTTPException(status_code=400, detail="At least one filter is required")
+    deactivated = bulk_update(
+        db,
+        Subscription,
+        {
+            "is_active": False,
+            "deactivated_at": datetime.utcnow(),
+            "version": Subscription.version + 1,
+        },
+        Subscription.is_active == True,
+        *criteria,
+        on_chunk=lambda rows: refresh_summaries(db, [row.user_id for row in rows]),
+        returning=(
+            Subscription.user_id,
+            Subscription.magazine_id,
+            Subscription.plan_id,
+            Subscription.price,
+            Subscription.next_renewal_date,
+        ),
+    )
+    for row in deactivated:
+        subscription_cancelled(row._asdict())
+    return {"deactivated": len(deactivated)}
+
+
+# admin api to move inactive subscriptions older than the retention window to the archive table
+@router.post("/admin/subscriptions/archive", dependencies=[Depends(require_admin)])
+def admin_archive_subscriptions(
+    retention_days: int = Query(90, ge=0),
+    batch_size: int = Query(500, ge=1, le=10000),
+    db: Session = Depends(get_db),
+):
+    archived = archive_inactive_subscriptions(db, retention_days, batch_size)
+    return {"archived": archived}
+
+
+# admin api to recompute every user's subscription summary (corrects drift)
+@router.post("/admin/subscription-summaries/rebuild", dependencies=[Depends(require_admin)])
+def admin_rebuild_subscription_summaries(db: Session = Depends(get_db)):
+    users, corrected = rebuild_summaries(db)
+    return {"users": users, "corrected": corrected}
+
+
+# admin api to reprice the active subscriptions of a magazine (queued for the reprice worker)
+@router.post(
+    "/admin/magazines/{magazine_id}/reprice",
+    status_code=202,
+    dependencies=[Depends(require_admin)],
+)
+def admin_reprice_magazine(magazine_id: int, db: Session = Depends(get_db)):
+    if not db.query(Magazine.id).filter(Magazine.id == magazine_id).first():
+        raise HTTPException(status_code=404, detail="Magazine not found")
+    job = enqueue_reprice(db, magazine_id)
+    db.commit()
+    db.refresh(job)
+    return job_progress(job)
+
+
+# admin api to follow a reprice job
+@router.get("/admin/reprice-jobs/{job_id}", dependencies=[Depends(require_admin)])
+def get_reprice_job(job_id: int, db: Session = Depends(get_db)):
+    job = db.get(RepriceJob, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Reprice job not found")
+    return job_progress(job)
+
+
+# api for downstream sync: the user, magazine and subscription changes after the cursor
+# `since` in commit order, with the current state of the changed rows (null once deleted or
+# archived); pass the returned `next` as the following since
+@router.get("/changes", dependencies=[Depends(require_admin)])
+def get_changes(
+    since: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    db: Session = Depends(get_db),
+):
+    return read_changes(db, since, limit)
+
+
+# api for operations: renewals and revenue per day and per month over the next 12 months,
+# by magazine and plan (computed once per day)
+@router.get("/forecast/renewals", dependencies=[Depends(require_admin)])
+def get_renewal_forecast(db: Session = Depends(get_db)):
+    return forecast_cache.get(db, date.today())
+
+
+# admin api to list the slowest statements, aggregated per fingerprint with the routes
+# that issued them and the plan captured on their first slow execution
+@router.get("/admin/slow-queries", dependencies=[Depends(require_admin)])
+def get_slow_queries(
+    limit: int = Query(50, ge=1, le=500),
+    order: str = Query("total_ms", pattern="^(total_ms|mean_ms|max_ms|count)$"),
+):
+    return slow_query_log.entries(limit, order)
@@ -0,0 +1,304 @@
+# append-only log of subscription events (subscription.created, .replaced, .cancelled) for
+# audit and analytics, so they never need to query the subscription tables. Endpoints emit an
+# event after their commit into an in-memory queue; a background writer appends the queued
+# events in batches to JSON-lines segment files (events-<first seq>.jsonl, a new one every
+# EVENT_LOG_SEGMENT_BYTES) and fsyncs them every EVENT_LOG_FSYNC_SECONDS, so a crash loses at
+# most that much. read_events() replays the log and tail_events() follows it.
+#
+# One writer per directory: with several worker processes give each its own EVENT_LOG_DIR.
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import date, datetime
+
+logger = logging.getLogger(__name__)
+
+EVENT_LOG_ENABLED = os.getenv("EVENT_LOG_ENABLED", "0") == "1"
+EVENT_LOG_DIR = os.getenv("EVENT_LOG_DIR", "events")
+EVENT_LOG_SEGMENT_BYTES = int(os.getenv("EVENT_LOG_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+EVENT_LOG_FSYNC_SECONDS = float(os.getenv("EVENT_LOG_FSYNC_SECONDS", "1"))
+# events written per batch
+EVENT_LOG_BATCH_SIZE = 1000
+# events waiting for the writer, beyond that they are dropped (and counted) rather than
+# blocking requests
+EVENT_LOG_QUEUE_SIZE = 100_000
+
+# the terms of a subscription an event carries (as "old" and "new")
+SUBSCRIPTION_TERMS = ("plan_id", "price", "next_renewal_date")
+
+_SEGMENT = "events-{:012d}.jsonl"
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serialisable")
+
+
+def _segments(directory: str):
+    return sorted(glob.glob(os.path.join(directory, "events-*.jsonl")))
+
+
+def _first_seq(path: str):
+    return int(os.path.basename(path)[len("events-") : -len(".jsonl")])
+
+
+# index of the segment holding the first event after seq `after`
+def _start_segment(paths: list, after: int):
+    index = 0
+    for i, path in enumerate(paths):
+        if _first_seq(path) <= after + 1:
+            index = i
+    return index
+
+
+def _fsync_directory(directory: str):
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+# drop a line left incomplete by a crash, returns the seq of the last complete event
+def _recover(path: str):
+    seq, end = _first_seq(path) - 1, 0
+    with open(path, "rb") as file:
+        for line in file:
+            if not line.endswith(b"\n"):
+                break
+            seq = json.loads(line)["seq"]
+            end += len(line)
+    if end != os.path.getsize(path):
+        logger.warning("truncating an incomplete event at the end of %s", path)
+        os.truncate(path, end)
+    return seq
+
+
+class EventLog:
+    def __init__(
+        self,
+        directory: str = EVENT_LOG_DIR,
+        segment_bytes: int = EVENT_LOG_SEGMENT_BYTES,
+        fsync_seconds: float = EVENT_LOG_FSYNC_SECONDS,
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_seconds = fsync_seconds
+        self.written = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=EVENT_LOG_QUEUE_SIZE)
+        self._thread = None
+        self._file = None
+        self._size = 0
+        self._seq = 0
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    # queue an event (a no-op unless the writer runs), never blocks
+    def emit(self, type: str, **fields):
+        if self._thread is None:
+            return
+        try:
+            self._queue.put_nowait({"type": type, "at": datetime.utcnow(), **fields})
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self, directory: str = None):
+        if directory is not None:
+            self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+        paths = _segments(self.directory)
+        if paths:
+            # continue the last segment (and its sequence)
+            self._seq = _recover(paths[-1])
+            self._open(paths[-1])
+        else:
+            self._seq = 0
+            self._open(os.path.join(self.directory, _SEGMENT.format(1)))
+        self._thread = threading.Thread(target=self._run, name="event-log", daemon=True)
+        self._thread.start()
+
+    # write what is queued, fsync and close
+    def stop(self):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+        self._file = None
+
+    def _open(self, path: str):
+        created = not os.path.exists(path)
+        self._file = open(path, "ab")
+        self._size = self._file.tell()
+        if created:
+            _fsync_directory(self.directory)
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _rotate(self):
+        self._sync()
+        self._file.close()
+        self._open(os.path.join(self.directory, _SEGMENT.format(self._seq + 1)))
+
+    def _write(self, batch: list):
+        lines = []
+        for event in batch:
+            self._seq += 1
+            lines.append(
+                json.dumps(
+                    {"seq": self._seq, **event}, separators=(",", ":"), default=_json_default
+                ).encode()
+                + b"\n"
+            )
+        data = b"".join(lines)
+        self._file.write(data)
+        # readers see complete batches, fsync follows on its own schedule
+        self._file.flush()
+        self._size += len(data)
+        self.written += len(batch)
+        if self._size >= self.segment_bytes:
+            self._rotate()
+
+    def _run(self):
+        last_sync = time.monotonic()
+        dirty = stopping = False
+        while not stopping:
+            timeout = max(last_sync + self.fsync_seconds - time.monotonic(), 0) if dirty else None
+            batch = []
+            try:
+                event = self._queue.get(timeout=timeout)
+                while event is not None:
+                    batch.append(event)
+                    if len(batch) >= EVENT_LOG_BATCH_SIZE:
+                        break
+                    event = self._queue.get_nowait()
+                stopping = event is None
+            except queue.Empty:
+                pass
+            try:
+                if batch:
+                    self._write(batch)
+                    dirty = True
+                if dirty and (stopping or time.monotonic() - last_sync >= self.fsync_seconds):
+                    self._sync()
+                    last_sync, dirty = time.monotonic(), False
+            except Exception:
+                logger.exception("writing %s events failed", len(batch))
+
+
+# every event after seq `after`, oldest first
+def read_events(directory: str = EVENT_LOG_DIR, after: int = 0):
+    paths = _segments(directory)
+    for path in paths[_start_segment(paths, after) :]:
+        with open(path, "rb") as file:
+            for line in file:
+                # the writer is in the middle of this line
+                if not line.endswith(b"\n"):
+                    break
+                event = json.loads(line)
+                if event["seq"] > after:
+                    yield event
+
+
+# like read_events, then waits for new events (across segment rotations) until stop is set
+def tail_events(
+    directory: str = EVENT_LOG_DIR,
+    after: int = 0,
+    poll_seconds: float = 0.5,
+    stop: threading.Event = None,
+):
+    stop = stop or threading.Event()
+    path, position = None, 0
+    while not stop.is_set():
+        paths = _segments(directory)
+        if path is None and paths:
+            path = paths[_start_segment(paths, after)]
+        if path is not None:
+            with open(path, "rb") as file:
+                file.seek(position)
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        break
+                    position += len(line)
+                    event = json.loads(line)
+                    if event["seq"] > after:
+                        after = event["seq"]
+                        yield event
+            # a newer segment existed before this one was read, so it was read to its end
+            later = [other for other in paths if other > path]
+            if later:
+                path, position = later[0], 0
+                continue
+        stop.wait(poll_seconds)
+
+
+def _terms(subscription):
+    if subscription is None:
+        return None
+    if isinstance(subscription, dict):
+        return {name: subscription[name] for name in SUBSCRIPTION_TERMS}
+    return {name: getattr(subscription, name) for name in SUBSCRIPTION_TERMS}
+
+
+def _field(subscription, name: str):
+    if isinstance(subscription, dict):
+        return subscription.get(name)
+    return getattr(subscription, name)
+
+
+# subscription.created / .replaced: subscription is the new one (a row or a dict),
+# replaced holds the terms of the subscription it replaced
+def subscription_written(subscription, replaced=None):
+    event_log.emit(
+        "subscription.replaced" if replaced is not None else "subscription.created",
+        subscription_id=_field(subscription, "id"),
+        user_id=_field(subscription, "user_id"),
+        magazine_id=_field(subscription, "magazine_id"),
+        previous_subscription_id=_field(subscription, "previous_subscription_id"),
+        old=_terms(replaced),
+        new=_terms(subscription),
+    )
+
+
+def subscription_cancelled(subscription):
+    event_log.emit(
+        "subscription.cancelled",
+        subscription_id=_field(subscription, "id"),
+        user_id=_field(subscription, "user_id"),
+        magazine_id=_field(subscription, "magazine_id"),
+        old=_terms(subscription),
+        new=None,
+    )
+
+
+event_log = EventLog()
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    args = argparse.ArgumentParser(description="Print the subscription event log")
+    args.add_argument("--directory", default=EVENT_LOG_DIR)
+    args.add_argument("--after", type=int, default=0, help="start after this seq")
+    args.add_argument("--follow", action="store_true", help="wait for new events")
+    options = args.parse_args()
+    reader = tail_events if options.follow else read_events
+    try:
+        for event in reader(options.directory, options.after):
+            sys.stdout.write(json.dumps(event, separators=(",", ":")) + "\n")
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
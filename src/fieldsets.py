@@ -0,0 +1,52 @@
+# sparse fieldsets: ?fields=id,name,base_price limits the columns an endpoint selects and
+# serialises to the requested ones, validated against the fields allowed per resource
+from fastapi import HTTPException, Query
+
+from models import Magazine, Plan, Subscription
+
+MAGAZINE_FIELDS = tuple(column.key for column in Magazine.__table__.c) + ("plans",)
+PLAN_FIELDS = tuple(column.key for column in Plan.__table__.c)
+SUBSCRIPTION_FIELDS = tuple(column.key for column in Subscription.__table__.c)
+# never the password hash
+USER_FIELDS = ("id", "username", "email", "created_at", "updated_at")
+
+
+def parse_fields(fields: str, allowed: tuple):
+    if fields is None:
+        return None
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    if not requested:
+        raise HTTPException(status_code=400, detail="fields must not be empty")
+    unknown = [field for field in requested if field not in allowed]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown fields {unknown}, allowed: {list(allowed)}",
+        )
+    # in the resource's own order, without duplicates
+    return tuple(field for field in allowed if field in requested)
+
+
+# dependency for the fields query parameter of a resource, None when not given
+def fieldset(allowed: tuple):
+    def dependency(
+        fields: str = Query(
+            None, description=f"comma separated subset of {', '.join(allowed)}"
+        ),
+    ):
+        return parse_fields(fields, allowed)
+
+    return dependency
+
+
+# the model's columns for a fieldset, all of them when fields is None
+def columns(model, fields: tuple = None):
+    if fields is None:
+        return list(model.__table__.c)
+    return [model.__table__.c[field] for field in fields]
+
+
+def pick(item: dict, fields: tuple = None):
+    if fields is None:
+        return item
+    return {field: item[field] for field in fields}
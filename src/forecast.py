@@ -0,0 +1,155 @@
+# renewal forecast: active subscriptions are loaded as arrays and projected forward by their
+# plan's renewal period with numpy datetime64 month arithmetic, then bucketed per day and
+# per month for each magazine and plan
+import threading
+from datetime import date
+
+import numpy as np
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from models import Subscription, Plan
+
+FORECAST_MONTHS = 12
+# subscriptions projected per numpy pass, bounds the size of the intermediate arrays
+FORECAST_CHUNK_SIZE = 200_000
+
+
+def load_active_subscriptions(db: Session):
+    rows = db.execute(
+        select(
+            Subscription.next_renewal_date,
+            Plan.renewal_period,
+            Subscription.price,
+            Subscription.magazine_id,
+            Subscription.plan_id,
+        )
+        .join(Plan, Plan.id == Subscription.plan_id)
+        .where(
+            Subscription.is_active == True,
+            Subscription.next_renewal_date.isnot(None),
+            Plan.renewal_period > 0,
+        )
+    ).all()
+    columns = list(zip(*rows)) or [(), (), (), (), ()]
+    return {
+        "next_renewal_date": np.array(columns[0], dtype="datetime64[D]"),
+        "renewal_period": np.array(columns[1], dtype=np.int64),
+        "price": np.array([price or 0.0 for price in columns[2]], dtype=np.float64),
+        "magazine_id": np.array(columns[3], dtype=np.int64),
+        "plan_id": np.array(columns[4], dtype=np.int64),
+    }
+
+
+# renewal dates of every subscription inside [start, end), same semantics as adding
+# relativedelta(months=k * period) to next_renewal_date (day clipped to the month length).
+# returns the row index and date of every renewal.
+def project_renewals(next_renewal_date, renewal_period, start, end, months):
+    start_day = np.datetime64(start, "D")
+    end_day = np.datetime64(end, "D")
+    first_month = next_renewal_date.astype("datetime64[M]")
+    day_of_month = (next_renewal_date - first_month.astype("datetime64[D]")).astype(
+        np.int64
+    )
+    # skip the whole periods that end before the window
+    months_behind = (np.datetime64(start, "M") - first_month).astype(np.int64)
+    first_step = np.maximum(0, months_behind // renewal_period - 1)
+    steps = first_step[:, None] + np.arange(months + 2)[None, :]
+    month = first_month[:, None] + steps * renewal_period[:, None]
+    month_start = month.astype("datetime64[D]")
+    month_length = ((month + 1).astype("datetime64[D]") - month_start).astype(np.int64)
+    renewal = month_start + np.minimum(day_of_month[:, None], month_length - 1)
+    inside = (renewal >= start_day) & (renewal < end_day)
+    rows, _ = np.nonzero(inside)
+    return rows, renewal[inside]
+
+
+# sum renewals and revenue per (bucket, magazine, plan)
+def _buckets(bucket, magazine_id, plan_id, price):
+    if not len(bucket):
+        return []
+    keys = np.stack([bucket.astype(np.int64), magazine_id, plan_id], axis=1)
+    unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    counts = np.bincount(inverse, minlength=len(unique))
+    revenue = np.bincount(inverse, weights=price, minlength=len(unique))
+    return list(zip(unique.tolist(), counts.tolist(), revenue.tolist()))
+
+
+def renewal_forecast(db: Session, start: date, months: int = FORECAST_MONTHS):
+    end = start + relativedelta(months=months)
+    arrays = load_active_subscriptions(db)
+    days, magazines, plans, prices = [], [], [], []
+    for offset in range(0, len(arrays["price"]), FORECAST_CHUNK_SIZE):
+        chunk = slice(offset, offset + FORECAST_CHUNK_SIZE)
+        rows, renewals = project_renewals(
+            arrays["next_renewal_date"][chunk],
+            arrays["renewal_period"][chunk],
+            start,
+            end,
+            months,
+        )
+        days.append(renewals)
+        magazines.append(arrays["magazine_id"][chunk][rows])
+        plans.append(arrays["plan_id"][chunk][rows])
+        prices.append(arrays["price"][chunk][rows])
+    renewals = np.concatenate(days) if days else np.array([], dtype="datetime64[D]")
+    magazine_id = np.concatenate(magazines) if magazines else np.array([], np.int64)
+    plan_id = np.concatenate(plans) if plans else np.array([], np.int64)
+    price = np.concatenate(prices) if prices else np.array([], np.float64)
+
+    daily = [
+        {
+            "date": str(np.datetime64(day, "D")),
+            "magazine_id": magazine,
+            "plan_id": plan,
+            "renewals": count,
+            "revenue": round(revenue, 2),
+        }
+        for (day, magazine, plan), count, revenue in _buckets(
+            renewals, magazine_id, plan_id, price
+        )
+    ]
+    monthly = [
+        {
+            "month": str(np.datetime64(month, "M")),
+            "magazine_id": magazine,
+            "plan_id": plan,
+            "renewals": count,
+            "revenue": round(revenue, 2),
+        }
+        for (month, magazine, plan), count, revenue in _buckets(
+            renewals.astype("datetime64[M]"), magazine_id, plan_id, price
+        )
+    ]
+    return {
+        "start": start,
+        "end": end,
+        "daily": daily,
+        "monthly": monthly,
+        "totals": {"renewals": len(price), "revenue": round(float(price.sum()), 2)},
+    }
+
+
+class ForecastCache:
+    # the forecast is computed at most once per day and process
+    def __init__(self):
+        self._day = None
+        self._result = None
+        self._lock = threading.Lock()
+
+    def get(self, db: Session, today: date):
+        with self._lock:
+            if self._day != today:
+                self._result = renewal_forecast(db, today)
+                self._day = today
+            return self._result
+
+    def clear(self):
+        with self._lock:
+            self._day = None
+            self._result = None
+
+
+forecast_cache = ForecastCache()
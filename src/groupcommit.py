@@ -0,0 +1,330 @@
+# group commit for subscription writes (opt-in with GROUP_COMMIT_ENABLED=1): concurrent
+# create_subscription / modify_subscription calls are queued for a few milliseconds and
+# written by a single flusher thread in one transaction with multi-row statements. Every
+# caller still gets its own result or error; a conflicting item is isolated with savepoints
+# without failing the rest of its batch. Callers await their write on the event loop, so the
+# number of writes in flight is not capped by the threadpool size.
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+
+from fastapi import HTTPException
+from sqlalchemy import insert, select, tuple_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from catalog import plan_registry
+from eventlog import subscription_written
+from mailer import subscription_mail
+from models import Magazine, OutboxMessage, Subscription, User
+from summaries import refresh_summaries
+from versioning import conflict
+
+logger = logging.getLogger(__name__)
+
+GROUP_COMMIT_ENABLED = os.getenv("GROUP_COMMIT_ENABLED", "0") == "1"
+# a batch is flushed when it holds this many writes ...
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "200"))
+# ... or this long after its first write was queued
+GROUP_COMMIT_MAX_WAIT_MS = float(os.getenv("GROUP_COMMIT_MAX_WAIT_MS", "5"))
+# callers give up (503) after this many seconds
+GROUP_COMMIT_TIMEOUT = 10
+
+SUBSCRIPTION_COLUMNS = list(Subscription.__table__.c)
+
+
+class Write:
+    def __init__(
+        self, kind: str, subscription, subscription_id: int = None, expected: int = None
+    ):
+        self.kind = kind
+        self.subscription = subscription
+        self.subscription_id = subscription_id
+        # the version the client modified (If-Match), if any
+        self.expected = expected
+        self.future = Future()
+        self.row = None
+        # terms of the subscription a modify replaced
+        self.replaced = None
+        self.error = None
+
+    def fail(self, status_code: int, detail: str):
+        self.error = HTTPException(status_code=status_code, detail=detail)
+
+    def conflict(self):
+        self.error = conflict("Subscription")
+
+
+def _new_row(write: Write):
+    subscription = write.subscription
+    return {
+        "user_id": subscription.user_id,
+        "magazine_id": subscription.magazine_id,
+        "plan_id": subscription.plan_id,
+        "price": subscription.price,
+        "next_renewal_date": subscription.next_renewal_date,
+        "is_active": True,
+        "previous_subscription_id": write.subscription_id,
+    }
+
+
+# creates: the user, magazine and plan must exist (one IN query each, plans from the registry)
+def _validate_creates(db: Session, creates: list):
+    def existing(model, key):
+        ids = {getattr(write.subscription, key) for write in creates}
+        return set(db.execute(select(model.id).where(model.id.in_(ids))).scalars())
+
+    users = existing(User, "user_id")
+    magazines = existing(Magazine, "magazine_id")
+    plans = plan_registry.get_many(
+        db, {write.subscription.plan_id for write in creates}, force=True
+    )
+    for write in creates:
+        if write.subscription.user_id not in users:
+            write.fail(404, "User not found")
+        elif write.subscription.magazine_id not in magazines:
+            write.fail(404, "Magazine not found")
+        elif write.subscription.plan_id not in plans:
+            write.fail(404, "Plan not found")
+
+
+# modifies: deactivate the replaced subscriptions with one UPDATE ... WHERE (id, version)
+# IN (...), a subscription modified twice in the same batch is a conflict for the second write
+def _deactivate(db: Session, modifies: list, now: datetime):
+    first = {}
+    for write in modifies:
+        if write.subscription_id in first:
+            write.conflict()
+        else:
+            first[write.subscription_id] = write
+    if not first:
+        return []
+    current = {
+        row.id: row
+        for row in db.execute(
+            select(
+                Subscription.id,
+                Subscription.version,
+                Subscription.is_active,
+                Subscription.user_id,
+                Subscription.plan_id,
+                Subscription.price,
+                Subscription.next_renewal_date,
+            ).where(Subscription.id.in_(list(first)))
+        )
+    }
+    versions = []
+    for id, write in first.items():
+        row = current.get(id)
+        if row is None:
+            write.fail(400, "Subscription not found")
+        elif write.expected is not None and row.version != write.expected:
+            write.conflict()
+        elif not row.is_active:
+            write.fail(400, "Subscription is not active")
+        else:
+            versions.append((id, row.version))
+            write.replaced = row._asdict()
+    if not versions:
+        return []
+    deactivated = set(
+        db.execute(
+            update(Subscription)
+            .where(
+                tuple_(Subscription.id, Subscription.version).in_(versions),
+                Subscription.is_active == True,
+            )
+            .values(is_active=False, deactivated_at=now, version=Subscription.version + 1)
+            .returning(Subscription.id),
+            execution_options={"synchronize_session": False},
+        ).scalars()
+    )
+    # changed by another process between the read and the update
+    for id, _ in versions:
+        if id not in deactivated:
+            first[id].conflict()
+    return [write for id, write in first.items() if id in deactivated]
+
+
+def _insert(db: Session, writes: list):
+    rows = db.execute(
+        insert(Subscription).returning(*SUBSCRIPTION_COLUMNS, sort_by_parameter_order=True),
+        [_new_row(write) for write in writes],
+    ).all()
+    for write, row in zip(writes, rows):
+        write.row = row._asdict()
+
+
+def _enqueue_mails(db: Session, writes: list):
+    user_ids = {write.subscription.user_id for write in writes}
+    emails = dict(
+        db.execute(select(User.id, User.email).where(User.id.in_(user_ids))).all()
+    )
+    now = datetime.utcnow()
+    messages = []
+    for write in writes:
+        email = emails.get(write.subscription.user_id)
+        if email is None:
+            continue
+        action = "created" if write.kind == "create" else "modified"
+        subject, body = subscription_mail(action, write.subscription)
+        messages.append(
+            {
+                "kind": "subscription",
+                "recipient": email,
+                "subject": subject,
+                "body": body,
+                "status": "pending",
+                "attempts": 0,
+                "next_attempt_at": now,
+                "created_at": now,
+            }
+        )
+    if messages:
+        db.execute(insert(OutboxMessage), messages)
+
+
+# one write on its own, in a savepoint so a conflict only fails this write
+def _apply_one(db: Session, write: Write, now: datetime):
+    try:
+        with db.begin_nested():
+            if write.kind == "modify" and not _deactivate(db, [write], now):
+                return
+            _insert(db, [write])
+            _enqueue_mails(db, [write])
+    except IntegrityError:
+        write.row = None
+        write.fail(400, "Active subscription already exists")
+
+
+# apply a batch of writes in the session's transaction, the caller commits
+def apply_writes(db: Session, writes: list):
+    now = datetime.utcnow()
+    creates = [write for write in writes if write.kind == "create"]
+    modifies = [write for write in writes if write.kind == "modify"]
+    if creates:
+        _validate_creates(db, creates)
+    try:
+        # all at once: one UPDATE, one multi-row INSERT for subscriptions and one for e-mail
+        with db.begin_nested():
+            valid = [write for write in creates if write.error is None]
+            valid += _deactivate(db, modifies, now)
+            if valid:
+                _insert(db, valid)
+                _enqueue_mails(db, valid)
+    except IntegrityError:
+        # an active subscription already exists for some write: isolate them one by one
+        # (writes that already failed keep their error, e.g. the 409 of a second
+        # modification of the same subscription)
+        for write in writes:
+            if write.error is None:
+                _apply_one(db, write, now)
+    # one summary refresh for the users of the whole batch
+    written = [write for write in writes if write.error is None and write.row is not None]
+    refresh_summaries(
+        db,
+        [write.subscription.user_id for write in written]
+        + [write.replaced["user_id"] for write in written if write.replaced is not None],
+    )
+
+
+class GroupCommitter:
+    def __init__(
+        self,
+        max_batch: int = GROUP_COMMIT_MAX_BATCH,
+        max_wait_ms: float = GROUP_COMMIT_MAX_WAIT_MS,
+    ):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.session_factory = None
+        self.batches = 0
+        self.writes = 0
+        self._queue = queue.Queue()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, session_factory):
+        self.session_factory = session_factory
+        self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    # queue a write and wait for the batch it lands in, returns the new subscription
+    async def submit(
+        self, kind: str, subscription, subscription_id: int = None, expected: int = None
+    ):
+        write = Write(kind, subscription, subscription_id, expected)
+        self._queue.put(write)
+        result = asyncio.wrap_future(write.future)
+        try:
+            return await asyncio.wait_for(asyncio.shield(result), GROUP_COMMIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            # not taken by a flush yet: cancelled, so no later flush can commit it
+            if write.future.cancel():
+                raise HTTPException(status_code=503, detail="Write timed out")
+            # already being written, its outcome is the response
+            return await result
+
+    def _run(self):
+        while True:
+            write = self._queue.get()
+            if write is None:
+                return
+            batch = [write]
+            deadline = time.monotonic() + self.max_wait
+            stopping = False
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    write = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if write is None:
+                    stopping = True
+                    break
+                batch.append(write)
+            self._flush(batch)
+            if stopping:
+                return
+
+    def _flush(self, batch: list):
+        # skip the writes whose callers timed out, the others can no longer be cancelled
+        batch = [write for write in batch if write.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            with self.session_factory() as db:
+                apply_writes(db, batch)
+                db.commit()
+        except Exception as error:
+            logger.exception("group commit of %s writes failed", len(batch))
+            for write in batch:
+                write.future.set_exception(error)
+            return
+        self.batches += 1
+        self.writes += len(batch)
+        for write in batch:
+            if write.error is not None:
+                write.future.set_exception(write.error)
+            else:
+                subscription_written(write.row, write.replaced)
+                write.future.set_result(write.row)
+
+
+group_committer = GroupCommitter()
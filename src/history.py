@@ -0,0 +1,62 @@
+# lookups of a user's current subscription and of the replacement chain of a subscription
+from sqlalchemy import select, literal, union_all
+from sqlalchemy.orm import Session
+
+from models import Subscription
+from archive import all_subscriptions
+
+
+# served by the partial unique index on (user_id, magazine_id) WHERE is_active
+def current_subscription(db: Session, user_id: int, magazine_id: int):
+    return (
+        db.query(Subscription)
+        .filter(
+            Subscription.user_id == user_id,
+            Subscription.magazine_id == magazine_id,
+            Subscription.is_active == True,
+        )
+        .first()
+    )
+
+
+# every subscription in the chain of subscription_id, oldest first, across the hot and the
+# archive table. Two recursive CTEs walk the chain backwards (primary key lookups) and
+# forwards (previous_subscription_id indexes).
+def subscription_history(db: Session, subscription_id: int):
+    subscriptions = all_subscriptions()
+    ancestors = (
+        select(
+            subscriptions.c.id,
+            subscriptions.c.previous_subscription_id,
+            literal(0).label("depth"),
+        )
+        .where(subscriptions.c.id == subscription_id)
+        .cte("ancestors", recursive=True)
+    )
+    ancestors = ancestors.union_all(
+        select(
+            subscriptions.c.id,
+            subscriptions.c.previous_subscription_id,
+            ancestors.c.depth - 1,
+        ).where(subscriptions.c.id == ancestors.c.previous_subscription_id)
+    )
+    descendants = (
+        select(subscriptions.c.id, literal(0).label("depth"))
+        .where(subscriptions.c.id == subscription_id)
+        .cte("descendants", recursive=True)
+    )
+    descendants = descendants.union_all(
+        select(subscriptions.c.id, descendants.c.depth + 1).where(
+            subscriptions.c.previous_subscription_id == descendants.c.id
+        )
+    )
+    chain = union_all(
+        select(ancestors.c.id, ancestors.c.depth),
+        select(descendants.c.id, descendants.c.depth).where(descendants.c.depth > 0),
+    ).subquery()
+    rows = db.execute(
+        select(subscriptions)
+        .join(chain, subscriptions.c.id == chain.c.id)
+        .order_by(chain.c.depth)
+    )
+    return [dict(row) for row in rows.mappings()]
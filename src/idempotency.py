@@ -0,0 +1,380 @@
+# Idempotency-Key support for the POSTs mobile clients retry (POST /subscriptions/ and
+# POST /users/register). The first request with a key claims it in the idempotency_keys table,
+# runs, and stores its response before sending it; a retry with the same key and the same
+# request (method, path, body and Authorization header) replays that response without running
+# the endpoint again. Duplicates arriving while the first request runs wait for it: in this
+# process on an asyncio event, from other workers by polling the claimed row. Responses are
+# also kept in a bounded in-memory store, so most retries never reach the database.
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse, Response
+
+from database import SessionLocal
+from models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+# (method, path) of the endpoints that honour Idempotency-Key
+IDEMPOTENT_ROUTES = {("POST", "/subscriptions/"), ("POST", "/users/register")}
+# how long a response is replayed for a key
+IDEMPOTENCY_TTL = timedelta(hours=int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24")))
+# responses kept in memory per worker (least recently used ones are dropped first)
+IDEMPOTENCY_MEMORY_SIZE = 10_000
+# how long a duplicate waits for the first request before giving up with 409
+IDEMPOTENCY_WAIT_SECONDS = 10.0
+IDEMPOTENCY_POLL_SECONDS = 0.05
+# a claim whose worker died is taken over after this; the worker running the request extends
+# its claim every IDEMPOTENCY_HEARTBEAT_SECONDS, so a slow request is never run twice
+IDEMPOTENCY_LOCK = timedelta(seconds=30)
+IDEMPOTENCY_HEARTBEAT_SECONDS = 10.0
+MAX_KEY_LENGTH = 255
+# response headers stored and replayed
+STORED_HEADERS = ("content-type", "etag", "x-reprice-job")
+
+CLAIMED, DONE, BUSY, MISMATCH = "claimed", "done", "busy", "mismatch"
+
+
+@dataclass(frozen=True, slots=True)
+class StoredResponse:
+    status: int
+    headers: tuple
+    body: bytes
+    request_hash: str
+    expires_at: datetime
+
+
+def request_hash(scope, body: bytes):
+    headers = Headers(scope=scope)
+    digest = hashlib.sha256()
+    for part in (scope["method"], scope["path"], headers.get("authorization", "")):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    digest.update(body)
+    return digest.hexdigest()
+
+
+class MemoryStore:
+    def __init__(self, size: int = IDEMPOTENCY_MEMORY_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            stored = self._entries.get(key)
+            if stored is None:
+                return None
+            if stored.expires_at <= datetime.utcnow():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return stored
+
+    def put(self, key: str, stored: StoredResponse):
+        with self._lock:
+            self._entries[key] = stored
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _stored(row: IdempotencyKey):
+    return StoredResponse(
+        row.response_status,
+        tuple(tuple(header) for header in json.loads(row.response_headers)),
+        row.response_body,
+        row.request_hash,
+        row.expires_at,
+    )
+
+
+# claim key for a request, or report why not: (CLAIMED, claimed_at identifying the claim),
+# (DONE, stored response), (BUSY, None) while another request runs it, (MISMATCH, None) when
+# it was used for a different request
+def claim_key(session_factory, key: str, fingerprint: str):
+    with session_factory() as db:
+        while True:
+            now = datetime.utcnow()
+            try:
+                db.add(
+                    IdempotencyKey(
+                        key=key,
+                        request_hash=fingerprint,
+                        status="in_progress",
+                        created_at=now,
+                        locked_until=now + IDEMPOTENCY_LOCK,
+                        expires_at=now + IDEMPOTENCY_TTL,
+                    )
+                )
+                db.commit()
+                return CLAIMED, now
+            except IntegrityError:
+                db.rollback()
+            row = db.get(IdempotencyKey, key)
+            if row is None:
+                continue
+            abandoned = row.status == "in_progress" and row.locked_until <= now
+            if row.expires_at <= now or abandoned:
+                # expired, or its worker died: take it over unless someone else just did
+                result = db.execute(
+                    update(IdempotencyKey)
+                    .where(
+                        IdempotencyKey.key == key,
+                        IdempotencyKey.status == row.status,
+                        IdempotencyKey.locked_until == row.locked_until,
+                    )
+                    .values(
+                        request_hash=fingerprint,
+                        status="in_progress",
+                        response_status=None,
+                        response_headers=None,
+                        response_body=None,
+                        created_at=now,
+                        locked_until=now + IDEMPOTENCY_LOCK,
+                        expires_at=now + IDEMPOTENCY_TTL,
+                    ),
+                    execution_options={"synchronize_session": False},
+                )
+                db.commit()
+                if result.rowcount == 1:
+                    return CLAIMED, now
+                db.expire_all()
+                continue
+            if row.request_hash != fingerprint:
+                return MISMATCH, None
+            if row.status == "done":
+                return DONE, _stored(row)
+            return BUSY, None
+
+
+# push back the lock of a running claim, False when it was taken over meanwhile
+def extend_key(session_factory, key: str, claimed_at: datetime):
+    with session_factory() as db:
+        result = db.execute(
+            update(IdempotencyKey)
+            .where(
+                IdempotencyKey.key == key,
+                IdempotencyKey.status == "in_progress",
+                IdempotencyKey.created_at == claimed_at,
+            )
+            .values(locked_until=datetime.utcnow() + IDEMPOTENCY_LOCK),
+            execution_options={"synchronize_session": False},
+        )
+        db.commit()
+    return result.rowcount == 1
+
+
+def complete_key(session_factory, key: str, status: int, headers: tuple, body: bytes):
+    expires_at = datetime.utcnow() + IDEMPOTENCY_TTL
+    with session_factory() as db:
+        db.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.key == key)
+            .values(
+                status="done",
+                response_status=status,
+                response_headers=json.dumps(headers),
+                response_body=body,
+                expires_at=expires_at,
+            ),
+            execution_options={"synchronize_session": False},
+        )
+        db.commit()
+    return expires_at
+
+
+# give a key back after a failed request, so a retry runs it again
+def release_key(session_factory, key: str):
+    with session_factory() as db:
+        db.execute(
+            delete(IdempotencyKey).where(
+                IdempotencyKey.key == key, IdempotencyKey.status == "in_progress"
+            ),
+            execution_options={"synchronize_session": False},
+        )
+        db.commit()
+
+
+def purge_expired_keys(db):
+    result = db.execute(
+        delete(IdempotencyKey).where(IdempotencyKey.expires_at <= datetime.utcnow()),
+        execution_options={"synchronize_session": False},
+    )
+    db.commit()
+    return result.rowcount
+
+
+def _error(status_code: int, detail: str):
+    return JSONResponse({"detail": detail}, status_code=status_code)
+
+
+def _replay(stored: StoredResponse):
+    response = Response(stored.body, status_code=stored.status, headers=dict(stored.headers))
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+class IdempotencyMiddleware:
+    def __init__(self, app, session_factory=SessionLocal, store: MemoryStore = None):
+        self.app = app
+        self.session_factory = session_factory
+        self.store = store or memory_store
+        # keys of the requests running in this process -> set when they finish
+        self._running = {}
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or (scope["method"], scope["path"]) not in IDEMPOTENT_ROUTES
+            or "idempotency-key" not in Headers(scope=scope)
+        ):
+            await self.app(scope, receive, send)
+            return
+        key = Headers(scope=scope)["idempotency-key"].strip()
+        if not key or len(key) > MAX_KEY_LENGTH:
+            await _error(400, f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters")(
+                scope, receive, send
+            )
+            return
+        key = f"{scope['path']}:{key}"
+        body = await self._read_body(receive)
+        response = await self._handle(scope, key, request_hash(scope, body), body)
+        await response(scope, receive, send)
+
+    @staticmethod
+    async def _read_body(receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        return b"".join(chunks)
+
+    async def _handle(self, scope, key: str, fingerprint: str, body: bytes):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + IDEMPOTENCY_WAIT_SECONDS
+        # duplicates in this process wait for the running request
+        while True:
+            stored = self.store.get(key)
+            if stored is not None:
+                if stored.request_hash != fingerprint:
+                    return _error(422, "Idempotency-Key was used for a different request")
+                return _replay(stored)
+            running = self._running.get(key)
+            if running is None:
+                break
+            try:
+                await asyncio.wait_for(running.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                return _error(409, "A request with this Idempotency-Key is in progress")
+        # nothing awaited since the lookups above, so only this request registers the key
+        running = self._running[key] = asyncio.Event()
+        try:
+            # ... and duplicates in other workers through the table
+            while True:
+                outcome, result = await run_in_threadpool(
+                    claim_key, self.session_factory, key, fingerprint
+                )
+                if outcome != BUSY:
+                    break
+                if loop.time() >= deadline:
+                    return _error(409, "A request with this Idempotency-Key is in progress")
+                await asyncio.sleep(IDEMPOTENCY_POLL_SECONDS)
+            if outcome == MISMATCH:
+                return _error(422, "Idempotency-Key was used for a different request")
+            if outcome == DONE:
+                self.store.put(key, result)
+                return _replay(result)
+            return await self._run(scope, key, fingerprint, body, claimed_at=result)
+        finally:
+            del self._running[key]
+            running.set()
+
+    # keep the claim while the request runs
+    async def _heartbeat(self, key: str, claimed_at: datetime):
+        while True:
+            await asyncio.sleep(IDEMPOTENCY_HEARTBEAT_SECONDS)
+            try:
+                if not await run_in_threadpool(
+                    extend_key, self.session_factory, key, claimed_at
+                ):
+                    logger.warning("idempotency key %s was taken over while running", key)
+                    return
+            except Exception:
+                logger.exception("extending idempotency key %s failed", key)
+
+    # run the claimed request and store its response before it is sent
+    async def _run(self, scope, key: str, fingerprint: str, body: bytes, claimed_at: datetime):
+        start, chunks = {}, []
+        received = False
+
+        async def receive():
+            nonlocal received
+            if not received:
+                received = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return {"type": "http.disconnect"}
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                start.update(message)
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        heartbeat = asyncio.create_task(self._heartbeat(key, claimed_at))
+        try:
+            await self.app(scope, receive, capture)
+        except BaseException:
+            await run_in_threadpool(release_key, self.session_factory, key)
+            raise
+        finally:
+            heartbeat.cancel()
+        status = start["status"]
+        raw_headers = [
+            (name.decode("latin-1"), value.decode("latin-1"))
+            for name, value in start.get("headers", [])
+        ]
+        content = b"".join(chunks)
+        # server errors are not replayed, a retry runs the request again
+        if status >= 500:
+            await run_in_threadpool(release_key, self.session_factory, key)
+        else:
+            headers = tuple(
+                (name, value) for name, value in raw_headers if name.lower() in STORED_HEADERS
+            )
+            expires_at = await run_in_threadpool(
+                complete_key, self.session_factory, key, status, headers, content
+            )
+            self.store.put(key, StoredResponse(status, headers, content, fingerprint, expires_at))
+        response = Response(content, status_code=status)
+        response.raw_headers = [
+            (name.encode("latin-1"), value.encode("latin-1")) for name, value in raw_headers
+        ]
+        return response
+
+
+memory_store = MemoryStore()
+
+
+if __name__ == "__main__":
+    with SessionLocal() as db:
+        print(f"purged {purge_expired_keys(db)} expired idempotency keys")
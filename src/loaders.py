@@ -0,0 +1,146 @@
+# request-scoped batch loading: lookups of the same entity type within a request are queued
+# and resolved together with one IN query, results are kept for the rest of the request
+from fastapi import Depends, HTTPException, Query
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from catalog import magazines_with_offerings, plan_registry
+from database import get_db
+from fieldsets import columns, USER_FIELDS
+from models import Magazine, Subscription, User
+
+# most ids accepted by a multi-get request
+MAX_IDS = 100
+
+
+class BatchLoader:
+    # fetch(keys) returns {key: value} for the keys that exist
+    def __init__(self, fetch):
+        self._fetch = fetch
+        self._values = {}
+        self._pending = set()
+
+    # queue keys, they are fetched with the next get
+    def prime(self, keys):
+        self._pending.update(key for key in keys if key not in self._values)
+
+    def _flush(self):
+        if not self._pending:
+            return
+        keys, self._pending = self._pending, set()
+        found = self._fetch(sorted(keys))
+        for key in keys:
+            self._values[key] = found.get(key)
+
+    def get(self, key):
+        if key not in self._values:
+            self._pending.add(key)
+            self._flush()
+        return self._values[key]
+
+    # values for keys in their order, missing ones are left out
+    def get_many(self, keys):
+        self.prime(keys)
+        self._flush()
+        return [self._values[key] for key in keys if self._values[key] is not None]
+
+
+def _rows_by_id(db: Session, model, fields: tuple = None):
+    def fetch(ids):
+        rows = db.execute(select(*columns(model, fields)).where(model.id.in_(ids))).all()
+        return {row.id: row._asdict() for row in rows}
+
+    return fetch
+
+
+def _plans_by_id(db: Session):
+    def fetch(ids):
+        return {
+            plan_id: plan.as_dict()
+            for plan_id, plan in plan_registry.get_many(db, ids).items()
+        }
+
+    return fetch
+
+
+def _magazines_by_id(db: Session):
+    def fetch(ids):
+        return {
+            magazine["id"]: magazine
+            for magazine in magazines_with_offerings(db, Magazine.id.in_(ids))
+        }
+
+    return fetch
+
+
+class Loaders:
+    def __init__(self, db: Session):
+        self.magazines = BatchLoader(_magazines_by_id(db))
+        self.plans = BatchLoader(_plans_by_id(db))
+        self.subscriptions = BatchLoader(_rows_by_id(db, Subscription))
+        self.users = BatchLoader(_rows_by_id(db, User, USER_FIELDS))
+
+
+# one set of loaders per request (FastAPI caches dependencies within a request)
+def get_loaders(db: Session = Depends(get_db)):
+    return Loaders(db)
+
+
+# dependency for the ids query parameter of the multi-get endpoints, None when not given
+def id_list(
+    ids: str = Query(None, description=f"comma separated ids, at most {MAX_IDS}"),
+):
+    if ids is None:
+        return None
+    try:
+        parsed = [int(value) for value in ids.split(",") if value.strip()]
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail="ids must be comma separated integers"
+        )
+    if not parsed or len(parsed) > MAX_IDS:
+        raise HTTPException(
+            status_code=400, detail=f"between 1 and {MAX_IDS} ids are required"
+        )
+    # keep the requested order, without duplicates
+    return tuple(dict.fromkeys(parsed))
+
+
+# references a subscription can be expanded into: name -> (id field, loader)
+SUBSCRIPTION_EXPANSIONS = {
+    "magazine": ("magazine_id", "magazines"),
+    "plan": ("plan_id", "plans"),
+}
+
+
+# dependency for the expand query parameter, an empty tuple when not given
+def expansions(allowed: dict):
+    def dependency(
+        expand: str = Query(
+            None, description=f"comma separated subset of {', '.join(allowed)}"
+        ),
+    ):
+        if expand is None:
+            return ()
+        requested = [name.strip() for name in expand.split(",") if name.strip()]
+        unknown = [name for name in requested if name not in allowed]
+        if unknown:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown expansions {unknown}, allowed: {list(allowed)}",
+            )
+        return tuple(dict.fromkeys(requested))
+
+    return dependency
+
+
+# replace references of items with the referenced entities, one query per entity type
+def expand_references(loaders: Loaders, items: list, allowed: dict, names: tuple):
+    for name in names:
+        key, loader = allowed[name]
+        getattr(loaders, loader).prime(item[key] for item in items)
+    for item in items:
+        for name in names:
+            key, loader = allowed[name]
+            item[name] = getattr(loaders, loader).get(item[key])
+    return items
@@ -0,0 +1,298 @@
+# transactional e-mail through an outbox: endpoints add messages to the outbox table inside
+# their own transaction, a background worker delivers them in batches over pooled SMTP
+# connections with retries and exponential backoff. Request latency never depends on SMTP.
+import logging
+import os
+import queue
+import smtplib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+from sqlalchemy import insert, select, update, literal
+from sqlalchemy.orm import Session
+
+from models import OutboxMessage, User
+
+logger = logging.getLogger(__name__)
+
+# SMTP settings
+SMTP_HOST = os.getenv("SMTP_HOST", "localhost")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "25"))
+SMTP_USERNAME = os.getenv("SMTP_USERNAME")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+MAIL_FROM = os.getenv("MAIL_FROM", "no-reply@magazines.example.com")
+# worker settings
+MAIL_WORKER_ENABLED = os.getenv("MAIL_WORKER_ENABLED", "0") == "1"
+MAIL_POOL_SIZE = int(os.getenv("MAIL_POOL_SIZE", "4"))
+MAIL_BATCH_SIZE = 100
+MAIL_POLL_SECONDS = 2.0
+MAIL_MAX_ATTEMPTS = 6
+MAIL_RETRY_BASE_SECONDS = 30
+# a claimed message is retried after this long if the worker dies while sending it
+MAIL_CLAIM_LEASE = timedelta(minutes=5)
+
+
+# add a message to the outbox, the caller commits
+def enqueue_mail(db: Session, kind: str, recipient: str, subject: str, body: str):
+    db.add(
+        OutboxMessage(kind=kind, recipient=recipient, subject=subject, body=body)
+    )
+
+
+# same, addressed to a user by id with an INSERT ... SELECT (no extra round trip)
+def enqueue_mail_to_user(db: Session, user_id: int, kind: str, subject: str, body: str):
+    now = datetime.utcnow()
+    db.execute(
+        insert(OutboxMessage).from_select(
+            [
+                "kind",
+                "recipient",
+                "subject",
+                "body",
+                "status",
+                "attempts",
+                "next_attempt_at",
+                "created_at",
+            ],
+            select(
+                literal(kind),
+                User.email,
+                literal(subject),
+                literal(body),
+                literal("pending"),
+                literal(0),
+                literal(now),
+                literal(now),
+            ).where(User.id == user_id),
+        )
+    )
+
+
+# message templates
+def registration_mail(username: str):
+    return (
+        "Welcome to the magazine service",
+        f"Hi {username}, your account has been created.",
+    )
+
+
+def password_reset_mail(username: str):
+    return (
+        "Password reset requested",
+        f"Hi {username}, a password reset was requested for your account. "
+        "If this was not you, you can ignore this message.",
+    )
+
+
+def subscription_mail(action: str, subscription):
+    return (
+        f"Subscription {action}",
+        f"Your subscription to magazine {subscription.magazine_id} was {action}. "
+        f"Plan: {subscription.plan_id}, price: {subscription.price}, "
+        f"next renewal: {subscription.next_renewal_date}.",
+    )
+
+
+class SMTPPool:
+    # at most `size` open connections, idle ones are reused across batches
+    def __init__(
+        self,
+        host: str = SMTP_HOST,
+        port: int = SMTP_PORT,
+        size: int = MAIL_POOL_SIZE,
+        username: str = SMTP_USERNAME,
+        password: str = SMTP_PASSWORD,
+        timeout: float = 10,
+    ):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.username:
+            connection.starttls()
+            connection.login(self.username, self.password)
+        return connection
+
+    @staticmethod
+    def _alive(connection):
+        try:
+            return connection.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    @contextmanager
+    def connection(self):
+        with self._slots:
+            try:
+                connection = self._idle.get_nowait()
+                if not self._alive(connection):
+                    connection = self._connect()
+            except queue.Empty:
+                connection = self._connect()
+            try:
+                yield connection
+            except Exception:
+                self._discard(connection)
+                raise
+            self._idle.put(connection)
+
+    def send(self, message: EmailMessage):
+        with self.connection() as connection:
+            connection.send_message(message)
+
+    @staticmethod
+    def _discard(connection):
+        try:
+            connection.close()
+        except OSError:
+            pass
+
+    def close(self):
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                connection.quit()
+            except (smtplib.SMTPException, OSError):
+                self._discard(connection)
+
+
+# claim a batch of due messages: the lease keeps other workers away while they are sent
+def claim_due_messages(db: Session, batch_size: int):
+    now = datetime.utcnow()
+    messages = (
+        db.query(OutboxMessage)
+        .filter(OutboxMessage.status == "pending", OutboxMessage.next_attempt_at <= now)
+        .order_by(OutboxMessage.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    claimed = []
+    for message in messages:
+        message.attempts += 1
+        message.next_attempt_at = now + MAIL_CLAIM_LEASE
+        claimed.append(
+            (message.id, message.recipient, message.subject, message.body, message.attempts)
+        )
+    db.commit()
+    return claimed
+
+
+def _email(recipient: str, subject: str, body: str):
+    message = EmailMessage()
+    message["From"] = MAIL_FROM
+    message["To"] = recipient
+    message["Subject"] = subject
+    message.set_content(body)
+    return message
+
+
+# deliver one batch, returns the number of messages processed
+def drain_outbox(
+    session_factory,
+    pool: SMTPPool,
+    batch_size: int = MAIL_BATCH_SIZE,
+    max_attempts: int = MAIL_MAX_ATTEMPTS,
+    executor: ThreadPoolExecutor = None,
+):
+    with session_factory() as db:
+        claimed = claim_due_messages(db, batch_size)
+    if not claimed:
+        return 0
+
+    def deliver(item):
+        _, recipient, subject, body, _ = item
+        try:
+            pool.send(_email(recipient, subject, body))
+            return None
+        except (smtplib.SMTPException, OSError) as error:
+            return repr(error)
+
+    if executor is not None:
+        errors = list(executor.map(deliver, claimed))
+    else:
+        errors = [deliver(item) for item in claimed]
+
+    now = datetime.utcnow()
+    with session_factory() as db:
+        sent = [item[0] for item, error in zip(claimed, errors) if error is None]
+        if sent:
+            db.execute(
+                update(OutboxMessage)
+                .where(OutboxMessage.id.in_(sent))
+                .values(status="sent", sent_at=now, last_error=None)
+            )
+        for (message_id, _, _, _, attempts), error in zip(claimed, errors):
+            if error is None:
+                continue
+            logger.warning("mail %s failed (attempt %s): %s", message_id, attempts, error)
+            values = {"last_error": error}
+            if attempts >= max_attempts:
+                values["status"] = "failed"
+            else:
+                delay = MAIL_RETRY_BASE_SECONDS * 2 ** (attempts - 1)
+                values["next_attempt_at"] = now + timedelta(seconds=delay)
+            db.execute(
+                update(OutboxMessage)
+                .where(OutboxMessage.id == message_id)
+                .values(**values)
+            )
+        db.commit()
+    return len(claimed)
+
+
+class OutboxWorker:
+    def __init__(
+        self,
+        session_factory,
+        pool: SMTPPool = None,
+        batch_size: int = MAIL_BATCH_SIZE,
+        poll_seconds: float = MAIL_POLL_SECONDS,
+    ):
+        self.session_factory = session_factory
+        self.pool = pool or SMTPPool()
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = ThreadPoolExecutor(max_workers=self.pool.size)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="outbox-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._executor.shutdown()
+        self.pool.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                processed = drain_outbox(
+                    self.session_factory,
+                    self.pool,
+                    self.batch_size,
+                    executor=self._executor,
+                )
+            except Exception:
+                logger.exception("outbox worker failed, retrying")
+                processed = 0
+            # keep draining while batches are full, otherwise wait for new messages
+            if processed < self.batch_size:
+                self._stop.wait(self.poll_seconds)
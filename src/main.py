@@ -1,11 +1,84 @@
+import logging
+from contextlib import asynccontextmanager
+
 # import fastapi
 from fastapi import FastAPI
 
 # import the endpoints module
 import endpoints
+from database import SessionLocal
+from compression import CompressionMiddleware
+from profiling import ProfilingMiddleware
+from slowlog import QueryRouteMiddleware
+from mailer import OutboxWorker, MAIL_WORKER_ENABLED
+from revocation import revocation_store
+from groupcommit import group_committer, GROUP_COMMIT_ENABLED
+from snapshot import load_snapshot, write_snapshot, CATALOG_SNAPSHOT_PATH
+from repricing import RepriceWorker, REPRICE_WORKER_ENABLED
+from idempotency import IdempotencyMiddleware
+from eventlog import event_log, EVENT_LOG_ENABLED
+from changefeed import ChangeSequencer, CHANGE_SEQUENCER_ENABLED
+
+logger = logging.getLogger(__name__)
+
+
+# load the in-memory state needed by the endpoints before serving requests
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    revocation_store.start(SessionLocal)
+    # warm start: the catalog written by the previous workers, if it is still current
+    if CATALOG_SNAPSHOT_PATH:
+        with SessionLocal() as db:
+            load_snapshot(db, CATALOG_SNAPSHOT_PATH)
+    # deliver queued e-mail in the background
+    outbox_worker = OutboxWorker(SessionLocal) if MAIL_WORKER_ENABLED else None
+    if outbox_worker is not None:
+        outbox_worker.start()
+    # reprice active subscriptions after magazine price changes
+    reprice_worker = RepriceWorker(SessionLocal) if REPRICE_WORKER_ENABLED else None
+    if reprice_worker is not None:
+        reprice_worker.start()
+    # number committed changes for the change feed, so polls stay read-only
+    change_sequencer = ChangeSequencer(SessionLocal) if CHANGE_SEQUENCER_ENABLED else None
+    if change_sequencer is not None:
+        change_sequencer.start()
+    # append subscription events to the event log in the background
+    if EVENT_LOG_ENABLED:
+        event_log.start()
+    # batch concurrent subscription writes into shared transactions
+    if GROUP_COMMIT_ENABLED:
+        group_committer.start(SessionLocal)
+    yield
+    group_committer.stop()
+    # after the writers, so their last events are written
+    event_log.stop()
+    if outbox_worker is not None:
+        outbox_worker.stop()
+    if reprice_worker is not None:
+        reprice_worker.stop()
+    if change_sequencer is not None:
+        change_sequencer.stop()
+    revocation_store.stop()
+    if CATALOG_SNAPSHOT_PATH:
+        try:
+            with SessionLocal() as db:
+                write_snapshot(db, CATALOG_SNAPSHOT_PATH)
+        except Exception:
+            logger.exception("writing the catalog snapshot failed")
+
 
 # Create an instance of FastAPI
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+# replays responses of POSTs retried with the same Idempotency-Key (innermost, so stored
+# responses are uncompressed)
+app.add_middleware(IdempotencyMiddleware)
+# compress responses for clients that accept gzip or brotli
+app.add_middleware(CompressionMiddleware)
+# per-request profiling, off unless PROFILING_ENABLED is set
+app.add_middleware(ProfilingMiddleware)
+# lets the slow query log attribute statements to the route that issued them
+app.add_middleware(QueryRouteMiddleware)
 
 # include the endpoint router
 app.include_router(endpoints.router)
@@ -0,0 +1,397 @@
+# online schema changes for large tables, registered as alembic operations (alembic/env.py
+# imports this module, so every revision can use them):
+#
+#   op.create_index_concurrently("ix_subscriptions_user_id", "subscriptions", ["user_id"])
+#   op.drop_index_concurrently("ix_subscriptions_user_id", "subscriptions")
+#   op.backfill("subscriptions_status", "subscriptions", {"status": "'active'"},
+#               where="status IS NULL")
+#
+# Indexes are built with CREATE INDEX CONCURRENTLY on PostgreSQL, outside the revision's
+# transaction, so writes go on while they build; an INVALID index left by an interrupted build
+# is dropped and built again. Backfills UPDATE in keyset batches of batch_size rows, each in its
+# own short transaction that also checkpoints the last id in migration_checkpoints, so an
+# interrupted upgrade resumes where it stopped; `pause` seconds between batches throttle them.
+# Their values and where clause must be safe to apply twice (a batch committed just before a
+# crash is not re-applied, but rows written concurrently by the app are not excluded either).
+#
+# With `alembic -x dry_run=1 upgrade head` the operations log an estimate of their duration from
+# the table statistics instead of running, and env.py rolls the whole upgrade back. Autogenerate
+# writes create_index_concurrently / drop_index_concurrently for indexes on existing tables.
+import logging
+import os
+import time
+from datetime import datetime
+
+import sqlalchemy as sa
+from alembic.autogenerate import renderers
+from alembic.operations import MigrateOperation, Operations, ops
+
+from models import MigrationCheckpoint
+
+logger = logging.getLogger(__name__)
+
+# rough throughput used by dry runs, calibrate per environment
+MIGRATION_BACKFILL_ROWS_PER_SECOND = float(
+    os.getenv("MIGRATION_BACKFILL_ROWS_PER_SECOND", "20000")
+)
+MIGRATION_INDEX_ROWS_PER_SECOND = float(os.getenv("MIGRATION_INDEX_ROWS_PER_SECOND", "200000"))
+# DDL gives up instead of queueing every write behind it while it waits for its lock
+MIGRATION_LOCK_TIMEOUT = os.getenv("MIGRATION_LOCK_TIMEOUT", "5s")
+MIGRATION_BACKFILL_BATCH = 1000
+
+
+def _is_dry_run(operations):
+    return bool(operations.get_context().opts.get("dry_run"))
+
+
+def _duration(seconds: float):
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m" if hours else f"{minutes}m {seconds:02d}s"
+
+
+# row count from the planner statistics (PostgreSQL) or ANALYZE results (SQLite), counted
+# when the table has none
+def estimate_rows(bind, table_name: str):
+    dialect = bind.dialect.name
+    estimate = None
+    if dialect == "postgresql":
+        estimate = bind.execute(
+            sa.text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table)"),
+            {"table": table_name},
+        ).scalar()
+        # -1: never analyzed
+        if estimate is not None and estimate < 0:
+            estimate = None
+    elif dialect == "sqlite":
+        has_stats = bind.execute(
+            sa.text("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+        ).scalar()
+        if has_stats:
+            stat = bind.execute(
+                sa.text("SELECT stat FROM sqlite_stat1 WHERE tbl = :table LIMIT 1"),
+                {"table": table_name},
+            ).scalar()
+            if stat:
+                estimate = int(stat.split()[0])
+    if estimate is None:
+        estimate = bind.execute(
+            sa.select(sa.func.count()).select_from(sa.table(table_name))
+        ).scalar()
+    return int(estimate)
+
+
+def _log_estimate(operations, what: str, table_name: str, rows_per_second: float, pauses=0.0):
+    rows = estimate_rows(operations.get_bind(), table_name)
+    seconds = rows / rows_per_second + pauses * rows
+    logger.info(
+        "dry run: %s on %s (~%s rows) would take ~%s", what, table_name, rows, _duration(seconds)
+    )
+    return rows, seconds
+
+
+@Operations.register_operation("create_index_concurrently")
+class CreateIndexConcurrentlyOp(MigrateOperation):
+    def __init__(self, index_name, table_name, columns, unique=False, where=None):
+        self.index_name = index_name
+        self.table_name = table_name
+        self.columns = list(columns)
+        self.unique = unique
+        # partial index predicate (SQL)
+        self.where = where
+
+    @classmethod
+    def create_index_concurrently(
+        cls, operations, index_name, table_name, columns, unique=False, where=None
+    ):
+        return operations.invoke(cls(index_name, table_name, columns, unique, where))
+
+    def reverse(self):
+        return DropIndexConcurrentlyOp(
+            self.index_name, self.table_name, self.columns, self.unique, self.where
+        )
+
+
+@Operations.register_operation("drop_index_concurrently")
+class DropIndexConcurrentlyOp(MigrateOperation):
+    # columns, unique and where are only kept to reverse the operation
+    def __init__(self, index_name, table_name, columns=(), unique=False, where=None):
+        self.index_name = index_name
+        self.table_name = table_name
+        self.columns = list(columns)
+        self.unique = unique
+        self.where = where
+
+    @classmethod
+    def drop_index_concurrently(cls, operations, index_name, table_name):
+        return operations.invoke(cls(index_name, table_name))
+
+    def reverse(self):
+        return CreateIndexConcurrentlyOp(
+            self.index_name, self.table_name, self.columns, self.unique, self.where
+        )
+
+
+@Operations.register_operation("backfill")
+class BackfillOp(MigrateOperation):
+    def __init__(
+        self,
+        name,
+        table_name,
+        values,
+        where=None,
+        batch_size=MIGRATION_BACKFILL_BATCH,
+        pause=0.0,
+    ):
+        # checkpoint name, unique across revisions
+        self.name = name
+        self.table_name = table_name
+        # column -> SQL expression, e.g. {"status": "'active'"}
+        self.values = values
+        self.where = where
+        self.batch_size = batch_size
+        self.pause = pause
+
+    @classmethod
+    def backfill(
+        cls,
+        operations,
+        name,
+        table_name,
+        values,
+        where=None,
+        batch_size=MIGRATION_BACKFILL_BATCH,
+        pause=0.0,
+    ):
+        return operations.invoke(cls(name, table_name, values, where, batch_size, pause))
+
+
+@Operations.implementation_for(CreateIndexConcurrentlyOp)
+def create_index_concurrently(operations, operation):
+    if _is_dry_run(operations):
+        _log_estimate(
+            operations,
+            f"creating index {operation.index_name}",
+            operation.table_name,
+            MIGRATION_INDEX_ROWS_PER_SECOND,
+        )
+        return
+    where = sa.text(operation.where) if operation.where is not None else None
+    context = operations.get_context()
+    if context.dialect.name != "postgresql":
+        operations.create_index(
+            operation.index_name,
+            operation.table_name,
+            operation.columns,
+            unique=operation.unique,
+            sqlite_where=where,
+            if_not_exists=True,
+        )
+        return
+    with context.autocommit_block():
+        if not context.as_sql:
+            # left INVALID by an interrupted build, IF NOT EXISTS would keep it
+            invalid = operations.get_bind().execute(
+                sa.text(
+                    "SELECT 1 FROM pg_index WHERE indexrelid = to_regclass(:index) "
+                    "AND NOT indisvalid"
+                ),
+                {"index": operation.index_name},
+            ).scalar()
+            if invalid:
+                operations.drop_index(
+                    operation.index_name,
+                    operation.table_name,
+                    postgresql_concurrently=True,
+                    if_exists=True,
+                )
+        operations.create_index(
+            operation.index_name,
+            operation.table_name,
+            operation.columns,
+            unique=operation.unique,
+            postgresql_where=where,
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+@Operations.implementation_for(DropIndexConcurrentlyOp)
+def drop_index_concurrently(operations, operation):
+    if _is_dry_run(operations):
+        logger.info("dry run: dropping index %s", operation.index_name)
+        return
+    context = operations.get_context()
+    if context.dialect.name != "postgresql":
+        operations.drop_index(operation.index_name, operation.table_name, if_exists=True)
+        return
+    with context.autocommit_block():
+        operations.drop_index(
+            operation.index_name,
+            operation.table_name,
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+
+
+def _backfill_statement(operation):
+    table = sa.table(
+        operation.table_name, sa.column("id"), *(sa.column(name) for name in operation.values)
+    )
+    values = {
+        name: sa.literal_column(value) if isinstance(value, str) else value
+        for name, value in operation.values.items()
+    }
+    criteria = [sa.text(operation.where)] if operation.where is not None else []
+    return table, sa.update(table).values(values), criteria
+
+
+# run the batches after the checkpoint on their own connection, returns the rows updated
+def run_backfill(engine, operation):
+    table, statement, criteria = _backfill_statement(operation)
+    checkpoints = MigrationCheckpoint.__table__
+    with engine.begin() as connection:
+        checkpoint = connection.execute(
+            sa.select(checkpoints).where(checkpoints.c.name == operation.name)
+        ).first()
+        if checkpoint is None:
+            connection.execute(
+                sa.insert(checkpoints).values(
+                    name=operation.name, last_id=0, rows=0, done=False, updated_at=datetime.utcnow()
+                )
+            )
+            last_id, rows = 0, 0
+        elif checkpoint.done:
+            logger.info("backfill %s already done (%s rows)", operation.name, checkpoint.rows)
+            return checkpoint.rows
+        else:
+            last_id, rows = checkpoint.last_id, checkpoint.rows
+            logger.info("backfill %s resumes after id %s", operation.name, last_id)
+    while True:
+        start = time.perf_counter()
+        with engine.begin() as connection:
+            # the batch ends at the batch_size-th id after the checkpoint, the last one at the
+            # end of the table (rows inserted after it are the application's to write)
+            upper = connection.execute(
+                sa.select(table.c.id)
+                .where(table.c.id > last_id)
+                .order_by(table.c.id)
+                .offset(operation.batch_size - 1)
+                .limit(1)
+            ).scalar()
+            done = upper is None
+            if done:
+                upper = connection.execute(
+                    sa.select(sa.func.max(table.c.id)).where(table.c.id > last_id)
+                ).scalar()
+            if upper is not None:
+                rows += connection.execute(
+                    statement.where(table.c.id > last_id, table.c.id <= upper, *criteria)
+                ).rowcount
+                last_id = upper
+            connection.execute(
+                sa.update(checkpoints)
+                .where(checkpoints.c.name == operation.name)
+                .values(last_id=last_id, rows=rows, done=done, updated_at=datetime.utcnow())
+            )
+        logger.info(
+            "backfill %s: %s rows up to id %s (batch %.0f ms)",
+            operation.name,
+            rows,
+            last_id,
+            (time.perf_counter() - start) * 1000,
+        )
+        if done:
+            return rows
+        if operation.pause:
+            time.sleep(operation.pause)
+
+
+@Operations.implementation_for(BackfillOp)
+def backfill(operations, operation):
+    if _is_dry_run(operations):
+        _log_estimate(
+            operations,
+            f"backfill {operation.name} (at most, every row matching)",
+            operation.table_name,
+            MIGRATION_BACKFILL_ROWS_PER_SECOND,
+            operation.pause / operation.batch_size,
+        )
+        return
+    context = operations.get_context()
+    if context.as_sql:
+        # a script is run by hand, as one statement
+        _, statement, criteria = _backfill_statement(operation)
+        operations.execute(statement.where(*criteria))
+        return
+    # commits what the revision did so far, so the batches see it and do not wait for its locks
+    with context.autocommit_block():
+        run_backfill(operations.get_bind().engine, operation)
+
+
+@renderers.dispatch_for(CreateIndexConcurrentlyOp)
+def render_create_index_concurrently(autogen_context, operation):
+    arguments = [repr(operation.index_name), repr(operation.table_name), repr(operation.columns)]
+    if operation.unique:
+        arguments.append("unique=True")
+    if operation.where is not None:
+        arguments.append(f"where={operation.where!r}")
+    return f"op.create_index_concurrently({', '.join(arguments)})"
+
+
+@renderers.dispatch_for(DropIndexConcurrentlyOp)
+def render_drop_index_concurrently(autogen_context, operation):
+    return (
+        f"op.drop_index_concurrently({operation.index_name!r}, {operation.table_name!r})"
+    )
+
+
+def _online_index_op(operation, new_tables: set):
+    if operation.table_name in new_tables:
+        return operation
+    if isinstance(operation, ops.CreateIndexOp):
+        # expression indexes are left to plain create_index
+        if not all(isinstance(column, str) for column in operation.columns):
+            return operation
+        where = operation.kw.get("postgresql_where")
+        return CreateIndexConcurrentlyOp(
+            operation.index_name,
+            operation.table_name,
+            operation.columns,
+            operation.unique,
+            str(where) if where is not None else None,
+        )
+    if isinstance(operation, ops.DropIndexOp):
+        return DropIndexConcurrentlyOp(operation.index_name, operation.table_name)
+    return operation
+
+
+def _rewrite(container, new_tables: set):
+    for i, operation in enumerate(container.ops):
+        if isinstance(operation, ops.OpContainer):
+            _rewrite(operation, new_tables)
+        else:
+            container.ops[i] = _online_index_op(operation, new_tables)
+
+
+# process_revision_directives hook: autogenerated indexes on existing tables are built and
+# dropped concurrently (tables created or dropped in the same revision keep plain ones)
+def online_revision_directives(context, revision, directives):
+    for script in directives:
+        for upgrade_ops, downgrade_ops in zip(script.upgrade_ops_list, script.downgrade_ops_list):
+            new_tables = {
+                operation.table_name
+                for operation in upgrade_ops.ops + downgrade_ops.ops
+                if isinstance(operation, (ops.CreateTableOp, ops.DropTableOp))
+            }
+            _rewrite(upgrade_ops, new_tables)
+            _rewrite(downgrade_ops, new_tables)
+
+
+# statement run on the migration connection before the revisions
+def lock_timeout_statement(dialect_name: str):
+    if dialect_name == "postgresql" and MIGRATION_LOCK_TIMEOUT:
+        return sa.text(f"SET lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'")
+    return None
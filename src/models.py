@@ -1,7 +1,9 @@
 from sqlalchemy import Column, Integer, String, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Float, Boolean
+from sqlalchemy import Column, Integer, String, Float, Boolean, LargeBinary
+from sqlalchemy import Index, text
+from sqlalchemy import DDL, event
 
 # Base Model
 Base = declarative_base()
@@ -51,6 +53,10 @@ class Magazine(Base):
     discount_quarterly = Column(Float)
     discount_half_yearly = Column(Float)
     discount_annual = Column(Float)
+    # optimistic concurrency (see versioning.py)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version}
 
     def __repr__(self):
         return f"<Magazine {self.name}>"
@@ -59,6 +65,46 @@ class Magazine(Base):
         return self.name
 
 
+# full-text search over magazine names (weighted higher) and descriptions: an expression GIN
+# index on PostgreSQL, an external content FTS5 table kept in sync by triggers on SQLite
+MAGAZINE_SEARCH_VECTOR = (
+    "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'B')"
+)
+MAGAZINE_SEARCH_DDL = {
+    "postgresql": [
+        f"CREATE INDEX IF NOT EXISTS ix_magazines_search ON magazines "
+        f"USING gin (({MAGAZINE_SEARCH_VECTOR}))",
+    ],
+    "sqlite": [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS magazines_fts USING fts5("
+        "name, description, content='magazines', content_rowid='id', "
+        "tokenize='porter unicode61')",
+        "CREATE TRIGGER IF NOT EXISTS magazines_fts_insert AFTER INSERT ON magazines BEGIN "
+        "INSERT INTO magazines_fts(rowid, name, description) "
+        "VALUES (new.id, new.name, new.description); END",
+        "CREATE TRIGGER IF NOT EXISTS magazines_fts_delete AFTER DELETE ON magazines BEGIN "
+        "INSERT INTO magazines_fts(magazines_fts, rowid, name, description) "
+        "VALUES ('delete', old.id, old.name, old.description); END",
+        "CREATE TRIGGER IF NOT EXISTS magazines_fts_update AFTER UPDATE ON magazines BEGIN "
+        "INSERT INTO magazines_fts(magazines_fts, rowid, name, description) "
+        "VALUES ('delete', old.id, old.name, old.description); "
+        "INSERT INTO magazines_fts(rowid, name, description) "
+        "VALUES (new.id, new.name, new.description); END",
+    ],
+}
+for dialect, statements in MAGAZINE_SEARCH_DDL.items():
+    for statement in statements:
+        event.listen(
+            Magazine.__table__, "after_create", DDL(statement).execute_if(dialect=dialect)
+        )
+event.listen(
+    Magazine.__table__,
+    "before_drop",
+    DDL("DROP TABLE IF EXISTS magazines_fts").execute_if(dialect="sqlite"),
+)
+
+
 class Plan(Base):
     __tablename__ = "plans"
 
@@ -73,9 +119,55 @@ class Plan(Base):
     def __str__(self):
         return self.title
 
+# The plans a magazine offers, with the discount (a decimal) and the effective price of a full
+# renewal period (base_price * renewal_period * (1 - discount)), kept in sync by catalog.py.
+# Plans without a row here are not offered by that magazine.
+class MagazinePlan(Base):
+    __tablename__ = "magazine_plans"
+
+    magazine_id = Column(Integer, primary_key=True)
+    plan_id = Column(Integer, primary_key=True, index=True)
+    discount = Column(Float, default=0.0)
+    price = Column(Float)
+
+    def __repr__(self):
+        return f"<MagazinePlan {self.magazine_id}:{self.plan_id}>"
+
+    def __str__(self):
+        return f"{self.magazine_id}:{self.plan_id}"
+
+
 # A subscription tracks which plan is associated with which magazine for that user. The subscription also tracks the price at renewal for that magazine and the next renewal date. For record keeping purposes, subscriptions are never deleted. If a user cancels a subscription to a magazine, the corresponding `is_active` attribute is set to `False`. Inactive subscriptions are never returned in the response when the user queries their subscriptions.
+# A user has at most one active subscription per magazine, enforced by a partial unique index
+# that is also used to look up the current subscription. A modification links the new row to the
+# one it replaces through previous_subscription_id.
 class Subscription(Base):
     __tablename__ = "subscriptions"
+    __table_args__ = (
+        Index(
+            "uq_subscriptions_active_user_magazine",
+            "user_id",
+            "magazine_id",
+            unique=True,
+            postgresql_where=text("is_active"),
+            sqlite_where=text("is_active"),
+        ),
+        # active subscriptions of a magazine in id order, for keyset chunks (see repricing.py)
+        Index(
+            "ix_subscriptions_active_magazine_id",
+            "magazine_id",
+            "id",
+            postgresql_where=text("is_active"),
+            sqlite_where=text("is_active"),
+        ),
+        # candidates for archiving (see archive.py)
+        Index(
+            "ix_subscriptions_inactive_deactivated_at",
+            "deactivated_at",
+            postgresql_where=text("NOT is_active"),
+            sqlite_where=text("NOT is_active"),
+        ),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer)
@@ -84,9 +176,274 @@ class Subscription(Base):
     price = Column(Float)
     next_renewal_date = Column(DateTime)
     is_active = Column(Boolean, default=True)
+    previous_subscription_id = Column(Integer, index=True)
+    deactivated_at = Column(DateTime)
+    # optimistic concurrency (see versioning.py)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version}
 
     def __repr__(self):
         return f"<Subscription {self.id}>"
 
     def __str__(self):
-        return self.id
\ No newline at end of file
+        return self.id
+
+
+# Inactive subscriptions moved out of the subscriptions table after the retention window
+# (see archive.py). Same columns, ids are kept so replacement chains stay intact.
+class SubscriptionArchive(Base):
+    __tablename__ = "subscriptions_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, index=True)
+    magazine_id = Column(Integer)
+    plan_id = Column(Integer)
+    price = Column(Float)
+    next_renewal_date = Column(DateTime)
+    is_active = Column(Boolean, default=False)
+    previous_subscription_id = Column(Integer, index=True)
+    deactivated_at = Column(DateTime)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<SubscriptionArchive {self.id}>"
+
+    def __str__(self):
+        return str(self.id)
+
+
+# Transactional outbox for e-mail: messages are written in the same transaction as the change
+# that triggers them and delivered by a background worker (see mailer.py).
+class OutboxMessage(Base):
+    __tablename__ = "outbox"
+    __table_args__ = (
+        Index(
+            "ix_outbox_pending_next_attempt_at",
+            "next_attempt_at",
+            postgresql_where=text("status = 'pending'"),
+            sqlite_where=text("status = 'pending'"),
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String)
+    recipient = Column(String)
+    subject = Column(String)
+    body = Column(String)
+    status = Column(String, default="pending")
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    last_error = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime)
+
+    def __repr__(self):
+        return f"<OutboxMessage {self.id} {self.kind}>"
+
+    def __str__(self):
+        return self.subject
+
+
+# Repricing of the active subscriptions of a magazine after its prices changed, run in keyset
+# chunks by a background worker (see repricing.py). last_id is the position reached, committed
+# with every chunk, so an interrupted job resumes there once its lease (next_attempt_at) ends.
+class RepriceJob(Base):
+    __tablename__ = "reprice_jobs"
+    __table_args__ = (
+        Index(
+            "ix_reprice_jobs_unfinished_next_attempt_at",
+            "next_attempt_at",
+            postgresql_where=text("status != 'done'"),
+            sqlite_where=text("status != 'done'"),
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    magazine_id = Column(Integer, index=True)
+    status = Column(String, default="pending")
+    # subscriptions to reprice when the job started, and repriced so far
+    total = Column(Integer)
+    updated = Column(Integer, default=0)
+    last_id = Column(Integer)
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    last_error = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+    def __repr__(self):
+        return f"<RepriceJob {self.id} magazine {self.magazine_id}>"
+
+    def __str__(self):
+        return str(self.id)
+
+
+# Responses of POSTs sent with an Idempotency-Key (see idempotency.py). A row is claimed
+# ("in_progress", locked until locked_until) before the request runs and completed with its
+# response, which retries with the same key and request hash get replayed until expires_at.
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    key = Column(String, primary_key=True)
+    request_hash = Column(String)
+    status = Column(String, default="in_progress")
+    response_status = Column(Integer)
+    response_headers = Column(String)
+    response_body = Column(LargeBinary)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    locked_until = Column(DateTime)
+    expires_at = Column(DateTime, index=True)
+
+    def __repr__(self):
+        return f"<IdempotencyKey {self.key}>"
+
+    def __str__(self):
+        return self.key
+
+
+# Per-user aggregate of the active subscriptions, served by GET /users/me/summary with one
+# primary key read. The subscription writes refresh the rows of the users they touch in their
+# own transaction and a rebuild job corrects drift (see summaries.py).
+class SubscriptionSummary(Base):
+    __tablename__ = "subscription_summaries"
+
+    user_id = Column(Integer, primary_key=True)
+    active_count = Column(Integer, nullable=False, default=0, server_default="0")
+    next_renewal_date = Column(DateTime)
+    # sum of the active subscriptions' prices per month of their plan
+    monthly_spend = Column(Float, nullable=False, default=0.0, server_default="0")
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<SubscriptionSummary {self.user_id}>"
+
+
+# progress of a batched backfill in a migration (see migrations.py)
+class MigrationCheckpoint(Base):
+    __tablename__ = "migration_checkpoints"
+
+    name = Column(String, primary_key=True)
+    # highest id backfilled
+    last_id = Column(Integer, nullable=False, default=0, server_default="0")
+    rows = Column(Integer, nullable=False, default=0, server_default="0")
+    done = Column(Boolean, nullable=False, default=False, server_default=text("false"))
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<MigrationCheckpoint {self.name}>"
+
+    def __str__(self):
+        return self.name
+
+
+# Revoked tokens. The key is a token jti, a refresh token family or a user subject
+# (see revocation.py); tokens issued at or before revoked_at are rejected. A jti is revoked
+# at most once (partial unique index): refresh token rotation claims it atomically.
+class RevokedToken(Base):
+    __tablename__ = "revoked_tokens"
+
+    id = Column(Integer, primary_key=True, index=True)
+    key = Column(String, index=True)
+    revoked_at = Column(DateTime, default=datetime.utcnow, index=True)
+    expires_at = Column(DateTime, index=True)
+
+    __table_args__ = (
+        Index(
+            "uq_revoked_tokens_jti",
+            "key",
+            unique=True,
+            postgresql_where=text("key LIKE 'jti:%'"),
+            sqlite_where=text("key LIKE 'jti:%'"),
+        ),
+    )
+
+    def __repr__(self):
+        return f"<RevokedToken {self.key}>"
+
+    def __str__(self):
+        return self.key
+
+
+# Single row (id = 1) version stamp of the catalog (magazines and plans). Every write to
+# the catalog bumps it in the same transaction, caches are keyed by it (see catalog.py).
+class CatalogVersion(Base):
+    __tablename__ = "catalog_versions"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<CatalogVersion {self.version}>"
+
+    def __str__(self):
+        return str(self.version)
+
+
+# Change feed (see changefeed.py): triggers on users, magazines and subscriptions add a row
+# for every inserted, updated or deleted row in the writing transaction. seq numbers them in
+# commit order and is NULL until the change was sequenced.
+class Change(Base):
+    __tablename__ = "changes"
+
+    id = Column(Integer, primary_key=True)
+    seq = Column(Integer, unique=True, index=True)
+    entity = Column(String, nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    operation = Column(String, nullable=False)
+    changed_at = Column(DateTime)
+
+    __table_args__ = (
+        Index(
+            "ix_changes_unsequenced_id",
+            "id",
+            postgresql_where=text("seq IS NULL"),
+            sqlite_where=text("seq IS NULL"),
+        ),
+    )
+
+    def __repr__(self):
+        return f"<Change {self.entity} {self.entity_id} {self.operation}>"
+
+    def __str__(self):
+        return f"{self.entity} {self.entity_id} {self.operation}"
+
+
+# table -> entity name in the change feed
+CHANGE_FEED_TABLES = {"users": "user", "magazines": "magazine", "subscriptions": "subscription"}
+CHANGE_FEED_FUNCTION = (
+    "CREATE OR REPLACE FUNCTION record_change() RETURNS trigger AS $$ BEGIN "
+    "INSERT INTO changes (entity, entity_id, operation, changed_at) VALUES (TG_ARGV[0], "
+    "CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END, lower(TG_OP), "
+    "now() AT TIME ZONE 'utc'); "
+    "RETURN NULL; END $$ LANGUAGE plpgsql"
+)
+
+
+def change_feed_ddl(table: str):
+    entity = CHANGE_FEED_TABLES[table]
+    # (% is escaped in DDL statements)
+    sqlite = [
+        f"CREATE TRIGGER IF NOT EXISTS {table}_change_{operation} AFTER {operation.upper()} "
+        f"ON {table} BEGIN INSERT INTO changes (entity, entity_id, operation, changed_at) "
+        f"VALUES ('{entity}', {row}.id, '{operation}', "
+        f"strftime('%%Y-%%m-%%d %%H:%%M:%%f', 'now')); END"
+        for operation, row in (("insert", "new"), ("update", "new"), ("delete", "old"))
+    ]
+    postgresql = [
+        CHANGE_FEED_FUNCTION,
+        f"CREATE OR REPLACE TRIGGER {table}_change AFTER INSERT OR UPDATE OR DELETE "
+        f"ON {table} FOR EACH ROW EXECUTE FUNCTION record_change('{entity}')",
+    ]
+    return {"postgresql": postgresql, "sqlite": sqlite}
+
+
+for model in (User, Magazine, Subscription):
+    for dialect, statements in change_feed_ddl(model.__tablename__).items():
+        for statement in statements:
+            event.listen(
+                model.__table__, "after_create", DDL(statement).execute_if(dialect=dialect)
+            )
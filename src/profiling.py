@@ -0,0 +1,206 @@
+# on-demand request profiling. With PROFILING_ENABLED=1 an admin can profile a single request
+# by sending X-Profile: cprofile|sample (or ?profile=cprofile|sample) together with the admin
+# token, and PROFILING_SAMPLE_RATE profiles that fraction of ordinary traffic with the
+# sampler. Results go to PROFILING_DIR as pstats (cprofile) and collapsed stacks that
+# flamegraph.pl / speedscope read directly; the file name is returned in X-Profile-Id.
+import contextvars
+import cProfile
+import functools
+import hmac
+import inspect
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from urllib.parse import parse_qs
+
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+
+from utils import ADMIN_TOKEN
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0") == "1"
+PROFILING_DIR = os.getenv("PROFILING_DIR", "./profiles")
+# fraction of requests profiled by the sampler without being asked for
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+# seconds between two stack samples
+PROFILING_INTERVAL = float(os.getenv("PROFILING_INTERVAL", "0.005"))
+# traffic sampling never profiles more requests than this at once
+PROFILING_MAX_ACTIVE = 4
+PROFILE_MODES = ("cprofile", "sample")
+
+# profile session of the request being handled
+current_profile = contextvars.ContextVar("current_profile", default=None)
+# one deterministic profiler at a time, concurrent requests fall back to the sampler
+_cprofile_lock = threading.Lock()
+
+
+class ProfileSession:
+    def __init__(self, mode: str, name: str):
+        self.mode = mode
+        self.name = name
+        self.profile = None
+        self.threads = set()
+        self.stacks = Counter()
+
+    def write(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.name)
+        if self.profile is not None:
+            self.profile.dump_stats(f"{path}.pstats")
+        with open(f"{path}.collapsed", "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+# run an endpoint inside a profile session, in the thread that executes it
+def _profiled_call(session: ProfileSession, call, args, kwargs):
+    thread_id = threading.get_ident()
+    session.threads.add(thread_id)
+    try:
+        if session.mode == "cprofile" and _cprofile_lock.acquire(blocking=False):
+            try:
+                session.profile = cProfile.Profile()
+                return session.profile.runcall(call, *args, **kwargs)
+            finally:
+                _cprofile_lock.release()
+        return call(*args, **kwargs)
+    finally:
+        session.threads.discard(thread_id)
+
+
+# stacks are cut at _profiled_call so they start at the endpoint
+def collapse(frame):
+    stack = []
+    while frame is not None and frame.f_code is not _profiled_call.__code__:
+        code = frame.f_code
+        stack.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        )
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class Sampler:
+    # a single thread that samples the stacks of every thread running a profiled endpoint
+    def __init__(self, interval: float = PROFILING_INTERVAL):
+        self.interval = interval
+        self._sessions = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    # register a session, bounded sessions are refused when PROFILING_MAX_ACTIVE are running
+    def add(self, session: ProfileSession, bounded: bool = False):
+        with self._lock:
+            if bounded and len(self._sessions) >= PROFILING_MAX_ACTIVE:
+                return False
+            self._sessions.add(session)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="profiling-sampler", daemon=True
+                )
+                self._thread.start()
+        self._wake.set()
+        return True
+
+    def remove(self, session: ProfileSession):
+        with self._lock:
+            self._sessions.discard(session)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                sessions = list(self._sessions)
+            if not sessions:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            frames = sys._current_frames()
+            for session in sessions:
+                for thread_id in list(session.threads):
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        session.stacks[collapse(frame)] += 1
+            del frames
+            time.sleep(self.interval)
+
+
+sampler = Sampler()
+
+
+def profiled_endpoint(endpoint):
+    # coroutine endpoints share the event loop thread with other requests, leave them alone
+    if inspect.iscoroutinefunction(endpoint):
+        return endpoint
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        session = current_profile.get()
+        if session is None:
+            return endpoint(*args, **kwargs)
+        return _profiled_call(session, endpoint, args, kwargs)
+
+    return wrapper
+
+
+# route class for the router: endpoints run under the request's profile session, if any
+class ProfiledRoute(APIRoute):
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, profiled_endpoint(endpoint), **kwargs)
+
+
+def requested_mode(scope):
+    headers = Headers(scope=scope)
+    mode = headers.get("x-profile")
+    if mode is None:
+        mode = parse_qs(scope.get("query_string", b"").decode()).get("profile", [None])[0]
+    if mode not in PROFILE_MODES:
+        return None
+    token = headers.get("x-admin-token")
+    if token is None or not hmac.compare_digest(token, ADMIN_TOKEN):
+        return None
+    return mode
+
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not PROFILING_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        mode, bounded = requested_mode(scope), False
+        if mode is None and random.random() < PROFILING_SAMPLE_RATE:
+            mode, bounded = "sample", True
+        if mode is None:
+            await self.app(scope, receive, send)
+            return
+        slug = scope["path"].strip("/").replace("/", "_") or "root"
+        name = (
+            f"{datetime.utcnow():%Y%m%dT%H%M%S}-{scope['method']}-{slug}-"
+            f"{uuid.uuid4().hex[:8]}"
+        )
+        session = ProfileSession(mode, name)
+        if not sampler.add(session, bounded):
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("X-Profile-Id", name)
+            await send(message)
+
+        token = current_profile.set(session)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            current_profile.reset(token)
+            sampler.remove(session)
+            await run_in_threadpool(session.write, PROFILING_DIR)
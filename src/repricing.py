@@ -0,0 +1,198 @@
+# repricing of active subscriptions after a magazine's prices changed: a reprice_jobs row is
+# written in the same transaction as the magazine update (or on demand), and a background
+# worker sets the price of every active subscription of that magazine to the effective price
+# of its plan (magazine_plans) with set-based UPDATEs in keyset chunks. Every chunk is its own
+# short transaction that also records the job's progress, so readers are never blocked for
+# long and an interrupted job resumes after the last committed chunk.
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import Session
+
+from bulk import bulk_update
+from models import MagazinePlan, RepriceJob, Subscription
+from summaries import refresh_summaries
+
+logger = logging.getLogger(__name__)
+
+REPRICE_WORKER_ENABLED = os.getenv("REPRICE_WORKER_ENABLED", "0") == "1"
+# subscriptions updated per chunk (and transaction)
+REPRICE_CHUNK_SIZE = 500
+REPRICE_POLL_SECONDS = 2.0
+# a job is resumed by another worker when its worker did not report progress for this long
+REPRICE_LEASE = timedelta(seconds=60)
+
+
+# effective price of the subscription's plan for its magazine, NULL when no longer offered
+def offering_price():
+    return (
+        select(MagazinePlan.price)
+        .where(
+            MagazinePlan.magazine_id == Subscription.magazine_id,
+            MagazinePlan.plan_id == Subscription.plan_id,
+        )
+        .scalar_subquery()
+    )
+
+
+# active subscriptions of a magazine whose price differs from the offering's
+def stale_prices(magazine_id: int):
+    price = offering_price()
+    return (
+        Subscription.magazine_id == magazine_id,
+        Subscription.is_active == True,
+        price.is_not(None),
+        Subscription.price.is_distinct_from(price),
+    )
+
+
+# queue a job for a magazine (the caller commits)
+def enqueue_reprice(db: Session, magazine_id: int):
+    job = RepriceJob(magazine_id=magazine_id)
+    db.add(job)
+    return job
+
+
+# claim the next due job: pending, or started by a worker whose lease ran out
+def claim_job(db: Session):
+    now = datetime.utcnow()
+    job = (
+        db.query(RepriceJob)
+        .filter(RepriceJob.status != "done", RepriceJob.next_attempt_at <= now)
+        .order_by(RepriceJob.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if job is None:
+        return None
+    job.attempts += 1
+    job.next_attempt_at = now + REPRICE_LEASE
+    if job.status == "pending":
+        job.status = "running"
+        job.started_at = now
+        job.total = db.execute(
+            select(func.count()).where(*stale_prices(job.magazine_id))
+        ).scalar()
+    db.commit()
+    return job.id
+
+
+# record a repriced chunk in the chunk's own transaction and extend the lease
+def _record_progress(db: Session, job_id: int, rows):
+    db.execute(
+        update(RepriceJob)
+        .where(RepriceJob.id == job_id)
+        .values(
+            updated=RepriceJob.updated + len(rows),
+            last_id=max(row[0] for row in rows),
+            next_attempt_at=datetime.utcnow() + REPRICE_LEASE,
+        )
+    )
+
+
+# in the chunk's transaction: its progress and the summaries of the repriced users
+def _reprice_chunk(db: Session, job_id: int, rows):
+    _record_progress(db, job_id, rows)
+    refresh_summaries(db, [row.user_id for row in rows])
+
+
+# run a claimed job to the end, from where it was interrupted; returns the rows updated
+def run_job(db: Session, job_id: int, chunk_size: int = REPRICE_CHUNK_SIZE):
+    job = db.get(RepriceJob, job_id)
+    magazine_id, last_id = job.magazine_id, job.last_id
+    db.commit()
+    try:
+        updated = bulk_update(
+            db,
+            Subscription,
+            {"price": offering_price(), "version": Subscription.version + 1},
+            *stale_prices(magazine_id),
+            chunk_size=chunk_size,
+            returning=(Subscription.user_id,),
+            on_chunk=lambda rows: _reprice_chunk(db, job_id, rows),
+            after_id=last_id,
+        )
+    except Exception as error:
+        db.rollback()
+        # left to be resumed once the lease ends
+        db.execute(
+            update(RepriceJob).where(RepriceJob.id == job_id).values(last_error=repr(error))
+        )
+        db.commit()
+        raise
+    db.execute(
+        update(RepriceJob)
+        .where(RepriceJob.id == job_id)
+        .values(status="done", finished_at=datetime.utcnow(), last_error=None)
+    )
+    db.commit()
+    return len(updated)
+
+
+# claim and run due jobs until there are none, returns the number of jobs run
+def run_due_jobs(session_factory, chunk_size: int = REPRICE_CHUNK_SIZE):
+    jobs = 0
+    while True:
+        with session_factory() as db:
+            job_id = claim_job(db)
+            if job_id is None:
+                return jobs
+            run_job(db, job_id, chunk_size)
+        jobs += 1
+
+
+def job_progress(job: RepriceJob):
+    progress = None
+    if job.status == "done":
+        progress = 1.0
+    elif job.total:
+        progress = round(min(job.updated / job.total, 1.0), 4)
+    return {
+        "id": job.id,
+        "magazine_id": job.magazine_id,
+        "status": job.status,
+        "total": job.total,
+        "updated": job.updated,
+        "progress": progress,
+        "last_id": job.last_id,
+        "attempts": job.attempts,
+        "last_error": job.last_error,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
+
+
+class RepriceWorker:
+    def __init__(self, session_factory, poll_seconds: float = REPRICE_POLL_SECONDS):
+        self.session_factory = session_factory
+        self.poll_seconds = poll_seconds
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="reprice-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                run_due_jobs(self.session_factory)
+            except Exception:
+                logger.exception("reprice worker failed, retrying")
+            self._stop.wait(self.poll_seconds)
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    print(f"ran {run_due_jobs(SessionLocal)} reprice jobs")
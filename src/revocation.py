@@ -0,0 +1,233 @@
+# token revocation: durable revoked_tokens table with an in-memory bloom filter
+# in front of it, so get_current_user only queries the table on a probable hit
+import calendar
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session
+
+from bulk import dialect_insert
+from models import RevokedToken
+
+logger = logging.getLogger(__name__)
+
+# initial bloom filter capacity and target false positive rate
+REVOCATION_FILTER_CAPACITY = 100_000
+REVOCATION_FILTER_ERROR_RATE = 0.001
+# how often (in seconds) a worker picks up revocations made by other workers
+REVOCATION_SYNC_SECONDS = 5
+# overlap when syncing, covers rows committed after their revoked_at timestamp
+REVOCATION_SYNC_LOOKBACK = timedelta(seconds=30)
+# how often (in seconds) rows of expired tokens are deleted (one row is added per refresh)
+REVOCATION_PURGE_SECONDS = float(os.getenv("REVOCATION_PURGE_SECONDS", "3600"))
+
+
+# key helpers: a token is revoked through its own jti, its refresh family or its subject
+def jti_key(jti: str):
+    return f"jti:{jti}"
+
+
+def family_key(family: str):
+    return f"fam:{family}"
+
+
+def subject_key(username: str):
+    return f"sub:{username}"
+
+
+def token_keys(payload: dict):
+    keys = []
+    if payload.get("jti"):
+        keys.append(jti_key(payload["jti"]))
+    if payload.get("fam"):
+        keys.append(family_key(payload["fam"]))
+    if payload.get("sub"):
+        keys.append(subject_key(payload["sub"]))
+    return keys
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        # double hashing over one 128 bit digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        added = False
+        for position in self._positions(key):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                added = True
+        # only count keys that were not already (probably) present
+        if added:
+            self.count += 1
+
+    def __contains__(self, key: str):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+
+class RevocationStore:
+    def __init__(
+        self,
+        capacity: int = REVOCATION_FILTER_CAPACITY,
+        error_rate: float = REVOCATION_FILTER_ERROR_RATE,
+        sync_seconds: float = REVOCATION_SYNC_SECONDS,
+        purge_seconds: float = REVOCATION_PURGE_SECONDS,
+    ):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_seconds = sync_seconds
+        self.purge_seconds = purge_seconds
+        self.session_factory = None
+        self._lock = threading.Lock()
+        self._filter = None
+        self._last_revoked_at = None
+        self._checked_at = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    # load the filter and purge expired rows in the background; rebuilds and purges use
+    # sessions of their own, never the caller's request session
+    def start(self, session_factory):
+        self.session_factory = session_factory
+        self.rebuild()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="revocation-purge", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.purge_seconds):
+            try:
+                self.purge()
+            except Exception:
+                logger.exception("purging revoked tokens failed, retrying")
+
+    # delete the rows of tokens that have expired anyway, returns how many (their keys stay
+    # in the filter as false positives until the next rebuild)
+    def purge(self):
+        with self.session_factory() as db:
+            deleted = db.query(RevokedToken).filter(
+                RevokedToken.expires_at < datetime.utcnow()
+            ).delete(synchronize_session=False)
+            db.commit()
+        return deleted
+
+    # drop expired rows and rebuild the filter from the remaining ones
+    def rebuild(self):
+        self.purge()
+        now = datetime.utcnow()
+        with self.session_factory() as db:
+            rows = db.query(RevokedToken.key, RevokedToken.revoked_at).all()
+        bloom = BloomFilter(max(self.capacity, 2 * len(rows)), self.error_rate)
+        for key, _ in rows:
+            bloom.add(key)
+        with self._lock:
+            self._filter = bloom
+            self._last_revoked_at = max((row[1] for row in rows), default=now)
+            self._checked_at = time.monotonic()
+
+    # pick up keys revoked by other processes since the last sync (reads in the caller's
+    # session, without committing it)
+    def sync(self, db: Session):
+        if self._filter is None or self._filter.count > self._filter.capacity:
+            self.rebuild()
+            return
+        if time.monotonic() - self._checked_at < self.sync_seconds:
+            return
+        rows = (
+            db.query(RevokedToken.key, RevokedToken.revoked_at)
+            .filter(
+                RevokedToken.revoked_at
+                >= self._last_revoked_at - REVOCATION_SYNC_LOOKBACK
+            )
+            .all()
+        )
+        with self._lock:
+            for key, revoked_at in rows:
+                self._filter.add(key)
+                self._last_revoked_at = max(self._last_revoked_at, revoked_at)
+            self._checked_at = time.monotonic()
+
+    # add a revocation to the session, the caller commits
+    def revoke(self, db: Session, key: str, expires_at: datetime):
+        db.add(RevokedToken(key=key, expires_at=expires_at))
+        if self._filter is not None:
+            with self._lock:
+                self._filter.add(key)
+
+    # revoke a jti key unless it is revoked already, with one INSERT ... ON CONFLICT DO NOTHING
+    # on the unique index of jti keys (atomic, concurrent claims wait for each other); True
+    # when this call revoked it. The caller commits
+    def claim(self, db: Session, key: str, expires_at: datetime):
+        result = db.execute(
+            dialect_insert(db, RevokedToken)
+            .values(key=key, expires_at=expires_at)
+            .on_conflict_do_nothing(
+                index_elements=["key"], index_where=text("key LIKE 'jti:%'")
+            )
+        )
+        if self._filter is not None:
+            with self._lock:
+                self._filter.add(key)
+        return result.rowcount == 1
+
+    # return the subset of keys revoked at or after issued_at
+    def revoked_keys(self, db: Session, keys: list, issued_at: datetime = None):
+        self.sync(db)
+        candidates = [key for key in keys if key in self._filter]
+        if not candidates:
+            return set()
+        query = db.query(RevokedToken.key, func.max(RevokedToken.revoked_at)).filter(
+            RevokedToken.key.in_(candidates)
+        )
+        return {
+            key
+            for key, revoked_at in query.group_by(RevokedToken.key).all()
+            if issued_at is None or revoked_at >= issued_at
+        }
+
+
+revocation_store = RevocationStore()
+
+
+# NumericDate with microseconds (RFC 7519 allows fractions) for iat: it is compared with the
+# microsecond revoked_at, whole seconds would reject tokens issued later in a revoke's second
+def numeric_date(value: datetime):
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1_000_000
+
+
+def issued_at(payload: dict):
+    if payload.get("iat") is None:
+        return None
+    return datetime.utcfromtimestamp(payload["iat"])
+
+
+def expires_at(payload: dict, default: timedelta):
+    if payload.get("exp") is None:
+        return datetime.utcnow() + default
+    return datetime.utcfromtimestamp(payload["exp"])
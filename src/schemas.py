@@ -1,6 +1,6 @@
 # importing required modules
-from pydantic import BaseModel, EmailStr
-from typing import Optional
+from pydantic import BaseModel, EmailStr, Field
+from typing import List, Optional
 import datetime
 
 
@@ -12,6 +12,11 @@ class UserCreate(BaseModel):
     password: str
 
 
+# schema for batch registration (partner migrations)
+class UserBatchCreate(BaseModel):
+    users: List[UserCreate] = Field(min_length=1, max_length=1000)
+
+
 # schema for User login : with username and password
 class UserLogin(BaseModel):
     username: str
@@ -26,7 +31,18 @@ class NewPassword(BaseModel):
     new_password: str
 
 
+# schema for token revocation
+class TokenRevoke(BaseModel):
+    token: str
+
+
 # schema for Magazine
+# a plan offered by a magazine
+class MagazinePlanOffer(BaseModel):
+    plan_id: int
+    discount: float = Field(0.0, ge=0, lt=1)
+
+
 class MagazineBase(BaseModel):
     name: str
     description: str
@@ -34,6 +50,9 @@ class MagazineBase(BaseModel):
     discount_quarterly: Optional[float] = None
     discount_half_yearly: Optional[float] = None
     discount_annual: Optional[float] = None
+    # offered plans; when not given, derived from the discount columns on create and kept
+    # (re-derived if a discount column changes) on update
+    plans: Optional[List[MagazinePlanOffer]] = None
 
 
 # schema for plan
@@ -70,6 +89,30 @@ class SubscriptionResponse(BaseModel):
     price: float
     next_renewal_date: datetime.date
     is_active: bool
+    previous_subscription_id: Optional[int] = None
+    version: int
 
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+
+# schemas for the admin bulk operations, every field narrows the affected rows
+class PlanFilter(BaseModel):
+    ids: Optional[List[int]] = None
+    title: Optional[str] = None
+    renewal_period: Optional[int] = None
+
+
+class MagazineFilter(BaseModel):
+    ids: Optional[List[int]] = None
+    name_prefix: Optional[str] = None
+
+
+class UserDeactivateMany(BaseModel):
+    usernames: List[str]
+
+
+class SubscriptionFilter(BaseModel):
+    ids: Optional[List[int]] = None
+    user_id: Optional[int] = None
+    magazine_id: Optional[int] = None
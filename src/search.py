@@ -0,0 +1,153 @@
+# magazine search: ranked full-text search backed by the database's full-text index, and
+# prefix autocomplete over magazine names from an in-memory sorted array
+import bisect
+import re
+import threading
+import time
+
+from sqlalchemy import select, text
+from sqlalchemy.orm import Session
+
+from catalog import current_catalog_version
+from models import Magazine, MAGAZINE_SEARCH_VECTOR
+
+# how often (in seconds) the autocomplete index checks the catalog version
+AUTOCOMPLETE_CHECK_SECONDS = 1.0
+
+POSTGRES_SEARCH = text(
+    f"""
+    WITH query AS (SELECT websearch_to_tsquery('english', :q) AS query)
+    SELECT m.id, m.name, m.description, m.base_price,
+           ts_rank_cd({MAGAZINE_SEARCH_VECTOR}, query.query) AS rank,
+           count(*) OVER () AS total
+    FROM magazines m, query
+    WHERE ({MAGAZINE_SEARCH_VECTOR}) @@ query.query
+    ORDER BY rank DESC, m.id
+    LIMIT :limit OFFSET :offset
+    """
+)
+POSTGRES_COUNT = text(
+    f"""
+    SELECT count(*) FROM magazines
+    WHERE ({MAGAZINE_SEARCH_VECTOR}) @@ websearch_to_tsquery('english', :q)
+    """
+)
+# bm25 is lower-is-better and can't be used next to a window function, hence the CTE
+SQLITE_SEARCH = text(
+    """
+    WITH hits AS (
+        SELECT rowid AS id, -bm25(magazines_fts, 10.0, 1.0) AS rank
+        FROM magazines_fts WHERE magazines_fts MATCH :q
+    )
+    SELECT m.id, m.name, m.description, m.base_price, hits.rank,
+           count(*) OVER () AS total
+    FROM hits JOIN magazines m ON m.id = hits.id
+    ORDER BY hits.rank DESC, m.id
+    LIMIT :limit OFFSET :offset
+    """
+)
+SQLITE_COUNT = text("SELECT count(*) FROM magazines_fts WHERE magazines_fts MATCH :q")
+
+
+# every word of the user's query as a quoted FTS5 term, all of them must match
+def fts5_query(q: str):
+    return " ".join(f'"{word}"' for word in re.findall(r"\w+", q))
+
+
+def search_magazines(db: Session, q: str, limit: int, offset: int):
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        search, count = POSTGRES_SEARCH, POSTGRES_COUNT
+    elif dialect == "sqlite":
+        q = fts5_query(q)
+        if not q:
+            return {"total": 0, "items": []}
+        search, count = SQLITE_SEARCH, SQLITE_COUNT
+    else:
+        raise NotImplementedError(f"full-text search is not supported on {dialect}")
+    rows = db.execute(search, {"q": q, "limit": limit, "offset": offset}).all()
+    if rows:
+        total = rows[0].total
+    else:
+        # past the last page, the window count has no row to ride on
+        total = db.execute(count, {"q": q}).scalar() if offset else 0
+    return {
+        "total": total,
+        "items": [
+            {
+                "id": row.id,
+                "name": row.name,
+                "description": row.description,
+                "base_price": row.base_price,
+                "rank": round(row.rank, 6),
+            }
+            for row in rows
+        ],
+    }
+
+
+class AutocompleteIndex:
+    # casefolded names and the names starting at every later word, sorted for bisect
+    def __init__(self, check_seconds: float = AUTOCOMPLETE_CHECK_SECONDS):
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+        self._names = ([], [])
+        self._words = ([], [])
+
+    @staticmethod
+    def _sorted(entries):
+        entries.sort()
+        return [entry[0] for entry in entries], [entry[1:] for entry in entries]
+
+    def rebuild(self, db: Session, version: int):
+        names, words = [], []
+        for id, name in db.execute(select(Magazine.id, Magazine.name)).all():
+            if not name:
+                continue
+            key = name.casefold()
+            names.append((key, id, name))
+            for match in re.finditer(r"\s+(?=\S)", key):
+                words.append((key[match.end() :], id, name))
+        names, words = self._sorted(names), self._sorted(words)
+        with self._lock:
+            self._names, self._words = names, words
+            self._version = version
+            self._checked_at = time.monotonic()
+
+    # rebuild when the catalog version moved, checked at most every check_seconds
+    def refresh(self, db: Session):
+        if self._version is not None and (
+            time.monotonic() - self._checked_at < self.check_seconds
+        ):
+            return
+        version = current_catalog_version(db)
+        if version == self._version:
+            self._checked_at = time.monotonic()
+            return
+        self.rebuild(db, version)
+
+    # force a version check on the next request (after a local catalog change)
+    def invalidate(self):
+        self._checked_at = 0.0
+
+    def complete(self, db: Session, prefix: str, limit: int):
+        self.refresh(db)
+        prefix = prefix.casefold()
+        results, seen = [], set()
+        # names starting with the prefix first, then names with a later word starting with it
+        for keys, entries in (self._names, self._words):
+            position = bisect.bisect_left(keys, prefix)
+            while position < len(keys) and keys[position].startswith(prefix):
+                id, name = entries[position]
+                if id not in seen:
+                    seen.add(id)
+                    results.append({"id": id, "name": name})
+                    if len(results) == limit:
+                        return results
+                position += 1
+        return results
+
+
+autocomplete_index = AutocompleteIndex()
@@ -0,0 +1,220 @@
+# slow query log: statements slower than SLOW_QUERY_MS are logged with the route that issued
+# them, their normalised SQL and the shape of their parameters, and aggregated per statement
+# fingerprint. The first slow occurrence of a SELECT also captures its plan (EXPLAIN, or
+# EXPLAIN QUERY PLAN on SQLite) in a background thread. GET /admin/slow-queries shows them.
+import contextvars
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# statements taking longer than this (milliseconds) are logged
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "1") == "1"
+# fingerprints kept in memory, slow statements beyond that are only logged
+SLOW_QUERY_MAX_FINGERPRINTS = 500
+# execution option that keeps a statement (e.g. our own EXPLAIN) out of the log
+SKIP_OPTION = "skip_slow_query_log"
+
+# ASGI scope of the request being handled, the router adds the matched route to it
+current_scope = contextvars.ContextVar("current_scope", default=None)
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_NAMED = re.compile(r"%\([^)]+\)s|(?<!:):\w+|\$\d+|%s|\?")
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_ROWS = re.compile(r"\(\?\+\)(?:\s*,\s*\(\?\+\))+")
+_SPACE = re.compile(r"\s+")
+
+
+# literals and placeholders become ?, IN lists of any length become (?+) and multi-row
+# VALUES lists become (?+)+
+def normalise(statement: str):
+    statement = _STRING.sub("?", statement)
+    statement = _NAMED.sub("?", statement)
+    statement = _NUMBER.sub("?", statement)
+    statement = _LIST.sub("(?+)", statement)
+    statement = _ROWS.sub("(?+)+", statement)
+    return _SPACE.sub(" ", statement).strip()
+
+
+def fingerprint(normalised: str):
+    return hashlib.sha1(normalised.encode()).hexdigest()[:16]
+
+
+def _type_name(value):
+    return "null" if value is None else type(value).__name__
+
+
+# parameter types without their values, e.g. {"username_1": "str"} or ["int", "int"]
+def parameter_shape(parameters, executemany: bool = False):
+    if executemany:
+        rows = list(parameters)
+        return {"rows": len(rows), "row": parameter_shape(rows[0]) if rows else None}
+    if isinstance(parameters, dict):
+        return {key: _type_name(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [_type_name(value) for value in parameters]
+    return _type_name(parameters)
+
+
+def current_route():
+    scope = current_scope.get()
+    if scope is None:
+        return "background"
+    route = scope.get("route")
+    path = getattr(route, "path", None) or scope.get("path", "")
+    return f"{scope.get('method', '')} {path}"
+
+
+class SlowQuery:
+    def __init__(self, fingerprint: str, statement: str, shape):
+        self.fingerprint = fingerprint
+        self.statement = statement
+        self.parameter_shape = shape
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_ms = 0.0
+        self.routes = Counter()
+        self.first_seen = datetime.utcnow()
+        self.last_seen = self.first_seen
+        self.plan = None
+
+    def as_dict(self):
+        return {
+            "fingerprint": self.fingerprint,
+            "statement": self.statement,
+            "parameter_shape": self.parameter_shape,
+            "count": self.count,
+            "total_ms": round(self.total_ms, 3),
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 3),
+            "last_ms": round(self.last_ms, 3),
+            "routes": dict(self.routes.most_common()),
+            "first_seen": self.first_seen,
+            "last_seen": self.last_seen,
+            "plan": self.plan,
+        }
+
+
+class SlowQueryLog:
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        # plans are captured one at a time, off the request path
+        self._explainer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="explain")
+
+    def record(self, engine, statement, parameters, executemany, elapsed_ms):
+        normalised = normalise(statement)
+        key = fingerprint(normalised)
+        route = current_route()
+        shape = parameter_shape(parameters, executemany)
+        logger.warning(
+            "slow query %.1fms [%s] %s %s params=%s",
+            elapsed_ms,
+            key,
+            route,
+            normalised,
+            shape,
+        )
+        with self._lock:
+            entry = self._entries.get(key)
+            explain = False
+            if entry is None:
+                if len(self._entries) >= SLOW_QUERY_MAX_FINGERPRINTS:
+                    return
+                entry = self._entries[key] = SlowQuery(key, normalised, shape)
+                explain = SLOW_QUERY_EXPLAIN and not executemany
+            entry.count += 1
+            entry.total_ms += elapsed_ms
+            entry.max_ms = max(entry.max_ms, elapsed_ms)
+            entry.last_ms = elapsed_ms
+            entry.last_seen = datetime.utcnow()
+            entry.routes[route] += 1
+        if explain:
+            self._explainer.submit(self._explain, engine, entry, statement, parameters)
+
+    def _explain(self, engine, entry: SlowQuery, statement: str, parameters):
+        # only reads are explained, EXPLAIN never runs the statement itself
+        if not statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            entry.plan = "not explained (not a SELECT)"
+            return
+        prefix = "EXPLAIN QUERY PLAN " if engine.dialect.name == "sqlite" else "EXPLAIN "
+        try:
+            with engine.connect() as connection:
+                rows = (
+                    connection.execution_options(**{SKIP_OPTION: True})
+                    .exec_driver_sql(prefix + statement, parameters)
+                    .all()
+                )
+            entry.plan = "\n".join(
+                " | ".join(str(value) for value in row) if len(row) > 1 else str(row[0])
+                for row in rows
+            )
+        except Exception as error:
+            entry.plan = f"explain failed: {error!r}"
+
+    def entries(self, limit: int = 50, order: str = "total_ms"):
+        with self._lock:
+            entries = [entry.as_dict() for entry in self._entries.values()]
+        entries.sort(key=lambda entry: entry[order], reverse=True)
+        return entries[:limit]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # wait for pending plans (tests)
+    def flush(self):
+        self._explainer.submit(lambda: None).result()
+
+
+slow_query_log = SlowQueryLog()
+
+
+# timing hooks for every engine (the app's, the tests' and the benchmarks')
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - conn.info["query_start_time"].pop()) * 1000
+    if elapsed_ms < SLOW_QUERY_MS or conn.get_execution_options().get(SKIP_OPTION):
+        return
+    slow_query_log.record(conn.engine, statement, parameters, executemany, elapsed_ms)
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("query_start_time"):
+        connection.info["query_start_time"].pop()
+
+
+class QueryRouteMiddleware:
+    # makes the request scope (and so the matched route) visible to the query hooks
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = current_scope.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_scope.reset(token)
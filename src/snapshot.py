@@ -0,0 +1,157 @@
+# catalog snapshot: the serialised catalog bodies of one catalog version (and their variants
+# compressed at the highest level) in a single binary file. Workers write it when they shut
+# down and memory-map it at startup, so a new worker serves the catalog without querying,
+# serialising and compressing it again. A snapshot is only used when its stamp (the version
+# and updated_at of catalog_versions) matches the database's.
+#
+# layout, little endian:
+#   header   magic "CATSNAP1", version u64, updated_at i64 (microseconds, -1 if unset),
+#            entry count u32, crc32 of everything after the header u32
+#   entries  name length u16, encoding length u16, offset u64, length u64, name, encoding
+#   blobs    the bytes of every entry at its offset ("identity" is the JSON body)
+import logging
+import mmap
+import os
+import struct
+import zlib
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from catalog import CATALOG_VERSION_ID, CachedBody, catalog_cache, catalog_entry
+from compression import supported_encodings, COMPRESSION_MINIMUM_SIZE
+from models import CatalogVersion
+
+logger = logging.getLogger(__name__)
+
+# where the snapshot is read at startup and written at shutdown, disabled when empty
+CATALOG_SNAPSHOT_PATH = os.getenv("CATALOG_SNAPSHOT_PATH", "")
+# the catalog resources always written, other cached fieldsets are added when present
+SNAPSHOT_RESOURCES = ("magazines", "plans")
+
+MAGIC = b"CATSNAP1"
+HEADER = struct.Struct("<8sQqII")
+ENTRY = struct.Struct("<HHQQ")
+IDENTITY = "identity"
+EPOCH = datetime(1970, 1, 1)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+# (version, updated_at in microseconds) of the catalog in the database
+def catalog_stamp(db: Session):
+    row = db.execute(
+        select(CatalogVersion.version, CatalogVersion.updated_at).where(
+            CatalogVersion.id == CATALOG_VERSION_ID
+        )
+    ).first()
+    if row is None:
+        return 0, -1
+    if row.updated_at is None:
+        return row.version or 0, -1
+    return row.version or 0, (row.updated_at - EPOCH) // timedelta(microseconds=1)
+
+
+def encode(stamp: tuple, entries: dict):
+    blobs = []
+    for name, entry in sorted(entries.items()):
+        blobs.append((name, IDENTITY, entry.body))
+        if len(entry.body) >= COMPRESSION_MINIMUM_SIZE:
+            for encoding in supported_encodings():
+                blobs.append((name, encoding, entry.encoded(encoding)))
+    index = []
+    offset = HEADER.size + sum(
+        ENTRY.size + len(name.encode()) + len(encoding.encode())
+        for name, encoding, _ in blobs
+    )
+    for name, encoding, blob in blobs:
+        index.append(
+            ENTRY.pack(len(name.encode()), len(encoding.encode()), offset, len(blob))
+            + name.encode()
+            + encoding.encode()
+        )
+        offset += len(blob)
+    payload = b"".join(index) + b"".join(blob for _, _, blob in blobs)
+    version, updated_at = stamp
+    return HEADER.pack(MAGIC, version, updated_at, len(blobs), zlib.crc32(payload)) + payload
+
+
+# (stamp, {name: CachedBody}) from snapshot bytes (or an mmap of them)
+def decode(data):
+    if len(data) < HEADER.size:
+        raise SnapshotError("truncated header")
+    magic, version, updated_at, count, crc = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise SnapshotError("not a catalog snapshot")
+    with memoryview(data) as view:
+        if zlib.crc32(view[HEADER.size :]) != crc:
+            raise SnapshotError("checksum mismatch")
+    variants = {}
+    position = HEADER.size
+    for _ in range(count):
+        name_length, encoding_length, offset, length = ENTRY.unpack_from(data, position)
+        position += ENTRY.size
+        name = bytes(data[position : position + name_length]).decode()
+        position += name_length
+        encoding = bytes(data[position : position + encoding_length]).decode()
+        position += encoding_length
+        variants.setdefault(name, {})[encoding] = bytes(data[offset : offset + length])
+    entries = {}
+    for name, blobs in variants.items():
+        body = blobs.pop(IDENTITY, None)
+        if body is None:
+            raise SnapshotError(f"no body for {name}")
+        entries[name] = CachedBody(version, body, encoded=blobs)
+    return (version, updated_at), entries
+
+
+# write the catalog at the database's current version to path (atomically, several workers
+# may write it at once), returns the number of entries written
+def write_snapshot(db: Session, path: str):
+    stamp = catalog_stamp(db)
+    version = stamp[0]
+    for resource in SNAPSHOT_RESOURCES:
+        catalog_entry(db, resource, version=version)
+    entries = catalog_cache.entries(version)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(encode(stamp, entries))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+    return len(entries)
+
+
+# prime the catalog cache from the snapshot at path when it matches the database, returns
+# the number of entries loaded (0 when there is no usable snapshot)
+def load_snapshot(db: Session, path: str):
+    try:
+        with open(path, "rb") as file, mmap.mmap(
+            file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            stamp, entries = decode(data)
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError, struct.error, SnapshotError) as error:
+        logger.warning("ignoring catalog snapshot %s: %s", path, error)
+        return 0
+    current = catalog_stamp(db)
+    if stamp != current:
+        logger.info("ignoring stale catalog snapshot %s (%s, database %s)", path, stamp, current)
+        return 0
+    for name, entry in entries.items():
+        catalog_cache.prime(name, entry)
+    return len(entries)
+
+
+if __name__ == "__main__":
+    import sys
+
+    from database import SessionLocal
+
+    path = sys.argv[1] if len(sys.argv) > 1 else CATALOG_SNAPSHOT_PATH or "catalog.snapshot"
+    with SessionLocal() as db:
+        print(f"wrote {write_snapshot(db, path)} catalog entries to {path}")
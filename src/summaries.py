@@ -0,0 +1,124 @@
+# per-user subscription summary (active count, next renewal date, monthly spend) for the
+# account page. Every subscription write refreshes the summary rows of the users it touched
+# in its own transaction: the row is locked first, so a concurrent write of the same user
+# waits and then aggregates that user's committed subscriptions too, and the aggregate is
+# recomputed from the user's active subscriptions (a handful of rows, read through the
+# partial unique index on (user_id, magazine_id) WHERE is_active) instead of applying
+# deltas, which drift with floats and cannot lower next_renewal_date after a cancellation.
+# Writes outside these paths (e.g. direct SQL) are corrected by rebuild_summaries().
+from datetime import datetime
+
+from sqlalchemy import delete, func, select, text, update
+from sqlalchemy.orm import Session
+
+from bulk import dialect_insert
+from models import Plan, Subscription, SubscriptionSummary, User
+
+# users refreshed per rebuild transaction
+SUMMARY_REBUILD_BATCH = 500
+# the predicate of the partial index, verbatim: SQLite only uses a partial index when the query
+# repeats its WHERE term, and is_active = 1 does not match WHERE is_active
+ACTIVE = text("subscriptions.is_active")
+
+
+# refresh the summary rows of user_ids in the caller's transaction (flushing it first),
+# returns {user_id: (active_count, next_renewal_date, monthly_spend)}
+def refresh_summaries(db: Session, user_ids):
+    user_ids = sorted(set(user_ids))
+    if not user_ids:
+        return {}
+    db.flush()
+    # create or lock the rows, in id order so two writers cannot deadlock
+    statement = dialect_insert(db, SubscriptionSummary).values(
+        [{"user_id": user_id} for user_id in user_ids]
+    )
+    db.execute(
+        statement.on_conflict_do_update(
+            index_elements=[SubscriptionSummary.user_id],
+            set_={"user_id": statement.excluded.user_id},
+        )
+    )
+    totals = {user_id: (0, None, 0.0) for user_id in user_ids}
+    for row in db.execute(
+        select(
+            Subscription.user_id,
+            func.count(),
+            func.min(Subscription.next_renewal_date),
+            func.sum(Subscription.price / func.coalesce(Plan.renewal_period, 1)),
+        )
+        .outerjoin(Plan, Plan.id == Subscription.plan_id)
+        .where(Subscription.user_id.in_(user_ids), ACTIVE)
+        .group_by(Subscription.user_id)
+    ):
+        totals[row[0]] = (row[1], row[2], round(row[3] or 0.0, 2))
+    now = datetime.utcnow()
+    db.execute(
+        update(SubscriptionSummary),
+        [
+            {
+                "user_id": user_id,
+                "active_count": count,
+                "next_renewal_date": next_renewal_date,
+                "monthly_spend": spend,
+                "updated_at": now,
+            }
+            for user_id, (count, next_renewal_date, spend) in totals.items()
+        ],
+    )
+    return totals
+
+
+# recompute every user's summary in batches, returns (users, corrected rows)
+def rebuild_summaries(db: Session, batch_size: int = SUMMARY_REBUILD_BATCH):
+    users = corrected = 0
+    last_id = 0
+    while True:
+        ids = db.execute(
+            select(User.id).where(User.id > last_id).order_by(User.id).limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+        stored = {
+            row[0]: tuple(row[1:])
+            for row in db.execute(
+                select(
+                    SubscriptionSummary.user_id,
+                    SubscriptionSummary.active_count,
+                    SubscriptionSummary.next_renewal_date,
+                    SubscriptionSummary.monthly_spend,
+                ).where(SubscriptionSummary.user_id.in_(ids))
+            )
+        }
+        for user_id, totals in refresh_summaries(db, ids).items():
+            if stored.get(user_id, (0, None, 0.0)) != totals:
+                corrected += 1
+        db.commit()
+        users += len(ids)
+        last_id = ids[-1]
+    # rows of deleted users
+    result = db.execute(
+        delete(SubscriptionSummary).where(
+            SubscriptionSummary.user_id.not_in(select(User.id))
+        ),
+        execution_options={"synchronize_session": False},
+    )
+    db.commit()
+    return users, corrected + result.rowcount
+
+
+def summary_response(summary: SubscriptionSummary):
+    if summary is None:
+        return {"active_count": 0, "next_renewal_date": None, "monthly_spend": 0.0}
+    return {
+        "active_count": summary.active_count,
+        "next_renewal_date": summary.next_renewal_date,
+        "monthly_spend": summary.monthly_spend,
+    }
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    with SessionLocal() as db:
+        users, corrected = rebuild_summaries(db)
+        print(f"rebuilt the summaries of {users} users, corrected {corrected}")
@@ -7,7 +7,7 @@ from sqlalchemy.orm import sessionmaker
 
 from main import app
 from models import Base
-from database import get_db
+from database import get_db, SessionLocal
 
 from .utils import create_user, login_user
 
@@ -32,6 +32,8 @@ def override_get_db():
 
 # Apply the override to the FastAPI app
 app.dependency_overrides[get_db] = override_get_db
+# Sessions opened outside of requests (startup, background work) use the test database too
+SessionLocal.configure(bind=engine)
 
 # Create the database tables
 Base.metadata.create_all(bind=engine)
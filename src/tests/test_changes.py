@@ -0,0 +1,115 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import update
+
+import main
+from changefeed import ChangeSequencer, purge_changes, sequence_changes
+from models import Change
+
+from .conftest import TestingSessionLocal
+from .utils import create_user, login_user, create_plan, create_magazine, ADMIN_HEADERS
+
+
+# the test numbers the changes itself, before the client starts the app
+@pytest.fixture(scope="module", autouse=True)
+def no_sequencer():
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(main, "CHANGE_SEQUENCER_ENABLED", False)
+        yield
+
+
+# what the background sequencer does, before the test polls
+def sequence():
+    with TestingSessionLocal() as db:
+        while sequence_changes(db):
+            pass
+
+
+def poll(client, since: int, limit: int = 1000):
+    response = client.get(f"/changes?since={since}&limit={limit}", headers=ADMIN_HEADERS)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    return response.json()
+
+
+def head(client):
+    sequence()
+    since = 0
+    while True:
+        page = poll(client, since)
+        since = page["next"]
+        if not page["has_more"]:
+            return since
+
+
+def test_change_feed(client, unique_username, unique_email):
+    assert client.get("/changes").status_code == 403
+    since = head(client)
+    username, _ = create_user(client, unique_username, unique_email, "changespassword")
+    token = login_user(client, username, "changespassword")
+    user = client.get("/users/me", headers={"Authorization": f"Bearer {token}"}).json()
+    plan = create_plan(client, {})
+    magazine = create_magazine(client, {}, "changes")
+    body = {"user_id": user["id"], "magazine_id": magazine["id"], "plan_id": plan["id"],
+            "price": 5.0, "next_renewal_date": "2030-12-31"}
+    subscription = client.post("/subscriptions/", json=body).json()
+    replacement = client.put(f"/subscriptions/{subscription['id']}", json=body).json()
+    client.delete(f"/magazines/{magazine['id']}")
+
+    # polls do not number changes themselves
+    assert poll(client, since)["changes"] == []
+    sequence()
+    page = poll(client, since)
+    changes = [(change["entity"], change["entity_id"], change["operation"]) for change in page["changes"]]
+    assert changes == [
+        ("user", user["id"], "insert"),
+        ("magazine", magazine["id"], "insert"),
+        ("subscription", subscription["id"], "insert"),
+        ("subscription", subscription["id"], "update"),
+        ("subscription", replacement["id"], "insert"),
+        ("magazine", magazine["id"], "delete"),
+    ]
+    seqs = [change["seq"] for change in page["changes"]]
+    assert seqs == list(range(since + 1, since + 7)) and page["next"] == seqs[-1]
+    assert not page["has_more"]
+    # the current state of the rows, never a password
+    assert page["changes"][0]["data"] == {key: user[key] for key in page["changes"][0]["data"]}
+    assert "password" not in page["changes"][0]["data"]
+    assert page["changes"][2]["data"]["is_active"] is False
+    assert page["changes"][5]["data"] is None and page["changes"][1]["data"] is None
+
+    # paging
+    page = poll(client, since, limit=4)
+    assert len(page["changes"]) == 4 and page["has_more"]
+    page = poll(client, page["next"], limit=4)
+    assert [change["seq"] for change in page["changes"]] == seqs[4:] and not page["has_more"]
+    assert poll(client, page["next"])["changes"] == []
+
+    # purged changes: cursors before them are gone
+    with TestingSessionLocal() as db:
+        db.execute(
+            update(Change)
+            .where(Change.seq <= seqs[2])
+            .values(changed_at=datetime.utcnow() - timedelta(days=30))
+        )
+        db.commit()
+        assert purge_changes(db) == seqs[2]
+        assert sequence_changes(db) == 0
+    assert client.get(f"/changes?since={seqs[1]}", headers=ADMIN_HEADERS).status_code == 410
+    assert [change["seq"] for change in poll(client, seqs[2])["changes"]] == seqs[3:]
+    assert poll(client, 0)["changes"][0]["seq"] == seqs[3]
+
+
+def test_change_sequencer(client):
+    since = head(client)
+    magazine = create_magazine(client, {}, "sequencer")
+    sequencer = ChangeSequencer(TestingSessionLocal, poll_seconds=0.01)
+    sequencer.start()
+    try:
+        deadline = time.monotonic() + 5
+        while not (changes := poll(client, since)["changes"]) and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        sequencer.stop()
+    assert [(change["entity"], change["entity_id"]) for change in changes] == [("magazine", magazine["id"])]
@@ -0,0 +1,91 @@
+import os
+import threading
+
+import pytest
+
+from eventlog import EventLog, event_log, read_events, tail_events
+
+from .utils import create_user, login_user, create_plan, create_magazine, ADMIN_HEADERS
+
+
+@pytest.fixture
+def events_dir(tmp_path):
+    event_log.start(str(tmp_path))
+    yield str(tmp_path)
+    event_log.stop()
+
+
+def test_subscription_events(client, events_dir, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "eventpassword")
+    token = login_user(client, username, "eventpassword")
+    user = client.get("/users/me", headers={"Authorization": f"Bearer {token}"}).json()
+    plan = create_plan(client, {})
+    magazines = [create_magazine(client, {}, f"events_{i}") for i in range(2)]
+    body = {"user_id": user["id"], "magazine_id": magazines[0]["id"], "plan_id": plan["id"],
+            "price": 5.0, "next_renewal_date": "2030-12-31"}
+
+    created = client.post("/subscriptions/", json=body).json()
+    replaced = client.put(f"/subscriptions/{created['id']}", json={**body, "price": 4.5}).json()
+    client.delete(f"/subscriptions/{replaced['id']}")
+    # cancelling again changes nothing and logs nothing
+    client.delete(f"/subscriptions/{replaced['id']}")
+    other = client.post("/subscriptions/", json={**body, "magazine_id": magazines[1]["id"]}).json()
+    response = client.post("/admin/subscriptions/deactivate", json={"ids": [other["id"]]}, headers=ADMIN_HEADERS)
+    assert response.json() == {"deactivated": 1}
+    event_log.stop()
+
+    events = list(read_events(events_dir))
+    assert [event["seq"] for event in events] == [1, 2, 3, 4, 5]
+    assert [(event["type"], event["subscription_id"]) for event in events] == [
+        ("subscription.created", created["id"]),
+        ("subscription.replaced", replaced["id"]),
+        ("subscription.cancelled", replaced["id"]),
+        ("subscription.created", other["id"]),
+        ("subscription.cancelled", other["id"]),
+    ]
+    terms = {"plan_id": plan["id"], "price": 5.0, "next_renewal_date": "2030-12-31T00:00:00"}
+    assert events[0]["old"] is None and events[0]["new"] == terms
+    assert events[1]["previous_subscription_id"] == created["id"]
+    assert events[1]["old"] == terms and events[1]["new"] == {**terms, "price": 4.5}
+    assert events[2]["old"] == {**terms, "price": 4.5} and events[2]["new"] is None
+    assert events[4]["user_id"] == user["id"] and events[4]["old"] == terms
+    assert [event["seq"] for event in read_events(events_dir, after=3)] == [4, 5]
+
+
+def test_segments_and_recovery(tmp_path):
+    directory = str(tmp_path)
+    log = EventLog(directory, segment_bytes=200, fsync_seconds=0)
+    log.start()
+    for i in range(10):
+        log.emit("test", n=i)
+    log.stop()
+    segments = sorted(os.listdir(directory))
+    assert len(segments) > 1 and segments[0] == "events-000000000001.jsonl"
+    assert [event["n"] for event in read_events(directory)] == list(range(10))
+
+    # an event torn by a crash is dropped and the sequence continues after the last one
+    with open(os.path.join(directory, segments[-1]), "ab") as file:
+        file.write(b'{"seq":11,"type":"te')
+    assert len(list(read_events(directory))) == 10
+    log.start()
+    log.emit("test", n=10)
+    log.stop()
+    assert [event["seq"] for event in read_events(directory)] == list(range(1, 12))
+
+    # tailing follows new events across segments
+    stop, tailed = threading.Event(), []
+
+    def tail():
+        for event in tail_events(directory, after=8, poll_seconds=0.01, stop=stop):
+            tailed.append(event["seq"])
+            if event["seq"] == 20:
+                stop.set()
+
+    reader = threading.Thread(target=tail)
+    reader.start()
+    log.start()
+    for i in range(9):
+        log.emit("test", n=11 + i)
+    log.stop()
+    reader.join(timeout=5)
+    assert tailed == list(range(9, 21))
@@ -0,0 +1,59 @@
+import random
+from datetime import date, timedelta
+
+import numpy as np
+from dateutil.relativedelta import relativedelta
+
+from forecast import project_renewals, forecast_cache
+from .utils import create_user, login_user, create_magazine, ADMIN_HEADERS
+
+
+def test_project_renewals_matches_relativedelta():
+    start = date(2026, 10, 19)
+    end = start + relativedelta(months=12)
+    dates = [date(2023, 1, 1) + timedelta(days=random.randint(0, 1800)) for _ in range(500)]
+    dates += [date(2026, 1, 31), date(2024, 2, 29), start, start - timedelta(days=1)]
+    periods = [random.choice([1, 2, 3, 6, 12]) for _ in dates]
+
+    rows, renewals = project_renewals(
+        np.array(dates, dtype="datetime64[D]"), np.array(periods), start, end, 12
+    )
+
+    expected = []
+    for i, (renewal_date, period) in enumerate(zip(dates, periods)):
+        k = 0
+        while (renewal := renewal_date + relativedelta(months=k * period)) < end:
+            if renewal >= start:
+                expected.append((i, str(renewal)))
+            k += 1
+    assert sorted(zip(rows.tolist(), map(str, renewals))) == sorted(expected)
+
+
+def test_renewal_forecast(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+    user = client.get("/users/me", headers=headers).json()
+    magazine = create_magazine(client, headers, "forecast")
+    plan = client.post("/plans/", json={
+        "title": "Quarterly",
+        "description": "Quarterly subscription plan",
+        "renewal_period": 3
+    }, headers=headers).json()
+    response = client.post("/subscriptions/", json={
+        "user_id": user["id"],
+        "magazine_id": magazine["id"],
+        "plan_id": plan["id"],
+        "price": 12.5,
+        "next_renewal_date": str(date.today() + timedelta(days=1))
+    }, headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+    forecast_cache.clear()
+    response = client.get("/forecast/renewals", headers=ADMIN_HEADERS)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    monthly = [item for item in response.json()["monthly"] if item["magazine_id"] == magazine["id"]]
+    assert sum(item["renewals"] for item in monthly) == 4
+    assert sum(item["revenue"] for item in monthly) == 50.0
+    daily = [item for item in response.json()["daily"] if item["magazine_id"] == magazine["id"]]
+    assert daily[0]["date"] == str(date.today() + timedelta(days=1))
@@ -0,0 +1,155 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi import HTTPException
+
+import endpoints
+import groupcommit
+from groupcommit import GroupCommitter
+from schemas import SubscriptionCreate
+
+from .conftest import TestingSessionLocal
+from .utils import create_user, login_user, create_plan, create_magazine
+
+
+@pytest.fixture
+def committer(monkeypatch):
+    committer = GroupCommitter(max_batch=50, max_wait_ms=100)
+    committer.start(TestingSessionLocal)
+    monkeypatch.setattr(endpoints, "group_committer", committer)
+    yield committer
+    committer.stop()
+
+
+def submit(committer, *args):
+    try:
+        return asyncio.run(committer.submit(*args))
+    except HTTPException as error:
+        return error
+
+
+def test_group_commit(client, committer, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "grouppassword")
+    token = login_user(client, username, "grouppassword")
+    user = client.get("/users/me", headers={"Authorization": f"Bearer {token}"}).json()
+    plan = create_plan(client, {})
+    magazines = [create_magazine(client, {}, f"group_{i}") for i in range(3)]
+
+    def create(magazine_id, plan_id=plan["id"]):
+        return SubscriptionCreate(
+            user_id=user["id"],
+            magazine_id=magazine_id,
+            plan_id=plan_id,
+            price=5.0,
+            next_renewal_date="2024-12-31",
+        )
+
+    writes = [("create", create(magazine["id"])) for magazine in magazines]
+    # a second active subscription for the first magazine, and an unknown plan
+    writes += [("create", create(magazines[0]["id"])), ("create", create(magazines[1]["id"], 999999))]
+    with ThreadPoolExecutor(len(writes)) as pool:
+        results = list(pool.map(lambda write: submit(committer, *write), writes))
+
+    created = [result for result in results if isinstance(result, dict)]
+    errors = sorted(
+        (result.status_code, result.detail)
+        for result in results
+        if isinstance(result, HTTPException)
+    )
+    assert sorted(item["magazine_id"] for item in created) == sorted(m["id"] for m in magazines)
+    assert errors == [(400, "Active subscription already exists"), (404, "Plan not found")]
+    assert committer.batches <= 2
+
+    # two modifications of the same subscription: only one can replace it
+    subscription = created[0]
+    modify = create(subscription["magazine_id"])
+    with ThreadPoolExecutor(2) as pool:
+        results = list(pool.map(
+            lambda _: submit(committer, "modify", modify, subscription["id"]), range(2)
+        ))
+    replaced = [result for result in results if isinstance(result, dict)]
+    assert len(replaced) == 1
+    assert replaced[0]["previous_subscription_id"] == subscription["id"]
+    assert [result.status_code for result in results if isinstance(result, HTTPException)] == [
+        409
+    ]
+
+    # through the endpoints
+    response = client.put(f"/subscriptions/{replaced[0]['id']}", json={
+        "user_id": user["id"],
+        "magazine_id": subscription["magazine_id"],
+        "plan_id": plan["id"],
+        "price": 7.0,
+        "next_renewal_date": "2025-06-30",
+    })
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert response.json()["price"] == 7.0
+    # the batches kept the user's summary current: 5.0 + 5.0 + 7.0 a month
+    summary = client.get("/users/me/summary", headers={"Authorization": f"Bearer {token}"}).json()
+    assert summary == {"active_count": 3, "next_renewal_date": "2024-12-31T00:00:00", "monthly_spend": 17.0}
+    response = client.put("/subscriptions/999999", json={
+        "user_id": user["id"],
+        "magazine_id": subscription["magazine_id"],
+        "plan_id": plan["id"],
+        "price": 7.0,
+        "next_renewal_date": "2025-06-30",
+    })
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Subscription not found"
+
+
+def test_conflict_rolls_back_to_savepoint(client, unique_username, unique_email):
+    from groupcommit import Write, apply_writes
+
+    username, _ = create_user(client, unique_username, unique_email, "grouppassword")
+    token = login_user(client, username, "grouppassword")
+    user = client.get("/users/me", headers={"Authorization": f"Bearer {token}"}).json()
+    plan = create_plan(client, {})
+    magazine = create_magazine(client, {}, "savepoint")
+    body = {
+        "user_id": user["id"],
+        "magazine_id": magazine["id"],
+        "plan_id": plan["id"],
+        "price": 5.0,
+        "next_renewal_date": "2024-12-31",
+    }
+    subscription = client.post("/subscriptions/", json=body).json()
+
+    # the conflicting create fails the multi-row insert, the modification must still apply and
+    # the second modification of the same subscription stays a version conflict
+    writes = [
+        Write("modify", SubscriptionCreate(**body), subscription["id"]),
+        Write("modify", SubscriptionCreate(**body), subscription["id"]),
+        Write("create", SubscriptionCreate(**body)),
+    ]
+    with TestingSessionLocal() as db:
+        apply_writes(db, writes)
+        db.commit()
+    assert writes[0].error is None
+    assert writes[0].row["previous_subscription_id"] == subscription["id"]
+    assert writes[1].error.status_code == 409 and writes[1].row is None
+    assert writes[2].error.detail == "Active subscription already exists"
+    response = client.get(f"/subscriptions/{subscription['id']}")
+    assert response.json()["is_active"] is False
+
+
+def test_timed_out_write_is_not_committed(client, monkeypatch, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "grouppassword")
+    token = login_user(client, username, "grouppassword")
+    user = client.get("/users/me", headers={"Authorization": f"Bearer {token}"}).json()
+    plan = create_plan(client, {})
+    magazine = create_magazine(client, {}, "timeout")
+    body = SubscriptionCreate(user_id=user["id"], magazine_id=magazine["id"], plan_id=plan["id"],
+                              price=5.0, next_renewal_date="2024-12-31")
+
+    # no flusher yet: the caller gives up before its write is taken
+    monkeypatch.setattr(groupcommit, "GROUP_COMMIT_TIMEOUT", 0.05)
+    committer = GroupCommitter(max_wait_ms=1)
+    error = submit(committer, "create", body)
+    assert error.status_code == 503
+    committer.start(TestingSessionLocal)
+    committer.stop()
+    assert committer.writes == 0
+    summary = client.get("/users/me/summary", headers={"Authorization": f"Bearer {token}"}).json()
+    assert summary["active_count"] == 0
@@ -0,0 +1,119 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select, update
+
+import endpoints
+import idempotency
+from models import IdempotencyKey, Subscription, User
+from idempotency import memory_store, purge_expired_keys, claim_key, CLAIMED
+
+from .conftest import TestingSessionLocal
+from .utils import create_user, login_user, create_plan, create_magazine
+
+
+def count_subscriptions(user_id: int):
+    with TestingSessionLocal() as db:
+        return db.execute(
+            select(func.count()).select_from(Subscription).where(Subscription.user_id == user_id)
+        ).scalar()
+
+
+def test_idempotent_subscription(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "idempotentpassword")
+    token = login_user(client, username, "idempotentpassword")
+    user = client.get("/users/me", headers={"Authorization": f"Bearer {token}"}).json()
+    plan = create_plan(client, {})
+    magazine = create_magazine(client, {}, "idempotent")
+    body = {"user_id": user["id"], "magazine_id": magazine["id"], "plan_id": plan["id"],
+            "price": 5.0, "next_renewal_date": "2030-12-31"}
+    headers = {"Idempotency-Key": f"subscribe-{user['id']}"}
+
+    first = client.post("/subscriptions/", json=body, headers=headers)
+    assert first.status_code == 200, f"Response status code: {first.status_code}, Response body: {first.text}"
+    assert "Idempotent-Replayed" not in first.headers
+    retry = client.post("/subscriptions/", json=body, headers=headers)
+    assert retry.status_code == 200
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json() == first.json()
+    assert count_subscriptions(user["id"]) == 1
+
+    # replayed from the table by a worker that did not see the first request
+    memory_store.clear()
+    retry = client.post("/subscriptions/", json=body, headers=headers)
+    assert retry.json() == first.json() and retry.headers["Idempotent-Replayed"] == "true"
+
+    # the same key for another request
+    other = client.post("/subscriptions/", json={**body, "plan_id": 999999}, headers=headers)
+    assert other.status_code == 422
+    assert count_subscriptions(user["id"]) == 1
+
+    # errors are replayed too, but a key is not tied to a request after it expired
+    missing = {**body, "magazine_id": 999999}
+    headers = {"Idempotency-Key": f"expiring-{user['id']}"}
+    assert client.post("/subscriptions/", json=missing, headers=headers).status_code == 404
+    assert client.post("/subscriptions/", json=missing, headers=headers).headers["Idempotent-Replayed"] == "true"
+    memory_store.clear()
+    with TestingSessionLocal() as db:
+        db.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.key == f"/subscriptions/:expiring-{user['id']}")
+            .values(expires_at=datetime.utcnow() - timedelta(seconds=1))
+        )
+        db.commit()
+        assert purge_expired_keys(db) >= 1
+    assert client.post("/subscriptions/", json=missing, headers=headers).status_code == 404
+    assert client.post("/subscriptions/", json=body, headers=headers).status_code == 422
+
+
+def test_concurrent_duplicates(client, monkeypatch):
+    calls = []
+    hash_password = endpoints.hash_password
+
+    # registration slow enough for the duplicates to arrive while it runs
+    def slow_hash_password(password):
+        calls.append(password)
+        time.sleep(0.3)
+        return hash_password(password)
+
+    monkeypatch.setattr(endpoints, "hash_password", slow_hash_password)
+    body = {"username": "idempotent_racer", "email": "racer@example.com", "password": "racerpassword"}
+    headers = {"Idempotency-Key": "register-racer"}
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        responses = list(
+            pool.map(lambda _: client.post("/users/register", json=body, headers=headers), range(4))
+        )
+
+    assert [response.status_code for response in responses] == [200] * 4
+    assert len({response.text for response in responses}) == 1
+    assert sorted("Idempotent-Replayed" in response.headers for response in responses) == [False] + [True] * 3
+    assert len(calls) == 1
+    with TestingSessionLocal() as db:
+        assert db.query(User).filter(User.username == "idempotent_racer").count() == 1
+
+
+def test_slow_request_keeps_its_claim(client, monkeypatch):
+    calls = []
+    hash_password = endpoints.hash_password
+
+    # a registration running past the lock, which the heartbeat keeps extending
+    def slow_hash_password(password):
+        calls.append(password)
+        time.sleep(0.5)
+        return hash_password(password)
+
+    monkeypatch.setattr(endpoints, "hash_password", slow_hash_password)
+    monkeypatch.setattr(idempotency, "IDEMPOTENCY_LOCK", timedelta(seconds=0.15))
+    monkeypatch.setattr(idempotency, "IDEMPOTENCY_HEARTBEAT_SECONDS", 0.05)
+    body = {"username": "idempotent_slow", "email": "slow@example.com", "password": "slowpassword"}
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        response = pool.submit(
+            client.post, "/users/register", json=body, headers={"Idempotency-Key": "register-slow"}
+        )
+        time.sleep(0.35)
+        # another worker does not take the claim over as abandoned
+        outcome, _ = claim_key(TestingSessionLocal, "/users/register:register-slow", "other")
+        assert outcome != CLAIMED
+        assert response.result().status_code == 200
+    assert len(calls) == 1
@@ -57,3 +57,232 @@ def test_delete_magazine(client, unique_username, unique_email):
     # Verify magazine is deleted
     response = client.get(f"/magazines/{magazine['id']}", headers=headers)
     assert response.status_code == 404, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+def test_get_magazines_compressed_and_cached(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+    create_plan(client, headers)
+    magazine = create_magazine(client, headers, "compressed")
+
+    response = client.get("/magazines/", headers={**headers, "Accept-Encoding": "gzip"})
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    etag = response.headers["etag"]
+
+    # unchanged catalog: conditional request is answered with 304
+    response = client.get("/magazines/", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 304, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+    # a catalog write bumps the version, the cached body is rebuilt
+    client.put(f"/magazines/{magazine['id']}", json={
+        "name": "Tech Weekly recompressed",
+        "description": "A weekly tech magazine",
+        "base_price": 7.0,
+    }, headers=headers)
+    response = client.get("/magazines/", headers={**headers, "Accept-Encoding": "identity", "If-None-Match": etag})
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert "content-encoding" not in response.headers
+    assert response.headers["etag"] != etag
+    names = [item["name"] for item in response.json()]
+    assert "Tech Weekly recompressed" in names
+
+def test_cached_body_etag():
+    from catalog import CachedBody
+
+    # same version and length, different fieldsets
+    assert CachedBody(3, b'[{"id":1}]').etag != CachedBody(3, b'[{"xy":1}]').etag
+    assert CachedBody(3, b'[{"id":1}]').etag == CachedBody(3, b'[{"id":1}]').etag
+    assert CachedBody(3, b'[{"id":1}]').etag != CachedBody(4, b'[{"id":1}]').etag
+
+def test_choose_encoding():
+    from compression import choose_encoding
+
+    assert choose_encoding("gzip, br") == "br"
+    assert choose_encoding("gzip;q=1.0, br;q=0.5") == "gzip"
+    assert choose_encoding("br;q=0, gzip;q=0") is None
+    assert choose_encoding("*") == "br"
+    assert choose_encoding("identity") is None
+
+
+def test_search_magazines(client):
+    for name, description in [
+        ("Gardening Today", "Plants, soil and seasonal tips"),
+        ("Soil Science Quarterly", "Research on soil chemistry"),
+        ("Chess Monthly", "Openings and endgames, with a gardening column"),
+    ]:
+        response = client.post("/magazines/", json={
+            "name": name,
+            "description": description,
+            "base_price": 4.0,
+        })
+        assert response.status_code == 200
+
+    response = client.get("/magazines/search", params={"q": "soil"})
+    assert response.status_code == 200
+    result = response.json()
+    assert result["total"] == 2
+    # a match in the name ranks above a match in the description
+    assert [item["name"] for item in result["items"]] == [
+        "Soil Science Quarterly",
+        "Gardening Today",
+    ]
+
+    # stemmed terms, all of them must match
+    response = client.get("/magazines/search", params={"q": "gardening openings"})
+    assert [item["name"] for item in response.json()["items"]] == ["Chess Monthly"]
+
+    # pagination keeps the total
+    response = client.get("/magazines/search", params={"q": "soil", "limit": 1, "offset": 1})
+    result = response.json()
+    assert result["total"] == 2
+    assert [item["name"] for item in result["items"]] == ["Gardening Today"]
+    response = client.get("/magazines/search", params={"q": "soil", "offset": 5})
+    assert response.json() == {"total": 2, "items": []}
+
+    response = client.get("/magazines/search", params={"q": "!!"})
+    assert response.json() == {"total": 0, "items": []}
+
+
+def test_autocomplete_magazines(client):
+    magazine = client.post("/magazines/", json={
+        "name": "Astronomy Now",
+        "description": "Stars and telescopes",
+        "base_price": 4.0,
+    }).json()
+
+    response = client.get("/magazines/autocomplete", params={"prefix": "astro"})
+    assert response.status_code == 200
+    assert {"id": magazine["id"], "name": "Astronomy Now"} in response.json()
+    # later words of a name match too
+    response = client.get("/magazines/autocomplete", params={"prefix": "NOW"})
+    assert {"id": magazine["id"], "name": "Astronomy Now"} in response.json()
+
+    # renames are picked up right away
+    client.put(f"/magazines/{magazine['id']}", json={
+        "name": "Stargazer",
+        "description": "Stars and telescopes",
+        "base_price": 4.0,
+    })
+    response = client.get("/magazines/autocomplete", params={"prefix": "astro"})
+    assert all(item["id"] != magazine["id"] for item in response.json())
+    response = client.get("/magazines/autocomplete", params={"prefix": "starg"})
+    assert [item["name"] for item in response.json()] == ["Stargazer"]
+
+
+def test_magazine_offerings(client):
+    monthly = client.post("/plans/", json={
+        "title": "Offer Monthly", "description": "monthly", "renewal_period": 1,
+    }).json()
+    quarterly = client.post("/plans/", json={
+        "title": "Offer Quarterly", "description": "quarterly", "renewal_period": 3,
+    }).json()
+
+    # derived from the discount columns: no annual or half-yearly discount, not offered
+    magazine = client.post("/magazines/", json={
+        "name": "Offerings Derived",
+        "description": "Only monthly and quarterly",
+        "base_price": 10.0,
+        "discount_quarterly": 0.1,
+    }).json()
+    plans = client.get(f"/magazines/{magazine['id']}").json()["plans"]
+    assert {plan["renewal_period"] for plan in plans} == {1, 3}
+    offered = {plan["id"]: plan for plan in plans}
+    assert offered[monthly["id"]]["discount"] == 0.0
+    assert offered[monthly["id"]]["price"] == 10.0
+    assert offered[quarterly["id"]]["discount"] == 0.1
+    assert offered[quarterly["id"]]["price"] == 27.0
+
+    # explicit offerings
+    response = client.put(f"/magazines/{magazine['id']}", json={
+        "name": "Offerings Derived",
+        "description": "Only quarterly now",
+        "base_price": 20.0,
+        "plans": [{"plan_id": quarterly["id"], "discount": 0.25}],
+    })
+    assert response.status_code == 200
+    response = client.get("/magazines/")
+    catalog = {item["id"]: item for item in response.json()}
+    plans = catalog[magazine["id"]]["plans"]
+    assert [(plan["id"], plan["discount"], plan["price"]) for plan in plans] == [
+        (quarterly["id"], 0.25, 45.0)
+    ]
+
+    # a PUT without plans keeps the explicit offerings, a new base price reprices them
+    def offerings(body):
+        response = client.put(f"/magazines/{magazine['id']}", json={
+            "name": "Offerings Renamed", "description": "Still only quarterly", **body,
+        })
+        assert response.status_code == 200
+        plans = client.get(f"/magazines/{magazine['id']}").json()["plans"]
+        return [(plan["id"], plan["discount"], plan["price"]) for plan in plans]
+
+    assert offerings({"base_price": 20.0}) == [(quarterly["id"], 0.25, 45.0)]
+    assert offerings({"base_price": 40.0}) == [(quarterly["id"], 0.25, 90.0)]
+    assert offerings({"base_price": 20.0}) == [(quarterly["id"], 0.25, 45.0)]
+
+    # a plan's renewal period drives the price, deleting a plan removes its offerings
+    client.put(f"/plans/{quarterly['id']}", json={
+        "title": "Offer Half-Yearly", "description": "half-yearly", "renewal_period": 6,
+    })
+    plans = client.get(f"/magazines/{magazine['id']}").json()["plans"]
+    assert [(plan["id"], plan["price"]) for plan in plans] == [(quarterly["id"], 90.0)]
+    client.delete(f"/plans/{quarterly['id']}")
+    assert client.get(f"/magazines/{magazine['id']}").json()["plans"] == []
+
+    response = client.put(f"/magazines/{magazine['id']}", json={
+        "name": "Offerings Derived",
+        "description": "Unknown plan",
+        "base_price": 20.0,
+        "plans": [{"plan_id": 999999, "discount": 0.1}],
+    })
+    assert response.status_code == 404
+
+
+def test_plan_renewal_period_rederives_offerings(client):
+    magazine = client.post("/magazines/", json={
+        "name": "Offerings Periods",
+        "description": "Quarterly and annual discounts",
+        "base_price": 10.0,
+        "discount_quarterly": 0.1,
+        "discount_annual": 0.3,
+    }).json()
+    plan = client.post("/plans/", json={
+        "title": "Offer Moving", "description": "moving", "renewal_period": 1,
+    }).json()
+
+    def offered(renewal_period):
+        response = client.put(f"/plans/{plan['id']}", json={
+            "title": "Offer Moving", "description": "moving", "renewal_period": renewal_period,
+        })
+        assert response.status_code == 200
+        plans = client.get(f"/magazines/{magazine['id']}").json()["plans"]
+        return [(item["discount"], item["price"]) for item in plans if item["id"] == plan["id"]]
+
+    # the derived discount follows the period, not just the price
+    assert offered(3) == [(0.1, 27.0)]
+    # out of 1, 3, 6 and 12: no derived offering, and back in with the new period's discount
+    assert offered(2) == []
+    assert offered(12) == [(0.3, 84.0)]
+    # no half-yearly discount on this magazine
+    assert offered(6) == []
+
+
+def test_magazine_fields(client):
+    magazine = create_magazine(client, {}, "fields")
+
+    response = client.get("/magazines/", params={"fields": "id,name,base_price"})
+    assert response.status_code == 200
+    items = response.json()
+    assert all(set(item) == {"id", "name", "base_price"} for item in items)
+    assert {"id": magazine["id"], "name": magazine["name"], "base_price": 5.0} in items
+
+    response = client.get(f"/magazines/{magazine['id']}", params={"fields": "name,plans"})
+    assert set(response.json()) == {"name", "plans"}
+
+    response = client.get(f"/magazines/{magazine['id']}", params={"fields": "name,secret"})
+    assert response.status_code == 400
+
+    response = client.get("/plans/", params={"fields": "id,renewal_period"})
+    assert all(set(plan) == {"id", "renewal_period"} for plan in response.json())
@@ -0,0 +1,79 @@
+import socket
+from datetime import datetime
+
+import pytest
+from aiosmtpd.controller import Controller
+
+from mailer import SMTPPool, drain_outbox
+from models import OutboxMessage
+from .conftest import TestingSessionLocal
+from .utils import create_user
+
+
+class CollectingHandler:
+    def __init__(self):
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        return "250 Message accepted for delivery"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def smtp_server():
+    handler = CollectingHandler()
+    controller = Controller(handler, hostname="127.0.0.1", port=free_port())
+    controller.start()
+    yield controller, handler
+    controller.stop()
+
+
+def test_reset_password_mail_delivered_by_worker(client, smtp_server, unique_username, unique_email):
+    controller, handler = smtp_server
+    username, email = create_user(client, unique_username, unique_email, "mailpassword")
+
+    response = client.post("/users/reset-password", params={"email": email})
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+    pool = SMTPPool(host=controller.hostname, port=controller.port, size=2)
+    while drain_outbox(TestingSessionLocal, pool, batch_size=50):
+        pass
+    pool.close()
+
+    recipients = [recipient for envelope in handler.messages for recipient in envelope.rcpt_tos]
+    # registration confirmation and reset mail
+    assert recipients.count(email) == 2
+    with TestingSessionLocal() as db:
+        statuses = {message.status for message in db.query(OutboxMessage).filter(OutboxMessage.recipient == email)}
+    assert statuses == {"sent"}
+
+
+def test_failed_delivery_is_retried_with_backoff(client):
+    with TestingSessionLocal() as db:
+        message = OutboxMessage(kind="test", recipient="retry@example.com", subject="Retry", body="Retry")
+        db.add(message)
+        db.commit()
+        message_id = message.id
+
+    # nothing listens on this port
+    pool = SMTPPool(host="127.0.0.1", port=free_port(), size=1, timeout=1)
+    drain_outbox(TestingSessionLocal, pool, batch_size=1000, max_attempts=2)
+    with TestingSessionLocal() as db:
+        message = db.get(OutboxMessage, message_id)
+        assert message.status == "pending"
+        assert message.attempts == 1
+        assert message.next_attempt_at > datetime.utcnow()
+        assert message.last_error
+
+        # make it due again: the second failure exhausts the attempts
+        message.next_attempt_at = datetime.utcnow()
+        db.commit()
+    drain_outbox(TestingSessionLocal, pool, batch_size=1000, max_attempts=2)
+    with TestingSessionLocal() as db:
+        assert db.get(OutboxMessage, message_id).status == "failed"
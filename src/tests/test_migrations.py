@@ -0,0 +1,144 @@
+import io
+
+import pytest
+import sqlalchemy as sa
+from alembic.autogenerate import render_python_code
+from alembic.migration import MigrationContext
+from alembic.operations import Operations, ops
+
+import migrations
+from models import MigrationCheckpoint
+
+from .conftest import engine, TestingSessionLocal
+
+metadata = sa.MetaData()
+items = sa.Table(
+    "migration_test_items",
+    metadata,
+    sa.Column("id", sa.Integer, primary_key=True),
+    sa.Column("status", sa.String),
+)
+
+
+@pytest.fixture
+def table():
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(sa.insert(items), [{"status": None} for _ in range(25)])
+    yield
+    metadata.drop_all(engine)
+    with TestingSessionLocal() as db:
+        db.execute(sa.delete(MigrationCheckpoint))
+        db.commit()
+
+
+def operations(connection, **opts):
+    return Operations(MigrationContext.configure(connection, opts=opts))
+
+
+def statuses():
+    with engine.connect() as connection:
+        return connection.execute(sa.select(items.c.status).order_by(items.c.id)).scalars().all()
+
+
+def test_backfill_resumes_from_checkpoint(table, monkeypatch):
+    def interrupt(seconds):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(migrations.time, "sleep", interrupt)
+    with engine.connect() as connection:
+        with pytest.raises(KeyboardInterrupt):
+            operations(connection).backfill(
+                "test_status", "migration_test_items", {"status": "'new'"},
+                where="status IS NULL", batch_size=10, pause=0.01,
+            )
+    # the first batch is committed with its checkpoint
+    assert statuses() == ["new"] * 10 + [None] * 15
+    with TestingSessionLocal() as db:
+        checkpoint = db.get(MigrationCheckpoint, "test_status")
+        assert (checkpoint.last_id, checkpoint.rows, checkpoint.done) == (10, 10, False)
+
+    monkeypatch.undo()
+    with engine.connect() as connection:
+        with engine.begin() as writer:
+            writer.execute(sa.update(items).where(items.c.id == 1).values(status="old"))
+        operations(connection).backfill(
+            "test_status", "migration_test_items", {"status": "'new'"},
+            where="status IS NULL", batch_size=10,
+        )
+        # done: running the revision again does nothing
+        with engine.begin() as writer:
+            writer.execute(sa.update(items).where(items.c.id == 20).values(status=None))
+        operations(connection).backfill(
+            "test_status", "migration_test_items", {"status": "'new'"}, where="status IS NULL",
+        )
+    assert statuses() == ["old"] + ["new"] * 18 + [None] + ["new"] * 5
+    with TestingSessionLocal() as db:
+        checkpoint = db.get(MigrationCheckpoint, "test_status")
+        assert (checkpoint.last_id, checkpoint.rows, checkpoint.done) == (25, 25, True)
+        assert str(checkpoint) == "test_status"
+
+
+def test_dry_run_estimates(table, caplog):
+    caplog.set_level("INFO", logger="migrations")
+    with engine.connect() as connection:
+        op = operations(connection, dry_run=True)
+        op.backfill("test_dry_run", "migration_test_items", {"status": "'new'"})
+        op.create_index_concurrently("ix_migration_test_status", "migration_test_items", ["status"])
+        assert not sa.inspect(connection).get_indexes("migration_test_items")
+    assert statuses() == [None] * 25
+    assert "backfill test_dry_run" in caplog.text and "~25 rows" in caplog.text
+    with TestingSessionLocal() as db:
+        assert db.get(MigrationCheckpoint, "test_dry_run") is None
+
+
+def test_indexes(table):
+    with engine.connect() as connection:
+        op = operations(connection)
+        op.create_index_concurrently(
+            "ix_migration_test_status", "migration_test_items", ["status"], where="status IS NULL"
+        )
+        # a rerun after an interrupted upgrade
+        op.create_index_concurrently("ix_migration_test_status", "migration_test_items", ["status"])
+        connection.commit()
+        assert [index["name"] for index in sa.inspect(connection).get_indexes("migration_test_items")] == [
+            "ix_migration_test_status"
+        ]
+        op.drop_index_concurrently("ix_migration_test_status", "migration_test_items")
+        connection.commit()
+        assert not sa.inspect(connection).get_indexes("migration_test_items")
+
+    # PostgreSQL, rendered: concurrently and outside the revision's transaction
+    buffer = io.StringIO()
+    context = MigrationContext.configure(
+        dialect_name="postgresql", opts={"as_sql": True, "output_buffer": buffer}
+    )
+    op = Operations(context)
+    with context.begin_transaction():
+        op.create_index_concurrently("ix_items_status", "items", ["status"], where="status IS NULL")
+        op.backfill("items_status", "items", {"status": "'new'"}, where="status IS NULL")
+    sql = buffer.getvalue()
+    assert "COMMIT;" in sql and sql.index("COMMIT;") < sql.index("CREATE INDEX CONCURRENTLY")
+    assert "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_items_status ON items (status) WHERE status IS NULL" in sql
+    assert "UPDATE items SET status='new' WHERE status IS NULL" in sql
+
+
+def test_autogenerate_uses_online_indexes():
+    upgrade = ops.UpgradeOps(ops=[
+        ops.CreateTableOp("new_items", [sa.Column("id", sa.Integer, primary_key=True)]),
+        ops.CreateIndexOp("ix_new_items_id", "new_items", ["id"]),
+        ops.ModifyTableOps("items", [ops.CreateIndexOp("ix_items_status", "items", ["status"])]),
+    ])
+    downgrade = ops.DowngradeOps(ops=[
+        ops.ModifyTableOps("items", [ops.DropIndexOp("ix_items_status", "items")]),
+        ops.DropIndexOp("ix_new_items_id", "new_items"),
+        ops.DropTableOp("new_items"),
+    ])
+    script = ops.MigrationScript("abc", upgrade, downgrade)
+    migrations.online_revision_directives(None, None, [script])
+    code = render_python_code(upgrade) + render_python_code(downgrade)
+    assert "op.create_index_concurrently('ix_items_status', 'items', ['status'])" in code
+    assert "op.drop_index_concurrently('ix_items_status', 'items')" in code
+    assert "op.create_index('ix_new_items_id'" in code
+    assert "op.drop_index('ix_new_items_id'" in code
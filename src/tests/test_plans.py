@@ -1,5 +1,5 @@
 import pytest
-from .utils import create_user, login_user
+from .utils import create_user, login_user, ADMIN_HEADERS
 
 def test_create_plan(client, unique_username, unique_email):
     username, _ = create_user(client, unique_username, unique_email, "adminpassword")
@@ -80,3 +80,113 @@ def test_create_plan_with_zero_renewal_period(client, unique_username, unique_em
         "renewal_period": 0
     }, headers=headers)
     assert response.status_code == 422, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+def test_admin_delete_plans_by_filter(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+    title = f"Bulk {username}"
+    for _ in range(3):
+        client.post("/plans/", json={
+            "title": title,
+            "description": "Plan deleted in bulk",
+            "renewal_period": 3
+        }, headers=headers)
+
+    response = client.post("/admin/plans/delete", json={"title": title})
+    assert response.status_code == 403, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+    response = client.post("/admin/plans/delete", json={"title": title}, headers=ADMIN_HEADERS)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert response.json()["deleted"] == 3
+    plans = client.get("/plans/", headers=headers).json()
+    assert not [plan for plan in plans if plan["title"] == title]
+
+def test_plan_registry(client):
+    from dataclasses import FrozenInstanceError
+    from catalog import PlanRegistry, plan_registry, bump_catalog_version
+    from models import Plan
+    from .conftest import TestingSessionLocal
+
+    plan = client.post("/plans/", json={
+        "title": "Biennial",
+        "description": "Two year plan",
+        "renewal_period": 24
+    }).json()
+    # the registry is reloaded by the plan writes of this process
+    with TestingSessionLocal() as db:
+        record = plan_registry.get(db, plan["id"])
+        assert record.title == "Biennial"
+        assert record in plan_registry.by_renewal_period(db, 24)
+    with pytest.raises(FrozenInstanceError):
+        record.title = "changed"
+
+    client.put(f"/plans/{plan['id']}", json={**plan, "title": "Two-yearly"})
+    assert client.get(f"/plans/{plan['id']}").json()["title"] == "Two-yearly"
+    client.delete(f"/plans/{plan['id']}")
+    assert client.get(f"/plans/{plan['id']}").status_code == 404
+    with TestingSessionLocal() as db:
+        assert plan_registry.by_renewal_period(db, 24) == ()
+
+    # another worker picks changes up through the catalog version
+    other = PlanRegistry(check_seconds=3600)
+    with TestingSessionLocal() as db:
+        before = len(other.all(db))
+        db.add(Plan(title="Elsewhere", description="created by another worker", renewal_period=2))
+        bump_catalog_version(db)
+        db.commit()
+        assert len(other.all(db)) == before
+        # an unknown id is checked against the database version right away
+        created = db.query(Plan).filter(Plan.title == "Elsewhere").first()
+        assert other.get(db, created.id).title == "Elsewhere"
+        assert len(other.all(db)) == before + 1
+
+def test_catalog_built_at_its_version(client, unique_username, unique_email, monkeypatch):
+    from catalog import plan_registry, bump_catalog_version
+    from models import MagazinePlan, Plan
+    from .utils import create_plan, create_magazine
+    from .conftest import TestingSessionLocal
+
+    username, _ = create_user(client, unique_username, unique_email, "catalogpassword")
+    token = login_user(client, username, "catalogpassword")
+    user = client.get("/users/me", headers={"Authorization": f"Bearer {token}"}).json()
+    plan = create_plan(client, {})
+    magazine = create_magazine(client, {}, "catalog_version")
+    assert client.get("/plans/").status_code == 200
+    # this worker's registry is not due for a check when another worker renames the plan
+    monkeypatch.setattr(plan_registry, "check_seconds", 3600)
+    with TestingSessionLocal() as db:
+        db.query(Plan).filter(Plan.id == plan["id"]).update({"title": "Renamed elsewhere"})
+        bump_catalog_version(db)
+        db.commit()
+    titles = {item["id"]: item["title"] for item in client.get("/plans/").json()}
+    assert titles[plan["id"]] == "Renamed elsewhere"
+    offered = next(item for item in client.get("/magazines/").json() if item["id"] == magazine["id"])
+    assert "Renamed elsewhere" in [item["title"] for item in offered["plans"]]
+
+    # nor does a subscription write accept a plan another worker just deleted
+    other = create_plan(client, {})
+    with TestingSessionLocal() as db:
+        db.query(MagazinePlan).filter(MagazinePlan.plan_id == other["id"]).delete()
+        db.query(Plan).filter(Plan.id == other["id"]).delete()
+        bump_catalog_version(db)
+        db.commit()
+    response = client.post("/subscriptions/", json={
+        "user_id": user["id"],
+        "magazine_id": magazine["id"],
+        "plan_id": other["id"],
+        "price": 5.0,
+        "next_renewal_date": "2024-12-31"
+    })
+    assert response.status_code == 404, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+def test_delete_all_plans(client):
+    from .utils import create_plan
+
+    plan = create_plan(client, {})
+    response = client.delete("/plans/")
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    # the deleted plans, as before the set-based delete
+    deleted = {item["id"]: item for item in response.json()}
+    assert deleted[plan["id"]] == plan
+    assert client.get("/plans/").json() == []
@@ -0,0 +1,83 @@
+import pstats
+
+import profiling
+
+from .utils import ADMIN_HEADERS
+
+
+def test_profile_request_on_demand(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(profiling, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(profiling, "PROFILING_DIR", str(tmp_path))
+
+    response = client.get("/plans/", headers={**ADMIN_HEADERS, "X-Profile": "cprofile"})
+    assert response.status_code == 200
+    name = response.headers["X-Profile-Id"]
+    stats = pstats.Stats(str(tmp_path / f"{name}.pstats"))
+    assert any(function == "get_plans" for _, _, function in stats.stats)
+    assert (tmp_path / f"{name}.collapsed").exists()
+
+    # the query flag works too
+    response = client.get("/plans/?profile=sample", headers=ADMIN_HEADERS)
+    assert (tmp_path / f"{response.headers['X-Profile-Id']}.collapsed").exists()
+
+    # only admins can ask for a profile
+    response = client.get("/plans/", headers={"X-Profile": "cprofile"})
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response.headers
+
+
+def test_profile_disabled_by_default(client, tmp_path):
+    response = client.get("/plans/", headers={**ADMIN_HEADERS, "X-Profile": "cprofile"})
+    assert "X-Profile-Id" not in response.headers
+
+
+def test_sample_traffic(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(profiling, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(profiling, "PROFILING_DIR", str(tmp_path))
+    monkeypatch.setattr(profiling, "PROFILING_SAMPLE_RATE", 1.0)
+
+    response = client.get("/plans/")
+    name = response.headers["X-Profile-Id"]
+    assert not (tmp_path / f"{name}.pstats").exists()
+    assert (tmp_path / f"{name}.collapsed").exists()
+
+
+def test_collapse_stacks():
+    def endpoint():
+        return profiling.collapse(profiling.sys._getframe())
+
+    session = profiling.ProfileSession("sample", "test")
+    stack = profiling._profiled_call(session, endpoint, (), {})
+    assert stack.startswith("endpoint (test_profiling.py:")
+    assert ";" not in stack
+
+
+def test_profile_subscription_writes(client, unique_username, unique_email, monkeypatch, tmp_path):
+    from .utils import create_user, create_plan, create_magazine
+
+    monkeypatch.setattr(profiling, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(profiling, "PROFILING_DIR", str(tmp_path))
+    username, _ = create_user(client, unique_username, unique_email, "profilepassword")
+    user_id = client.post("/users/login", json={
+        "username": username,
+        "password": "profilepassword"
+    }).json()["user"]["id"]
+    subscription = {
+        "user_id": user_id,
+        "magazine_id": create_magazine(client, {}, "profiled")["id"],
+        "plan_id": create_plan(client, {})["id"],
+        "price": 5.0,
+        "next_renewal_date": "2024-12-31"
+    }
+
+    # the async routes hand their work to the threadpool, which is what gets profiled
+    headers = {**ADMIN_HEADERS, "X-Profile": "cprofile"}
+    response = client.post("/subscriptions/", json=subscription, headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    stats = pstats.Stats(str(tmp_path / f"{response.headers['X-Profile-Id']}.pstats"))
+    assert any(function == "insert_subscription" for _, _, function in stats.stats)
+
+    response = client.put(f"/subscriptions/{response.json()['id']}", json=subscription, headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    stats = pstats.Stats(str(tmp_path / f"{response.headers['X-Profile-Id']}.pstats"))
+    assert any(function == "replace_subscription" for _, _, function in stats.stats)
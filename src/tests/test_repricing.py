@@ -0,0 +1,87 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import select, update
+
+import repricing
+from models import RepriceJob, Subscription
+from repricing import run_due_jobs
+
+from .conftest import TestingSessionLocal
+from .utils import create_plan, create_magazine, ADMIN_HEADERS
+
+
+def test_reprice_after_magazine_update(client, monkeypatch):
+    plan = create_plan(client, {})
+    magazine = create_magazine(client, {}, "reprice")
+    with TestingSessionLocal() as db:
+        db.add_all(
+            Subscription(
+                user_id=900000 + i,
+                magazine_id=magazine["id"],
+                plan_id=plan["id"],
+                price=5.0,
+                next_renewal_date=datetime(2030, 1, 1),
+                is_active=i < 7,
+            )
+            for i in range(8)
+        )
+        db.commit()
+
+    # a name change alone does not reprice anything
+    body = {"name": magazine["name"], "description": "edited", "base_price": 5.0,
+            "discount_quarterly": 0.1, "discount_half_yearly": 0.2, "discount_annual": 0.3}
+    response = client.put(f"/magazines/{magazine['id']}", json=body)
+    assert "X-Reprice-Job" not in response.headers
+    # nor do explicit offerings with the prices already offered
+    offers = [{"plan_id": offer["id"], "discount": offer["discount"]}
+              for offer in client.get(f"/magazines/{magazine['id']}").json()["plans"]]
+    response = client.put(f"/magazines/{magazine['id']}", json={**body, "plans": offers})
+    assert response.status_code == 200 and "X-Reprice-Job" not in response.headers
+    response = client.put(f"/magazines/{magazine['id']}", json={**body, "base_price": 6.0})
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    job_id = int(response.headers["X-Reprice-Job"])
+    assert client.get(f"/admin/reprice-jobs/{job_id}", headers=ADMIN_HEADERS).json()["status"] == "pending"
+
+    # interrupted after the first chunk of 3
+    record_progress = repricing._record_progress
+    calls = []
+
+    def interrupted(db, job_id, rows):
+        calls.append(rows)
+        if len(calls) == 2:
+            raise RuntimeError("worker stopped")
+        record_progress(db, job_id, rows)
+
+    monkeypatch.setattr(repricing, "_record_progress", interrupted)
+    with pytest.raises(RuntimeError):
+        run_due_jobs(TestingSessionLocal, chunk_size=3)
+    monkeypatch.undo()
+    job = client.get(f"/admin/reprice-jobs/{job_id}", headers=ADMIN_HEADERS).json()
+    assert job["status"] == "running"
+    assert (job["total"], job["updated"], job["progress"]) == (7, 3, round(3 / 7, 4))
+    assert "worker stopped" in job["last_error"]
+    # leased to the interrupted worker until the lease ends
+    assert run_due_jobs(TestingSessionLocal, chunk_size=3) == 0
+
+    with TestingSessionLocal() as db:
+        db.execute(update(RepriceJob).where(RepriceJob.id == job_id).values(next_attempt_at=datetime.utcnow()))
+        db.commit()
+    assert run_due_jobs(TestingSessionLocal, chunk_size=3) == 1
+    job = client.get(f"/admin/reprice-jobs/{job_id}", headers=ADMIN_HEADERS).json()
+    assert (job["status"], job["updated"], job["progress"], job["attempts"]) == ("done", 7, 1.0, 2)
+
+    with TestingSessionLocal() as db:
+        rows = db.execute(
+            select(Subscription.price, Subscription.is_active, Subscription.version)
+            .where(Subscription.magazine_id == magazine["id"])
+        ).all()
+    assert sorted(rows) == [(5.0, False, 1)] + [(6.0, True, 2)] * 7
+
+    # on demand: nothing left to reprice
+    response = client.post(f"/admin/magazines/{magazine['id']}/reprice", headers=ADMIN_HEADERS)
+    assert response.status_code == 202
+    assert run_due_jobs(TestingSessionLocal) == 1
+    job = client.get(f"/admin/reprice-jobs/{response.json()['id']}", headers=ADMIN_HEADERS).json()
+    assert (job["status"], job["total"], job["updated"]) == ("done", 0, 0)
+    assert client.post("/admin/magazines/999999/reprice", headers=ADMIN_HEADERS).status_code == 404
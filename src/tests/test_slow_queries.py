@@ -0,0 +1,49 @@
+import slowlog
+from slowlog import normalise, parameter_shape, slow_query_log
+
+from .utils import ADMIN_HEADERS, create_magazine
+
+
+def test_normalise():
+    assert normalise("SELECT * FROM t WHERE a = 'x''y' AND b IN (?, ?, ?) LIMIT 10") == (
+        "SELECT * FROM t WHERE a = ? AND b IN (?+) LIMIT ?"
+    )
+    assert normalise("SELECT x::text FROM t WHERE id = %(id_1)s") == (
+        "SELECT x::text FROM t WHERE id = ?"
+    )
+    assert normalise("INSERT INTO t (a, b) VALUES (?, ?), (?, ?)") == normalise(
+        "INSERT INTO t (a, b) VALUES ($1, $2), ($3, $4), ($5, $6)"
+    )
+    assert parameter_shape({"id": 1, "name": None}) == {"id": "int", "name": "null"}
+    assert parameter_shape([(1, "a"), (2, "b")], executemany=True) == {
+        "rows": 2,
+        "row": ["int", "str"],
+    }
+
+
+def test_slow_queries_are_logged_and_explained(client, monkeypatch):
+    # every statement counts as slow
+    monkeypatch.setattr(slowlog, "SLOW_QUERY_MS", 0)
+    slow_query_log.clear()
+    magazine = create_magazine(client, ADMIN_HEADERS, "slow")
+    client.get(f"/magazines/{magazine['id']}")
+    slow_query_log.flush()
+    monkeypatch.setattr(slowlog, "SLOW_QUERY_MS", 100)
+
+    response = client.get("/admin/slow-queries", headers=ADMIN_HEADERS)
+    assert response.status_code == 200
+    entries = response.json()
+    select = next(
+        entry
+        for entry in entries
+        if "GET /magazines/{magazine_id}" in entry["routes"]
+        and entry["statement"].startswith("SELECT")
+    )
+    assert select["count"] >= 1
+    # SQLite EXPLAIN QUERY PLAN output
+    assert "SEARCH" in select["plan"] or "SCAN" in select["plan"]
+    insert = next(entry for entry in entries if entry["statement"].startswith("INSERT"))
+    assert insert["plan"] == "not explained (not a SELECT)"
+
+    response = client.get("/admin/slow-queries")
+    assert response.status_code == 403
@@ -0,0 +1,44 @@
+import catalog
+from catalog import catalog_cache
+from snapshot import load_snapshot, write_snapshot
+
+from .conftest import TestingSessionLocal
+from .utils import create_plan, create_magazine
+
+
+def test_catalog_snapshot(client, tmp_path, monkeypatch):
+    create_plan(client, {})
+    create_magazine(client, {}, "snapshot")
+    magazines = client.get("/magazines/", headers={"Accept-Encoding": "br"})
+    plans = client.get("/plans/")
+    path = str(tmp_path / "catalog.snapshot")
+
+    with TestingSessionLocal() as db:
+        assert write_snapshot(db, path) >= 2
+        # a new worker: nothing cached, everything served from the snapshot
+        catalog_cache.clear()
+        assert load_snapshot(db, path) >= 2
+
+    def build(db, fields, version):
+        raise AssertionError("catalog rebuilt despite the snapshot")
+
+    monkeypatch.setattr(catalog, "CATALOG_BUILDERS", {"magazines": build, "plans": build})
+    response = client.get("/magazines/", headers={"Accept-Encoding": "br"})
+    assert response.headers["ETag"] == magazines.headers["ETag"]
+    assert response.json() == magazines.json()
+    assert client.get("/plans/").json() == plans.json()
+    monkeypatch.undo()
+
+    # a catalog write after the snapshot makes it stale
+    create_magazine(client, {}, "snapshot_stale")
+    with TestingSessionLocal() as db:
+        catalog_cache.clear()
+        assert load_snapshot(db, path) == 0
+        # damaged and missing files are ignored
+        with open(path, "r+b") as file:
+            file.seek(-1, 2)
+            file.write(b"\0")
+        assert load_snapshot(db, path) == 0
+        assert load_snapshot(db, str(tmp_path / "missing")) == 0
+    names = [magazine["name"] for magazine in client.get("/magazines/").json()]
+    assert any(name.endswith("snapshot_stale") for name in names)
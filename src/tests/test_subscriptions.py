@@ -1,5 +1,5 @@
 import pytest
-from .utils import create_user, login_user, create_plan, create_magazine
+from .utils import create_user, login_user, create_plan, create_magazine, ADMIN_HEADERS
 
 def test_create_subscription(client, unique_username, unique_email):
     username, _ = create_user(client, unique_username, unique_email, "adminpassword")
@@ -98,3 +98,182 @@ def test_delete_subscription(client, unique_username, unique_email):
     response = client.get(f"/subscriptions/{subscription_id}", headers=headers)
     assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
     assert not response.json()["is_active"], f"Subscription is not marked as inactive: {response.json()}"
+
+def test_admin_deactivate_subscriptions(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    plan = create_plan(client, headers)
+    name_suffix = "bulk_deactivate_sub"
+    magazine = create_magazine(client, headers, name_suffix)
+
+    response = client.post("/subscriptions/", json={
+        "user_id": 1,
+        "magazine_id": magazine["id"],
+        "plan_id": plan["id"],
+        "price": 10.0,
+        "next_renewal_date": "2024-12-31"
+    }, headers=headers)
+    subscription_id = response.json()["id"]
+
+    response = client.post("/admin/subscriptions/deactivate", json={"magazine_id": magazine["id"]}, headers=ADMIN_HEADERS)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert response.json()["deactivated"] == 1
+    assert not client.get(f"/subscriptions/{subscription_id}", headers=headers).json()["is_active"]
+
+def test_subscription_current_and_history(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    plan = create_plan(client, headers)
+    name_suffix = "history_sub"
+    magazine = create_magazine(client, headers, name_suffix)
+    body = {
+        "user_id": 1,
+        "magazine_id": magazine["id"],
+        "plan_id": plan["id"],
+        "price": 10.0,
+        "next_renewal_date": "2024-12-31"
+    }
+
+    first = client.post("/subscriptions/", json=body, headers=headers).json()
+    # a second active subscription for the same user and magazine is rejected
+    response = client.post("/subscriptions/", json=body, headers=headers)
+    assert response.status_code == 400, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+    second = client.put(f"/subscriptions/{first['id']}", json={**body, "price": 12.0}, headers=headers).json()
+    third = client.put(f"/subscriptions/{second['id']}", json={**body, "price": 14.0}, headers=headers).json()
+    assert third["previous_subscription_id"] == second["id"]
+
+    # a replaced subscription cannot be modified again
+    response = client.put(f"/subscriptions/{first['id']}", json=body, headers=headers)
+    assert response.status_code == 400, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+    response = client.get("/subscriptions/current", params={"user_id": 1, "magazine_id": magazine["id"]}, headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert response.json()["id"] == third["id"]
+
+    for subscription_id in (first["id"], second["id"], third["id"]):
+        response = client.get(f"/subscriptions/{subscription_id}/history", headers=headers)
+        assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+        assert [item["id"] for item in response.json()] == [first["id"], second["id"], third["id"]]
+
+def test_archive_inactive_subscriptions(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "adminpassword")
+    token = login_user(client, username, "adminpassword")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    plan = create_plan(client, headers)
+    name_suffix = "archive_sub"
+    magazine = create_magazine(client, headers, name_suffix)
+    body = {
+        "user_id": 2,
+        "magazine_id": magazine["id"],
+        "plan_id": plan["id"],
+        "price": 10.0,
+        "next_renewal_date": "2024-12-31"
+    }
+    first = client.post("/subscriptions/", json=body, headers=headers).json()
+    second = client.put(f"/subscriptions/{first['id']}", json=body, headers=headers).json()
+
+    response = client.post("/admin/subscriptions/archive", params={"retention_days": 0}, headers=ADMIN_HEADERS)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert response.json()["archived"] >= 1
+
+    # the live listing no longer contains the archived row, lookups by id and history still work
+    ids = [item["id"] for item in client.get("/subscriptions/", headers=headers).json()]
+    assert first["id"] not in ids and second["id"] in ids
+    response = client.get(f"/subscriptions/{first['id']}", headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert not response.json()["is_active"]
+    response = client.get(f"/subscriptions/{second['id']}/history", headers=headers)
+    assert [item["id"] for item in response.json()] == [first["id"], second["id"]]
+
+def test_subscription_fields(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "fieldspassword")
+    token = login_user(client, username, "fieldspassword")
+    headers = {"Authorization": f"Bearer {token}"}
+    user = client.get("/users/me", headers=headers, params={"fields": "id,username"}).json()
+    assert user == {"id": user["id"], "username": username}
+    response = client.get("/users/me", headers=headers, params={"fields": "password"})
+    assert response.status_code == 400
+
+    plan = create_plan(client, headers)
+    magazine = create_magazine(client, headers, "fields_sub")
+    subscription = client.post("/subscriptions/", json={
+        "user_id": user["id"],
+        "magazine_id": magazine["id"],
+        "plan_id": plan["id"],
+        "price": 10.0,
+        "next_renewal_date": "2024-12-31"
+    }).json()
+
+    fields = "id,magazine_id,next_renewal_date"
+    response = client.get(f"/subscriptions/{subscription['id']}", params={"fields": fields})
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert response.json() == {
+        "id": subscription["id"],
+        "magazine_id": magazine["id"],
+        "next_renewal_date": "2024-12-31T00:00:00",
+    }
+    response = client.get("/subscriptions/", params={"fields": fields})
+    assert all(set(item) == {"id", "magazine_id", "next_renewal_date"} for item in response.json())
+
+def test_multi_get_and_expand(client, unique_username, unique_email, monkeypatch):
+    from sqlalchemy import event
+    from catalog import plan_registry
+    from .conftest import engine, TestingSessionLocal
+
+    username, _ = create_user(client, unique_username, unique_email, "multipassword")
+    token = login_user(client, username, "multipassword")
+    user = client.get("/users/me", headers={"Authorization": f"Bearer {token}"}).json()
+    plan = create_plan(client, {})
+    magazines = [create_magazine(client, {}, f"multi_{i}") for i in range(3)]
+    subscriptions = [
+        client.post("/subscriptions/", json={
+            "user_id": user["id"],
+            "magazine_id": magazine["id"],
+            "plan_id": plan["id"],
+            "price": 5.0,
+            "next_renewal_date": "2024-12-31"
+        }).json()
+        for magazine in magazines
+    ]
+
+    # requested order, unknown ids left out
+    ids = [magazines[2]["id"], magazines[0]["id"], 999999]
+    response = client.get("/magazines/", params={"ids": ",".join(map(str, ids))})
+    assert [item["id"] for item in response.json()] == ids[:2]
+    response = client.get("/plans/", params={"ids": f"{plan['id']}", "fields": "id,title"})
+    assert response.json() == [{"id": plan["id"], "title": plan["title"]}]
+    assert client.get("/plans/", params={"ids": "1,x"}).status_code == 400
+
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    # plans come from the plan registry, loaded beforehand
+    with TestingSessionLocal() as db:
+        plan_registry.reload(db)
+    monkeypatch.setattr(plan_registry, "check_seconds", 3600)
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        response = client.get("/subscriptions/", params={
+            "ids": ",".join(str(subscription["id"]) for subscription in subscriptions),
+            "expand": "magazine,plan",
+        })
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    items = response.json()
+    assert [item["magazine"]["id"] for item in items] == [m["id"] for m in magazines]
+    assert all(item["plan"]["id"] == plan["id"] for item in items)
+    # subscriptions and magazines (with their offerings): one query each, no plan query
+    assert len(statements) == 2
+
+    response = client.get("/subscriptions/", params={"fields": "id", "expand": "plan"})
+    assert all(set(item) == {"id", "plan"} for item in response.json())
+    assert client.get("/subscriptions/", params={"expand": "user"}).status_code == 400
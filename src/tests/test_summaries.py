@@ -0,0 +1,52 @@
+from sqlalchemy import update
+
+from models import Subscription
+
+from .conftest import TestingSessionLocal
+from .utils import create_user, login_user, create_plan, create_magazine, ADMIN_HEADERS
+
+
+def test_subscription_summary(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "summarypassword")
+    token = login_user(client, username, "summarypassword")
+    auth = {"Authorization": f"Bearer {token}"}
+    user = client.get("/users/me", headers=auth).json()
+    monthly = create_plan(client, {})
+    quarterly = client.post("/plans/", json={
+        "title": "Quarterly", "description": "Quarterly subscription plan", "renewal_period": 3
+    }).json()
+    magazines = [create_magazine(client, {}, f"summary_{i}") for i in range(3)]
+
+    def summary():
+        response = client.get("/users/me/summary", headers=auth)
+        assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+        return response.json()
+
+    assert summary() == {"active_count": 0, "next_renewal_date": None, "monthly_spend": 0.0}
+    body = {"user_id": user["id"], "plan_id": monthly["id"], "price": 5.0}
+    first = client.post("/subscriptions/", json={**body, "magazine_id": magazines[0]["id"], "next_renewal_date": "2030-03-01"}).json()
+    second = client.post("/subscriptions/", json={**body, "magazine_id": magazines[1]["id"], "next_renewal_date": "2030-01-15"}).json()
+    assert summary() == {"active_count": 2, "next_renewal_date": "2030-01-15T00:00:00", "monthly_spend": 10.0}
+
+    # quarterly at 12.0 is 4.0 a month
+    replaced = client.put(f"/subscriptions/{second['id']}", json={
+        **body, "magazine_id": magazines[1]["id"], "plan_id": quarterly["id"], "price": 12.0,
+        "next_renewal_date": "2030-04-15",
+    }).json()
+    assert summary() == {"active_count": 2, "next_renewal_date": "2030-03-01T00:00:00", "monthly_spend": 9.0}
+    client.delete(f"/subscriptions/{first['id']}")
+    assert summary() == {"active_count": 1, "next_renewal_date": "2030-04-15T00:00:00", "monthly_spend": 4.0}
+    third = client.post("/subscriptions/", json={**body, "magazine_id": magazines[2]["id"], "next_renewal_date": "2030-02-01"}).json()
+    client.post("/admin/subscriptions/deactivate", json={"ids": [third["id"]]}, headers=ADMIN_HEADERS)
+    assert summary() == {"active_count": 1, "next_renewal_date": "2030-04-15T00:00:00", "monthly_spend": 4.0}
+
+    # a write that bypassed the endpoints is corrected by the rebuild
+    with TestingSessionLocal() as db:
+        db.execute(update(Subscription).where(Subscription.id == replaced["id"]).values(price=15.0))
+        db.commit()
+    assert summary()["monthly_spend"] == 4.0
+    response = client.post("/admin/subscription-summaries/rebuild", headers=ADMIN_HEADERS)
+    assert response.status_code == 200
+    assert response.json()["corrected"] >= 1
+    assert summary() == {"active_count": 1, "next_renewal_date": "2030-04-15T00:00:00", "monthly_spend": 5.0}
+    assert client.post("/admin/subscription-summaries/rebuild", headers=ADMIN_HEADERS).json()["corrected"] == 0
@@ -1,5 +1,5 @@
 import pytest
-from .utils import create_user, login_user
+from .utils import create_user, login_user, ADMIN_HEADERS
 from datetime import datetime, timedelta, UTC
 from datetime import timedelta
 from jose import JWTError, jwt
@@ -39,6 +39,53 @@ def test_register_user(client, unique_username, unique_email):
     })
     assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
 
+def test_register_duplicate_username(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "testpassword")
+    response = client.post("/users/register", json={
+        "username": username,
+        "email": f"other{unique_email}",
+        "password": "testpassword"
+    })
+    assert response.status_code == 400, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+
+def test_register_users_batch(client, unique_username, unique_email):
+    existing, existing_email = create_user(client, unique_username, unique_email, "batchpassword")
+    users = [
+        {"username": f"{existing}batch{i}", "email": f"batch{i}{existing_email}", "password": "batchpassword"}
+        for i in range(3)
+    ]
+    users.append({"username": existing, "email": f"dup{existing_email}", "password": "batchpassword"})
+
+    response = client.post("/users/register/batch", json={"users": users})
+    assert response.status_code == 403, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+    response = client.post("/users/register/batch", json={"users": users}, headers=ADMIN_HEADERS)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert len(response.json()["created"]) == 3
+    assert response.json()["skipped"] == [existing]
+    login_user(client, f"{existing}batch0", "batchpassword")
+
+
+def test_register_users_batch_without_on_conflict(client, unique_username, unique_email, monkeypatch):
+    import endpoints
+
+    existing, existing_email = create_user(client, unique_username, unique_email, "batchpassword")
+    users = [
+        {"username": f"{existing}rows{i}", "email": f"rows{i}{existing_email}", "password": "batchpassword"}
+        for i in range(2)
+    ]
+    users.insert(1, {"username": existing, "email": f"dup{existing_email}", "password": "batchpassword"})
+
+    # databases without ON CONFLICT insert row by row
+    monkeypatch.setattr(endpoints, "supports_on_conflict", lambda db: False)
+    response = client.post("/users/register/batch", json={"users": users}, headers=ADMIN_HEADERS)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert [row["username"] for row in response.json()["created"]] == [f"{existing}rows0", f"{existing}rows1"]
+    assert response.json()["skipped"] == [existing]
+    login_user(client, f"{existing}rows1", "batchpassword")
+
+
 def test_login_user(client, unique_username, unique_email):
     username, _ = create_user(client, unique_username, unique_email, "loginpassword")
     response = client.post("/users/login", json={
@@ -102,3 +149,132 @@ def test_token_expiry(client, unique_username, unique_email):
     # Verify token has expired
     response = client.get("/users/me", headers=headers)
     assert response.status_code == 401, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+
+def test_revoked_access_token_is_rejected(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "revokepassword")
+    token = login_user(client, username, "revokepassword")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    response = client.post("/users/token/revoke", json={"token": token}, headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+    response = client.get("/users/me", headers=headers)
+    assert response.status_code == 401, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+
+def test_refresh_token_reuse_revokes_family(client, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "rotatepassword")
+    login_response = client.post("/users/login", json={
+        "username": username,
+        "password": "rotatepassword"
+    })
+    old_refresh = login_response.json()["refresh_token"]
+
+    response = client.post("/users/token/refresh", headers={"Authorization": f"Bearer {old_refresh}"})
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    new_access = response.json()["access_token"]
+    new_refresh = response.json()["refresh_token"]
+
+    # replaying the rotated refresh token is rejected and kills the family
+    response = client.post("/users/token/refresh", headers={"Authorization": f"Bearer {old_refresh}"})
+    assert response.status_code == 401, f"Response status code: {response.status_code}, Response body: {response.text}"
+    response = client.post("/users/token/refresh", headers={"Authorization": f"Bearer {new_refresh}"})
+    assert response.status_code == 401, f"Response status code: {response.status_code}, Response body: {response.text}"
+    response = client.get("/users/me", headers={"Authorization": f"Bearer {new_access}"})
+    assert response.status_code == 401, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+
+def test_concurrent_refresh_replay(client, unique_username, unique_email, monkeypatch):
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from revocation import revocation_store
+
+    username, _ = create_user(client, unique_username, unique_email, "racepassword")
+    # every request passes the revocation check before any of them rotates the token
+    barrier = threading.Barrier(4)
+    check = revocation_store.revoked_keys
+
+    def revoked_keys(*args):
+        revoked = check(*args)
+        barrier.wait(timeout=10)
+        return revoked
+
+    monkeypatch.setattr(revocation_store, "revoked_keys", revoked_keys)
+    for _ in range(3):
+        refresh = client.post("/users/login", json={
+            "username": username,
+            "password": "racepassword"
+        }).json()["refresh_token"]
+        with ThreadPoolExecutor(4) as pool:
+            responses = list(pool.map(
+                lambda _: client.post("/users/token/refresh", headers={"Authorization": f"Bearer {refresh}"}),
+                range(4),
+            ))
+        codes = sorted(response.status_code for response in responses)
+        assert codes == [200, 401, 401, 401], codes
+        # the losing replays revoked the family, the winner's tokens included
+        winner = next(response for response in responses if response.status_code == 200).json()
+        monkeypatch.setattr(revocation_store, "revoked_keys", check)
+        response = client.post("/users/token/refresh", headers={"Authorization": f"Bearer {winner['refresh_token']}"})
+        assert response.status_code == 401, f"Response status code: {response.status_code}, Response body: {response.text}"
+        monkeypatch.setattr(revocation_store, "revoked_keys", revoked_keys)
+        barrier.reset()
+
+
+def test_deactivated_user_tokens_are_revoked(client, unique_username, unique_email):
+    username, email = create_user(client, unique_username, unique_email, "deactivatepassword")
+    token = login_user(client, username, "deactivatepassword")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    response = client.delete(f"/users/deactivate/{username}", headers=headers)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+    # registering the same username again must not revive the old token
+    response = client.post("/users/register", json={
+        "username": username,
+        "email": email,
+        "password": "deactivatepassword"
+    })
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    response = client.get("/users/me", headers=headers)
+    assert response.status_code == 401, f"Response status code: {response.status_code}, Response body: {response.text}"
+    # a token issued after the revocation, in the same second, is accepted
+    token = login_user(client, username, "deactivatepassword")
+    response = client.get("/users/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+
+
+def test_revocation_store_uses_own_sessions():
+    from models import RevokedToken, User
+    from revocation import RevocationStore
+    from .conftest import TestingSessionLocal
+
+    store = RevocationStore()
+    store.session_factory = TestingSessionLocal
+    with TestingSessionLocal() as db:
+        db.add(RevokedToken(key="jti:expired", expires_at=datetime.utcnow() - timedelta(days=1)))
+        db.add(RevokedToken(key="jti:current", expires_at=datetime.utcnow() + timedelta(days=1)))
+        db.commit()
+        # the first check rebuilds the filter without committing the caller's transaction
+        db.add(User(username="revocation-uncommitted", email="revocation-uncommitted@example.com"))
+        assert store.revoked_keys(db, ["jti:current", "jti:expired", "jti:other"]) == {"jti:current"}
+        db.rollback()
+        assert db.query(User).filter(User.username == "revocation-uncommitted").first() is None
+        # expired rows are purged
+        assert db.query(RevokedToken).filter(RevokedToken.key == "jti:expired").first() is None
+        db.query(RevokedToken).filter(RevokedToken.key == "jti:current").delete()
+        db.commit()
+
+
+def test_admin_deactivate_users(client, unique_username, unique_email):
+    first, _ = create_user(client, unique_username, unique_email, "bulkpassword")
+    second, _ = create_user(client, unique_username, unique_email, "bulkpassword")
+    token = login_user(client, first, "bulkpassword")
+
+    response = client.post("/admin/users/deactivate", json={"usernames": [first, second]}, headers=ADMIN_HEADERS)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert response.json()["deactivated"] == 2
+
+    response = client.get("/users/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 401, f"Response status code: {response.status_code}, Response body: {response.text}"
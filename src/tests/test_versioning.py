@@ -0,0 +1,105 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import func, select
+
+from models import Subscription
+
+from .conftest import TestingSessionLocal
+from .utils import create_user, login_user, create_plan, create_magazine
+
+
+def subscribe(client, suffix, unique_username, unique_email):
+    username, _ = create_user(client, unique_username, unique_email, "versionpassword")
+    token = login_user(client, username, "versionpassword")
+    user = client.get("/users/me", headers={"Authorization": f"Bearer {token}"}).json()
+    plan = create_plan(client, {})
+    magazine = create_magazine(client, {}, suffix)
+    body = {
+        "user_id": user["id"],
+        "magazine_id": magazine["id"],
+        "plan_id": plan["id"],
+        "price": 5.0,
+        "next_renewal_date": "2024-12-31",
+    }
+    response = client.post("/subscriptions/", json=body)
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    return body, response.json()
+
+
+def test_parallel_modifications(client, unique_username, unique_email):
+    body, subscription = subscribe(client, "version_parallel", unique_username, unique_email)
+
+    def modify(price):
+        return client.put(f"/subscriptions/{subscription['id']}", json={**body, "price": price})
+
+    with ThreadPoolExecutor(8) as pool:
+        responses = list(pool.map(modify, range(10, 18)))
+
+    statuses = sorted(response.status_code for response in responses)
+    # exactly one replacement, the others lost the race (or saw the row already replaced)
+    assert statuses.count(200) == 1, [response.text for response in responses]
+    assert set(statuses) <= {200, 400, 409}
+    with TestingSessionLocal() as db:
+        active = db.execute(
+            select(func.count()).where(
+                Subscription.user_id == body["user_id"],
+                Subscription.magazine_id == body["magazine_id"],
+                Subscription.is_active == True,
+            )
+        ).scalar()
+    assert active == 1
+
+
+def test_subscription_if_match(client, unique_username, unique_email):
+    body, subscription = subscribe(client, "version_if_match", unique_username, unique_email)
+    assert subscription["version"] == 1
+    response = client.get(f"/subscriptions/{subscription['id']}")
+    assert response.headers["ETag"] == '"1"'
+
+    path = f"/subscriptions/{subscription['id']}"
+    response = client.put(path, json=body, headers={"If-Match": '"2"'})
+    assert response.status_code == 409, f"Response status code: {response.status_code}, Response body: {response.text}"
+    response = client.put(path, json=body, headers={"If-Match": "not an etag"})
+    assert response.status_code == 400
+    response = client.put(path, json=body, headers={"If-Match": '"1"'})
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    replacement = response.json()
+    assert response.headers["ETag"] == f'"{replacement["version"]}"'
+
+    # the replaced row moved on to version 2
+    assert client.get(path).json()["version"] == 2
+    response = client.put(path, json=body, headers={"If-Match": '"1"'})
+    assert response.status_code == 409
+    response = client.delete(
+        f"/subscriptions/{replacement['id']}", headers={"If-Match": '"7"'}
+    )
+    assert response.status_code == 409
+    response = client.delete(f"/subscriptions/{replacement['id']}", headers={"If-Match": "*"})
+    assert response.status_code == 200
+    assert response.json()["version"] == 2
+
+
+def test_magazine_if_match(client):
+    magazine = create_magazine(client, {}, "version_magazine")
+    path = f"/magazines/{magazine['id']}"
+    response = client.get(path)
+    assert response.headers["ETag"] == '"1"'
+    update = {"name": magazine["name"], "description": "edited", "base_price": 6.0}
+
+    response = client.put(path, json=update, headers={"If-Match": '"1"'})
+    assert response.status_code == 200, f"Response status code: {response.status_code}, Response body: {response.text}"
+    assert response.json()["version"] == 2
+    assert response.headers["ETag"] == '"2"'
+    # a second client still editing version 1
+    response = client.put(path, json={**update, "description": "stale"}, headers={"If-Match": '"1"'})
+    assert response.status_code == 409
+    assert client.get(path).json()["description"] == "edited"
+
+    # concurrent updates of the same read: one wins, the others conflict
+    def edit(i):
+        return client.put(path, json={**update, "description": f"edit {i}"}, headers={"If-Match": '"2"'})
+
+    with ThreadPoolExecutor(4) as pool:
+        statuses = sorted(response.status_code for response in pool.map(edit, range(4)))
+    assert statuses == [200, 409, 409, 409]
+    assert client.get(path).json()["version"] == 3
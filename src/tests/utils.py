@@ -2,6 +2,10 @@ import random
 from pydantic import BaseModel, ConfigDict, EmailStr
 from typing import Optional
 
+# header accepted by the admin endpoints (utils.ADMIN_TOKEN default)
+ADMIN_HEADERS = {"X-Admin-Token": "admin_token"}
+
+
 class UserCreate(BaseModel):
     username: str
     email: EmailStr
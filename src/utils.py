@@ -1,15 +1,27 @@
 # importing the required libraries
 import hashlib
+import hmac
+import os
+import uuid
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
 
 
-from fastapi import Depends, HTTPException
+from fastapi import Depends, HTTPException, Header
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from sqlalchemy.orm import Session
 from models import User
 from database import get_db
+from revocation import (
+    revocation_store,
+    token_keys,
+    jti_key,
+    family_key,
+    issued_at,
+    expires_at,
+    numeric_date,
+)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -20,6 +32,15 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 REFRESH_TOKEN_EXPIRE_DAYS = 7
 
+# shared secret for the admin endpoints, sent in the X-Admin-Token header
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "admin_token")
+
+
+# dependency for admin-only endpoints
+def require_admin(x_admin_token: str = Header(None)):
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
 
 def get_current_user(
     token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)
@@ -36,12 +57,81 @@ def get_current_user(
             raise credentials_exception
     except JWTError:
         raise credentials_exception
+    # refresh tokens are only accepted by the refresh endpoint
+    if payload.get("type") == "refresh":
+        raise credentials_exception
+    # the revocation table is only queried when the bloom filter reports a hit
+    if revocation_store.revoked_keys(db, token_keys(payload), issued_at(payload)):
+        raise credentials_exception
     user = db.query(User).filter(User.username == username).first()
     if user is None:
         raise credentials_exception
     return user
 
 
+# dependency for the refresh endpoint: validates and rotates the refresh token
+def get_refresh_token_user(
+    token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)
+):
+    credentials_exception = HTTPException(
+        status_code=401,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise credentials_exception
+    username = payload.get("sub")
+    if username is None or payload.get("type") != "refresh" or not payload.get("jti"):
+        raise credentials_exception
+    revoked = revocation_store.revoked_keys(
+        db, token_keys(payload), issued_at(payload)
+    )
+    if jti_key(payload["jti"]) in revoked and family_key(payload["fam"]) not in revoked:
+        # an already rotated refresh token was replayed: revoke the whole family
+        revoke_family(db, payload)
+    if revoked:
+        raise credentials_exception
+    user = db.query(User).filter(User.username == username).first()
+    if user is None:
+        raise credentials_exception
+    # rotation: the presented refresh token can only be used once. The check above can race
+    # with a concurrent refresh of the same token, the claim cannot: losing it is a replay
+    if not revoke_token(db, payload):
+        db.rollback()
+        revoke_family(db, payload)
+        raise credentials_exception
+    db.commit()
+    return user, payload["fam"]
+
+
+# revoke a single decoded token, the caller commits; False when it was revoked already
+def revoke_token(db: Session, payload: dict):
+    if not payload.get("jti"):
+        return False
+    return revocation_store.claim(
+        db,
+        jti_key(payload["jti"]),
+        expires_at(payload, timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)),
+    )
+
+
+# revoke every token of a decoded token's refresh family (reuse detection), and commit
+def revoke_family(db: Session, payload: dict):
+    revocation_store.revoke(
+        db,
+        family_key(payload["fam"]),
+        datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+    )
+    db.commit()
+
+
+# a new token family is started on every login and kept across refreshes
+def new_token_family():
+    return uuid.uuid4().hex
+
+
 # function to hash a password
 def hash_password(password: str):
     return hashlib.sha256(password.encode()).hexdigest()
@@ -54,15 +144,22 @@ def verify_password(plain_password: str, hashed_password: str):
 
 def create_access_token(data: dict):
     to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+    now = datetime.utcnow()
+    expire = now + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    to_encode.update(
+        {"exp": expire, "iat": numeric_date(now), "jti": uuid.uuid4().hex, "type": "access"}
+    )
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
 def create_refresh_token(data: dict):
     to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
-    to_encode.update({"exp": expire})
+    now = datetime.utcnow()
+    expire = now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    to_encode.update(
+        {"exp": expire, "iat": numeric_date(now), "jti": uuid.uuid4().hex, "type": "refresh"}
+    )
+    to_encode.setdefault("fam", new_token_family())
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
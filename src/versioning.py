@@ -0,0 +1,39 @@
+# optimistic concurrency for magazines and subscriptions: every write bumps the row's version
+# column and is applied with UPDATE ... WHERE version = :v (the ORM does this for mapped
+# objects through version_id_col, Core updates add the condition themselves). A write based
+# on a stale read changes no rows and is answered with 409 instead of overwriting the other
+# one. Reads return the version as an ETag, writes accept it back in If-Match.
+from fastapi import Header, HTTPException, Response
+
+
+def etag(version: int):
+    return f'"{version}"'
+
+
+# dependency for the If-Match header: the expected version, None when not given (or "*")
+def if_match(if_match: str = Header(None)):
+    if if_match is None or if_match.strip() == "*":
+        return None
+    value = if_match.strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    try:
+        return int(value.strip('"'))
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail="If-Match must be a single ETag returned by this API"
+        )
+
+
+def conflict(name: str):
+    return HTTPException(
+        status_code=409, detail=f"{name} was modified concurrently, reload it and retry"
+    )
+
+
+# set the ETag header for an item (a row, dict or mapped object) that has a version
+def set_etag(response: Response, item):
+    version = item.get("version") if isinstance(item, dict) else getattr(item, "version", None)
+    if version is not None:
+        response.headers["ETag"] = etag(version)
+    return item